@@ -0,0 +1,183 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from scheduler import PRIORITY_INTERACTIVE
+from metrics import admission_rejections_total
+
+logger = logging.getLogger('Briefly-pdf')
+
+# PDFs que se leen y procesan a la vez en todo el servidor, y subidas que pueden
+# esperar turno; con la cola llena las subidas nuevas se rechazan con 503
+ADMISSION_MAX_EXTRACTIONS = max(1, int(os.getenv('ADMISSION_MAX_EXTRACTIONS', 2)))
+ADMISSION_MAX_WAITING_UPLOADS = max(0, int(os.getenv('ADMISSION_MAX_WAITING_UPLOADS', 4)))
+# Preguntas del usuario en espera de turno para el modelo a partir de las cuales se
+# rechazan las consultas nuevas con 503 (0 desactiva el límite)
+ADMISSION_MAX_QUEUED_CALLS = max(0, int(os.getenv('ADMISSION_MAX_QUEUED_CALLS', 32)))
+# Límite por cliente (cubo de fichas): consultas y subidas por minuto (0 lo desactiva) y ráfaga máxima
+RATE_LIMIT_QUERIES_PER_MINUTE = float(os.getenv('RATE_LIMIT_QUERIES_PER_MINUTE', 60))
+RATE_LIMIT_QUERY_BURST = max(1, int(os.getenv('RATE_LIMIT_QUERY_BURST', 20)))
+RATE_LIMIT_UPLOADS_PER_MINUTE = float(os.getenv('RATE_LIMIT_UPLOADS_PER_MINUTE', 10))
+RATE_LIMIT_UPLOAD_BURST = max(1, int(os.getenv('RATE_LIMIT_UPLOAD_BURST', 5)))
+# Cabecera con la IP del cliente cuando el servidor está detrás de un proxy (por
+# ejemplo X-Forwarded-For); vacía para usar la dirección de la conexión
+ADMISSION_CLIENT_HEADER = os.getenv('ADMISSION_CLIENT_HEADER', '')
+# Tamaño del cuerpo a partir del cual una petición se trata como subida antes de
+# leerla (las consultas de texto ocupan unos cientos de bytes)
+UPLOAD_BODY_MIN_BYTES = 64 * 1024
+# Clientes distintos cuyos cubos se recuerdan (se olvidan primero los más antiguos)
+RATE_LIMIT_MAX_CLIENTS = 10000
+
+
+# Petición rechazada por falta de capacidad (503) o por superar el límite del cliente (429)
+class AdmissionRejected(Exception):
+    def __init__(self, status, retry_after, message, reason):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+
+
+# Cubo de fichas: se recargan a `rate` fichas por segundo hasta `capacity`
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    # Tomar `count` fichas; devuelve 0 si se pudo o los segundos hasta que las haya
+    def take(self, count=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        count = min(count, self.capacity)
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0.0
+        return (count - self.tokens) / self.rate
+
+
+# Límite de peticiones por cliente, con un cubo de fichas por cliente
+class ClientRateLimiter:
+    def __init__(self, per_minute, burst, max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+
+    def take(self, client, count=1):
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket.take(count)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# Control de admisión del servidor: limita los PDFs que se procesan a la vez y la
+# cola de preguntas para el modelo, y aplica un límite por cliente a consultas y
+# subidas. Cuando no hay capacidad responde al momento (429/503 con Retry-After)
+# en lugar de dejar que la latencia empeore para todos.
+class AdmissionController:
+    def __init__(self, scheduler, max_extractions=ADMISSION_MAX_EXTRACTIONS,
+                 max_waiting_uploads=ADMISSION_MAX_WAITING_UPLOADS, max_queued_calls=ADMISSION_MAX_QUEUED_CALLS):
+        self.scheduler = scheduler
+        self.max_extractions = max_extractions
+        self.max_waiting_uploads = max_waiting_uploads
+        self.max_queued_calls = max_queued_calls
+        self.query_limiter = ClientRateLimiter(RATE_LIMIT_QUERIES_PER_MINUTE, RATE_LIMIT_QUERY_BURST)
+        self.upload_limiter = ClientRateLimiter(RATE_LIMIT_UPLOADS_PER_MINUTE, RATE_LIMIT_UPLOAD_BURST)
+        self.extractions = 0
+        self.waiting_uploads = 0
+        self._extraction_slots = asyncio.Semaphore(max_extractions)
+        self._extraction_seconds = 0.0
+        self._extraction_count = 0
+        self.rejected = {}
+
+    def _reject(self, status, retry_after, message, reason):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        admission_rejections_total.inc(reason=reason)
+        raise AdmissionRejected(status, retry_after, message, reason)
+
+    # Tiempo medio de procesamiento de un PDF (para estimar el Retry-After)
+    def _average_extraction(self):
+        return self._extraction_seconds / self._extraction_count if self._extraction_count else 5.0
+
+    # Admitir una consulta: límite del cliente y cola de preguntas para el modelo
+    def check_query(self, client):
+        wait = self.query_limiter.take(client)
+        if wait:
+            self._reject(429, wait, "Has enviado demasiadas consultas seguidas. Espera unos segundos antes de volver a intentarlo.",
+                         'query_rate')
+        queued = self.scheduler.queue_depth(PRIORITY_INTERACTIVE)
+        if self.max_queued_calls and queued >= self.max_queued_calls:
+            waited = self.scheduler.stats()['classes']['interactive']['avgWaitSeconds']
+            self._reject(503, waited, "El servidor está atendiendo demasiadas consultas. Vuelve a intentarlo en unos segundos.",
+                         'model_queue')
+
+    # Admitir una subida de `files` PDFs: límite del cliente y cola de PDFs pendientes de procesar
+    def check_upload(self, client, files=1):
+        wait = self.upload_limiter.take(client, files)
+        if wait:
+            self._reject(429, wait, "Has subido demasiados PDFs seguidos. Espera antes de subir otro.", 'upload_rate')
+        self.check_upload_capacity()
+
+    # Comprobar que hay capacidad para procesar otro PDF
+    def check_upload_capacity(self):
+        if self.extractions >= self.max_extractions and self.waiting_uploads >= self.max_waiting_uploads:
+            retry_after = self._average_extraction() * (self.waiting_uploads + 1) / self.max_extractions
+            self._reject(503, retry_after, "El servidor está procesando demasiados PDFs. Vuelve a intentarlo en unos segundos.",
+                         'extractions')
+
+    # Turno para leer y procesar un PDF; con la cola de espera llena lanza AdmissionRejected
+    @asynccontextmanager
+    async def extraction_slot(self):
+        self.check_upload_capacity()
+        self.waiting_uploads += 1
+        try:
+            await self._extraction_slots.acquire()
+        finally:
+            self.waiting_uploads -= 1
+        self.extractions += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.extractions -= 1
+            self._extraction_slots.release()
+            self._extraction_seconds += time.monotonic() - started
+            self._extraction_count += 1
+
+    def stats(self):
+        return {
+            'extractions': self.extractions,
+            'maxExtractions': self.max_extractions,
+            'waitingUploads': self.waiting_uploads,
+            'maxWaitingUploads': self.max_waiting_uploads,
+            'maxQueuedCalls': self.max_queued_calls,
+            'trackedClients': len(self.query_limiter) + len(self.upload_limiter),
+            'rejected': dict(self.rejected)
+        }
+
+
+# Función para identificar al cliente de una petición (para el límite por cliente)
+def client_id(request):
+    if ADMISSION_CLIENT_HEADER:
+        forwarded = request.headers.get(ADMISSION_CLIENT_HEADER)
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr or 'desconocido'
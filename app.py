@@ -1,16 +1,29 @@
-from quart import Quart, request, jsonify, send_from_directory
+from quart import Quart, request, jsonify, send_from_directory, make_response, g
 from quart_cors import cors
 import os
 import time
-import base64
 import uuid
 import asyncio
+from collections import Counter
 from typing import Dict, Any, List, Tuple
 from werkzeug.utils import secure_filename
-import google.generativeai as genai
 from dotenv import load_dotenv
-import fitz  # PyMuPDF
 import logging
+from pdf_processing import PdfIngestion, get_page_parts, image_part_stats, render_cache, shutdown_executor, block_plan_signature
+from document_store import DocumentStore, document_hash
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH, cache_key, normalize_question
+from scheduler import ModelScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, PRIORITY_PREFETCH, PRIORITY_NAMES
+from session_events import SessionEventBus, format_sse
+from page_index import PageIndex, build_page_index
+from session_state import create_session_state
+from resilience import ResilientCaller, describe_error
+from context_cache import DocumentContextCache
+from conversation import Conversation, CHAT_HISTORY, compaction_prompt
+from admission import AdmissionController, AdmissionRejected, client_id, UPLOAD_BODY_MIN_BYTES
+from text_cleanup import fit_pages, truncate_text, cleanup_stats, PROMPT_MAX_CHARS
+from model_backend import create_model, create_file_store
+from metrics import (registry, model_call_seconds, model_first_token_seconds, http_request_seconds, observe_payload,
+                     conversation_compactions_total, prompt_truncated_chars_total, record_timing, start_request_timings, server_timing_header, METRICS_TIMING_HEADER)
 
 # Configurar logging
 logging.basicConfig(
@@ -27,188 +40,1140 @@ app = Quart(__name__)
 app = cors(app, allow_origin=os.getenv('CORS_ORIGIN', '*'))
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # Aumenta el límite a 50MB
 
-# Inicializar Gemini
-API_KEY = os.getenv('GEMINI_API_KEY')
-if not API_KEY:
-    logger.error("No se encontró la API KEY de Gemini. Verifica tu archivo .env")
-    raise ValueError("GEMINI_API_KEY no está configurada en el archivo .env")
+# Inicializar el modelo: Gemini o, con MODEL_BACKEND=stub, un modelo local simulado
+# (sin API KEY) para desarrollo y pruebas de carga
+model, MODEL_NAME = create_model()
 
-genai.configure(api_key=API_KEY)
-model = genai.GenerativeModel(model_name="gemini-1.5-flash")  # Usar solo este modelo
+# Versiones de las plantillas de prompt: incrementarlas al cambiar un prompt
+# invalida las entradas correspondientes de la caché persistente
+SUMMARY_PROMPT_VERSION = 2
+QUERY_PROMPT_VERSION = 2
+# Segundos sin actividad tras los que se elimina una sesión, y cada cuánto se revisan
+SESSION_IDLE_TIMEOUT = int(os.getenv('SESSION_IDLE_TIMEOUT', 3600))
+SESSION_CLEANUP_INTERVAL = int(os.getenv('SESSION_CLEANUP_INTERVAL', 300))
+# Segundos mínimos entre dos "siguiente bloque" que generan un resumen nuevo
+BLOCK_REQUEST_INTERVAL = float(os.getenv('BLOCK_REQUEST_INTERVAL', 15))
+# Segundos que "obtener resumen" espera a un resumen en curso antes de responder que sigue pendiente
+SUMMARY_WAIT_TIMEOUT = float(os.getenv('SUMMARY_WAIT_TIMEOUT', 25))
+# Segundos que una consulta espera a las páginas de un PDF que aún se está procesando en segundo plano
+INGEST_WAIT_TIMEOUT = float(os.getenv('INGEST_WAIT_TIMEOUT', 20))
+# Bloques que se resumen por adelantado tras el bloque actual (0 desactiva la precarga)
+PREFETCH_BLOCKS = max(0, int(os.getenv('PREFETCH_BLOCKS', 0)))
+# Segundos sin actividad tras los que una sesión deja de precargar bloques
+PREFETCH_IDLE_TIMEOUT = int(os.getenv('PREFETCH_IDLE_TIMEOUT', 300))
+# Resumen completo: bloques que se resumen a la vez y resúmenes que se combinan en cada paso de reducción
+DOCUMENT_SUMMARY_CONCURRENCY = max(1, int(os.getenv('DOCUMENT_SUMMARY_CONCURRENCY', 4)))
+DOCUMENT_SUMMARY_GROUP_SIZE = max(2, int(os.getenv('DOCUMENT_SUMMARY_GROUP_SIZE', 8)))
+# Subida por lotes: archivos que se procesan a la vez y máximo de archivos por petición
+UPLOAD_CONCURRENCY = max(1, int(os.getenv('UPLOAD_CONCURRENCY', 2)))
+MAX_UPLOAD_FILES = max(1, int(os.getenv('MAX_UPLOAD_FILES', 10)))
 
-# Almacenamiento en memoria para los PDFs procesados
+# Procesos de Hypercorn que atienden peticiones (más de uno requiere SESSION_BACKEND=sqlite)
+WEB_WORKERS = max(1, int(os.getenv('WEB_WORKERS', 1)))
+
+# Sesiones cargadas en este worker (con sus PDFs procesados)
 pdf_store = {}
 # Almacenamiento para controlar los bloques enviados y sus resúmenes
 block_summary_control = {}
-# Semáforo para controlar acceso concurrente a recursos compartidos
-pdf_semaphore = asyncio.Semaphore(1)
+# Historial de la conversación de cada sesión cargada en este worker
+conversations = {}
+# Generaciones de resúmenes en curso: (hash del documento, bloque) -> tarea
+summary_inflight = {}
+# Precargas en curso: (hash del documento, bloque) -> sesión que la inició
+prefetch_inflight = {}
+# Bloques de cada documento cuyo resumen se generó por precarga
+prefetched_blocks = {}
+# Sesiones que esperan cada resumen de bloque en curso: (hash, bloque) -> Counter(sesión)
+summary_waiters = {}
+# Documentos que se siguen extrayendo en segundo plano: hash -> tarea que sigue la extracción
+ingestions = {}
+# Contadores de la precarga de resúmenes
+prefetch_stats = {
+    'started': 0,
+    'completed': 0,
+    'cancelled': 0,
+    'hits': 0,
+    'inflightHits': 0,
+    'misses': 0
+}
+
+# Función que libera los recursos de un documento que ya no usa ninguna sesión
+def on_document_evicted(doc_hash):
+    render_cache.invalidate(doc_hash)
+    context_cache.invalidate(doc_hash)
+    prefetched_blocks.pop(doc_hash, None)
+    ingestion_task = ingestions.pop(doc_hash, None)
+    if ingestion_task:
+        ingestion_task.cancel()
+    for key, task in list(summary_inflight.items()):
+        if key[0] == doc_hash:
+            task.cancel()
+
+# Función para calcular la memoria del historial de conversación de todas las sesiones
+def conversation_bytes():
+    return sum(conversation.memory_bytes() for conversation in conversations.values())
+
+# Documentos compartidos entre sesiones, indexados por el hash de su contenido. El
+# historial de las conversaciones cuenta en el mismo presupuesto de memoria.
+document_store = DocumentStore(on_evict=on_document_evicted, session_bytes=conversation_bytes)
+# Caché persistente (SQLite) de resúmenes y respuestas
+response_cache = ResponseCache(RESPONSE_CACHE_PATH)
+# Estado de las sesiones (en memoria o compartido entre workers, según SESSION_BACKEND)
+session_state = create_session_state()
+# Imágenes de página registradas en el backend del modelo y citadas por identificador
+context_cache = DocumentContextCache(create_file_store())
+# Planificador de llamadas al modelo (concurrencia global, prioridades y equidad entre sesiones)
+model_scheduler = ModelScheduler()
+# Reintentos, peticiones duplicadas e interruptor de circuito de las llamadas al modelo
+resilient_caller = ResilientCaller(scheduler=model_scheduler)
+# Control de admisión: PDFs que se procesan a la vez, cola de preguntas y límites por cliente
+admission = AdmissionController(model_scheduler)
+# Eventos de bloques enviados a los navegadores por Server-Sent Events
+event_bus = SessionEventBus()
+
+# Indicadores del estado del servidor exportados en /metrics
+registry.gauge('briefly_sessions', 'Sesiones activas', lambda: len(pdf_store))
+registry.gauge('briefly_documents', 'Documentos cargados (compartidos entre sesiones)', lambda: len(document_store))
+registry.gauge('briefly_document_resident_bytes', 'Memoria estimada de los documentos residentes y del historial de las sesiones',
+               document_store.resident_bytes)
+registry.gauge('briefly_render_cache_bytes', 'Bytes de la caché de páginas renderizadas', lambda: render_cache.current_bytes)
+registry.gauge('briefly_scheduler_active', 'Llamadas al modelo en curso', lambda: model_scheduler.active)
+registry.gauge('briefly_scheduler_queued', 'Llamadas al modelo en espera por prioridad',
+               lambda: {name: model_scheduler.queue_depth(priority) for priority, name in PRIORITY_NAMES.items()}, 'priority')
+registry.gauge('briefly_extractions_active', 'PDFs que se están leyendo y procesando', lambda: admission.extractions)
+registry.gauge('briefly_ingestions_active', 'PDFs que se siguen procesando tras crear su sesión', lambda: len(ingestions))
+registry.gauge('briefly_uploads_waiting', 'Subidas esperando turno para procesarse', lambda: admission.waiting_uploads)
+registry.gauge('briefly_summaries_inflight', 'Resúmenes en generación', lambda: len(summary_inflight))
+registry.gauge('briefly_model_circuit_open', 'Circuito del modelo abierto (1) o cerrado (0)',
+               lambda: 0 if resilient_caller.breaker.state == 'closed' else 1)
+registry.gauge('briefly_conversation_bytes', 'Bytes del historial de conversación de las sesiones', conversation_bytes)
+registry.gauge('briefly_event_streams', 'Flujos de eventos abiertos', lambda: event_bus.stats()['streams'])
 
 # Función para generar un ID único para cada sesión
 def generate_session_id():
     return str(uuid.uuid4())
 
-# Función para convertir imagen a base64
-def image_to_base64(image_data):
-    return base64.b64encode(image_data).decode('utf-8')
+# Función para obtener una sesión registrando el acceso (las sesiones y los
+# documentos se expulsan según su último acceso, no según su creación)
+def get_session(session_id):
+    pdf_data = pdf_store.get(session_id)
+    if pdf_data:
+        pdf_data['lastAccess'] = time.time()
+        document_store.touch(pdf_data['docHash'], pdf_data['document'])
+    return pdf_data
+
+# Función para cargar una sesión desde el estado de las sesiones. En un worker que no
+# la creó se carga su documento del directorio compartido; en todos se actualizan el
+# bloque actual y los resúmenes que hayan generado otros workers. Devuelve los datos
+# de la sesión, o None si no existe.
+async def load_session(session_id, touch=True):
+    record = await session_state.load_session(session_id)
+    if record is None:
+        drop_session(session_id)  # Se eliminó desde otro worker
+        return None
+    pdf_data = pdf_store.get(session_id)
+    if pdf_data is None:
+        pdf_data = await restore_session(session_id, record)
+        if pdf_data is None:
+            return None
+    if session_state.shared:
+        control = block_summary_control[session_id]
+        if record['lastSent'] > control['lastSent']:
+            control['lastBlock'] = record['lastBlock']
+            control['lastSent'] = record['lastSent']
+        document = pdf_data['document']
+        for key, text in (await session_state.load_summaries(pdf_data['docHash'])).items():
+            if key == 'document':
+                document.setdefault('documentSummary', text)
+            else:
+                document['summaries'].setdefault(key, text)
+        shared_conversation = await session_state.load_conversation(session_id)
+        local_conversation = conversations.get(session_id)
+        if shared_conversation and (local_conversation is None or shared_conversation['updated'] > local_conversation.updated):
+            conversations[session_id] = Conversation.from_dict(shared_conversation)
+    if touch:
+        get_session(session_id)
+        await session_state.touch_session(session_id, pdf_data['lastAccess'])
+    return pdf_data
+
+# Función para cargar en este worker una sesión creada en otro
+async def restore_session(session_id, record):
+    doc_hash = record['docHash']
+
+    async def load_shared_document():
+        document = await session_state.load_document(doc_hash)
+        if document is None:
+            raise FileNotFoundError(f"El documento {doc_hash[:12]} no está en el directorio compartido")
+        document['index'] = await asyncio.to_thread(build_page_index, document['pages'])
+        return document
 
-# Función para extraer contenido del PDF (texto e imágenes)
-def extract_pdf_contents(buffer):
     try:
-        # Cargar el documento PDF con PyMuPDF
-        doc = fitz.open(stream=buffer, filetype="pdf")
-        total_pages = len(doc)
-        pages = []
+        document, _ = await document_store.acquire(doc_hash, load_shared_document)
+    except Exception as error:
+        logger.error(f"No se pudo cargar la sesión {session_id}: {error}")
+        return None
+    if session_id in pdf_store:
+        # Otra petición de la misma sesión la cargó mientras tanto
+        document_store.release(doc_hash)
+        return pdf_store[session_id]
+    
+    pdf_store[session_id] = {
+        'name': record['name'],
+        'docHash': doc_hash,
+        'document': document,
+        'totalPages': record['totalPages'],
+        'timestamp': record['timestamp'],
+        'lastAccess': record['lastAccess']
+    }
+    block_summary_control[session_id] = {
+        'lastBlock': record['lastBlock'],
+        'lastSent': record['lastSent'],
+        'summaries': document['summaries']
+    }
+    logger.info(f"Sesión {session_id} cargada desde el estado compartido")
+    return pdf_store[session_id]
 
-        logger.info(f"Procesando PDF con {total_pages} páginas")
-        
-        for i in range(total_pages):
-            page = doc[i]
-            
-            # Extraer texto
-            text_items = page.get_text()
-            
-            # Renderizar página como imagen con resolución optimizada
-            pix = page.get_pixmap(matrix=fitz.Matrix(1.2, 1.2))  # Reducida de 1.5 a 1.2 para optimizar
-            page_image = pix.tobytes("png")
-            page_image_base64 = image_to_base64(page_image)
-            
-            pages.append({
-                'pageNumber': i + 1,
-                'text': text_items,
-                'fullPageImage': page_image_base64
-            })
-            logger.info(f"Página {i+1}/{total_pages} procesada")
+# Función para obtener la tabla de bloques de una sesión: rangos (inicio, fin) de páginas
+# planificados una sola vez al procesar el documento (fin excluido, índices desde 0)
+def get_blocks(pdf_data):
+    return pdf_data['document']['blocks']
 
-        return {
-            'totalPages': total_pages,
-            'pages': pages
+# Función para obtener el número de bloques de una sesión. Mientras el documento se
+# sigue procesando es una estimación a partir de los bloques ya planificados.
+def count_blocks(pdf_data):
+    ingestion = pdf_data['document'].get('ingestion')
+    return ingestion.estimated_blocks() if ingestion else len(get_blocks(pdf_data))
+
+# Función para obtener el avance del procesamiento de un documento
+def ingestion_progress(document):
+    ingestion = document.get('ingestion')
+    if ingestion:
+        return ingestion.progress()
+    if 'ingested' in document:
+        return document['ingested']
+    # Documento cargado del directorio compartido: ya se procesó completo en otro worker
+    return {
+        'pagesReady': document['totalPages'],
+        'totalPages': document['totalPages'],
+        'blocksReady': len(document['blocks']),
+        'estimatedBlocks': len(document['blocks']),
+        'done': True,
+        'error': None
+    }
+
+# Función para esperar a una parte de un documento que se sigue procesando en segundo
+# plano: las páginas [0, pages), el bloque `block` o, sin ninguno de los dos, el
+# documento completo. Devuelve None si ya está disponible (o el documento no tiene ese
+# bloque) y un mensaje para el usuario si no llega a tiempo o el procesamiento falló.
+async def wait_for_ingestion(document, pages=None, block=None, timeout=INGEST_WAIT_TIMEOUT):
+    ingestion = document.get('ingestion')
+    if ingestion is None:
+        # Documento que no se pudo procesar entero: solo están las páginas previas al fallo
+        error = document.get('ingested', {}).get('error')
+        if error is None:
+            return None
+        if block is not None:
+            available = block < len(document['blocks'])
+        elif pages is not None:
+            available = len(document['pages']) >= pages
+        else:
+            available = False
+        return None if available else f"No se pudo procesar el documento completo: {error}"
+    if block is not None:
+        waiter = ingestion.wait_for_block(block)
+    elif pages is not None:
+        waiter = ingestion.wait_for_pages(pages)
+    else:
+        waiter = ingestion.wait()
+    try:
+        available = await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        progress = ingestion.progress()
+        return (f"El documento aún se está procesando ({progress['pagesReady']} de {progress['totalPages']} páginas listas). "
+                "Vuelve a intentarlo en unos segundos.")
+    if not available and ingestion.error:
+        return f"No se pudo procesar el documento completo: {ingestion.error}"
+    return None
+
+# Función que sigue la extracción en segundo plano de un documento: publica el avance
+# tras cada tanda de páginas y, al terminar, actualiza su memoria y respeta el presupuesto
+async def track_ingestion(doc_hash, document, ingestion):
+    try:
+        while not ingestion.finished:
+            await ingestion.wait_for_pages(len(ingestion.pages) + 1)
+            document_store.update_size(doc_hash)
+            publish_block_event(doc_hash, 'ingestion', ingestion.progress())
+    except asyncio.CancelledError:
+        ingestion.cancel()
+        raise
+    finally:
+        if ingestions.get(doc_hash) is asyncio.current_task():
+            del ingestions[doc_hash]
+    
+    if ingestion.error:
+        logger.error(f"El documento {doc_hash[:12]} quedó procesado a medias "
+                     f"({len(ingestion.pages)} de {ingestion.total_pages} páginas): {ingestion.error}")
+        # Las sesiones que ya lo usan conservan las páginas extraídas (ver wait_for_ingestion),
+        # pero las siguientes subidas del mismo PDF lo vuelven a extraer
+        document['ingested'] = ingestion.progress()
+        del document['ingestion']
+        document_store.update_size(doc_hash)
+        document_store.retire(doc_hash)
+        publish_block_event(doc_hash, 'ingestion', document['ingested'])
+        await document_store.enforce_budget()
+        return
+    progress = ingestion.progress()
+    logger.info(f"Documento {doc_hash[:12]} procesado en segundo plano en {progress['seconds']:.2f} segundos "
+                f"(disponible a los {progress['firstBlockSeconds']:.2f} segundos)")
+    document['ingested'] = progress
+    del document['ingestion']
+    document_store.update_size(doc_hash)
+    await document_store.enforce_budget()
+
+# Función para quitar una sesión de este worker y liberar su referencia al documento
+def drop_session(session_id):
+    cancel_prefetch(session_id)
+    pdf_data = pdf_store.pop(session_id, None)
+    block_summary_control.pop(session_id, None)
+    conversation = conversations.pop(session_id, None)
+    if conversation and conversation.compacting:
+        conversation.compacting.cancel()
+    event_bus.close(session_id)
+    if pdf_data:
+        document_store.release(pdf_data['docHash'], pdf_data['document'])
+    return pdf_data is not None
+
+# Función para eliminar una sesión (del estado de las sesiones y de este worker)
+async def remove_session(session_id):
+    removed = await session_state.delete_session(session_id)
+    return drop_session(session_id) or removed
+
+# Función para notificar un evento de bloque a todas las sesiones que usan el documento
+def publish_block_event(doc_hash, event, data):
+    for session_id in event_bus.session_ids():
+        pdf_data = pdf_store.get(session_id)
+        if pdf_data and pdf_data['docHash'] == doc_hash:
+            event_bus.publish(session_id, event, data)
+
+# Función para guardar un resumen en el documento (compartido por todas sus sesiones)
+# y en el estado de las sesiones, para los demás workers
+async def store_block_summary(session_id, document, block_index, texto_resumen):
+    if document['summaries'].get(block_index) != texto_resumen:
+        document['summaries'][block_index] = texto_resumen
+        await session_state.save_summary(document['hash'], block_index, texto_resumen)
+    if session_id in pdf_store and session_id not in block_summary_control:
+        block_summary_control[session_id] = {
+            'lastBlock': block_index,
+            'lastSent': time.time(),
+            'summaries': document['summaries']
         }
+
+# Función para llamar al modelo con un turno del planificador y un tiempo máximo,
+# registrando en las métricas la duración, el resultado y los bytes enviados.
+# Los errores transitorios se reintentan y las preguntas del usuario pueden
+# duplicarse si tardan más de lo habitual (ver resilience.py); con el circuito
+# abierto la llamada falla al instante con CircuitOpenError.
+async def call_model(parts, session_id, priority, timeout, kind, key=None):
+    observe_payload(kind, parts)
+    resilient_caller.check(kind)
+
+    async def attempt(attempt_timeout):
+        return await asyncio.wait_for(model.generate_content_async(parts), timeout=attempt_timeout)
+
+    async with model_scheduler.slot(session_id, priority, key):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            resultado = await resilient_caller.call(attempt, timeout, kind, hedge=priority == PRIORITY_INTERACTIVE)
+            outcome = 'success'
+            return resultado
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            model_call_seconds.observe(elapsed, kind=kind, outcome=outcome)
+            record_timing('model', elapsed)
+
+# Función para registrar que el texto de una llamada se recortó por superar PROMPT_MAX_CHARS
+def report_truncation(kind, page_numbers, dropped_chars):
+    cleanup_stats['truncatedCalls'] += 1
+    cleanup_stats['truncatedChars'] += dropped_chars
+    prompt_truncated_chars_total.inc(dropped_chars, kind=kind)
+    logger.warning(f"Texto recortado en la llamada '{kind}': {dropped_chars} caracteres omitidos "
+                   f"de las páginas {page_numbers} (presupuesto {PROMPT_MAX_CHARS})")
+
+# Función para construir el texto de unas páginas para un prompt dentro del presupuesto
+def pages_prompt_text(document, page_indices, kind):
+    pages_info, truncation = fit_pages([(i + 1, document['pages'][i].text) for i in page_indices])
+    if truncation:
+        report_truncation(kind, truncation['pages'], truncation['droppedChars'])
+    return pages_info
+
+# Función para añadir a una pregunta el historial de la conversación de la sesión
+def with_conversation(session_id, parts):
+    conversation = conversations.get(session_id) if CHAT_HISTORY else None
+    return conversation.contents(parts) if conversation else parts
+
+# Función para obtener las claves de la caché de respuestas que dependen del historial
+def conversation_cache_context(session_id):
+    conversation = conversations.get(session_id) if CHAT_HISTORY else None
+    return conversation.cache_context() if conversation else ()
+
+# Función para guardar un turno de la conversación y, si el historial supera su
+# presupuesto, condensar en segundo plano los turnos más antiguos
+async def record_turn(session_id, question, answer):
+    if not CHAT_HISTORY or session_id not in pdf_store:
+        return
+    conversation = conversations.setdefault(session_id, Conversation())
+    conversation.add_turn(question, answer)
+    await session_state.save_conversation(session_id, conversation.to_dict())
+    # El historial cuenta en el presupuesto de memoria de las sesiones
+    await document_store.enforce_budget()
+    count = conversation.compaction_batch()
+    if count and conversation.compacting is None:
+        conversation.compacting = asyncio.create_task(compact_conversation(session_id, conversation, count))
+
+# Función para condensar los turnos más antiguos de una conversación en su resumen.
+# Se hace después de responder, con prioridad de fondo, para que la latencia de las
+# preguntas no dependa de la longitud de la conversación.
+async def compact_conversation(session_id, conversation, count):
+    turns = conversation.turns[:count]
+    try:
+        prompt = compaction_prompt(pdf_store[session_id]['name'], conversation.summary, turns)
+        resultado = await call_model(prompt, session_id, PRIORITY_BACKGROUND, 60, 'history')
+        conversation.apply_compaction(resultado.text.strip(), count)
+        conversation_compactions_total.inc(outcome='success')
+        logger.info(f"Historial de la sesión {session_id}: {count} turnos condensados en el resumen")
+    except asyncio.CancelledError:
+        raise
     except Exception as error:
-        logger.error(f'Error al procesar el PDF: {error}')
-        raise Exception(f'No se pudo procesar el archivo PDF: {str(error)}')
+        # Sin resumen nuevo se descartan los turnos antiguos para que el historial siga acotado
+        conversation.apply_compaction(conversation.summary, count)
+        conversation_compactions_total.inc(outcome='error')
+        logger.warning(f"No se pudo condensar el historial de la sesión {session_id}: {describe_error(error)}")
+    finally:
+        conversation.compacting = None
+    if conversations.get(session_id) is conversation:
+        await session_state.save_conversation(session_id, conversation.to_dict())
 
 # Función para generar un resumen de un solo bloque incluyendo imágenes
-async def generate_block_summary(session_id, block_index):
-    async with pdf_semaphore:  # Usar semáforo para evitar sobrecarga
-        pdf_data = pdf_store.get(session_id)
-        if not pdf_data:
-            logger.warning(f"No se encontró el PDF para la sesión {session_id}")
-            return {'success': False, 'message': 'No se encontró el PDF'}
+async def generate_block_summary(session_id, block_index, priority=PRIORITY_BACKGROUND):
+    pdf_data = pdf_store.get(session_id)
+    if not pdf_data:
+        logger.warning(f"No se encontró el PDF para la sesión {session_id}")
+        return {'success': False, 'message': 'No se encontró el PDF'}
 
-        total_blocks = (pdf_data['totalPages'] + 2) // 3  # Equivalente a Math.ceil(pdf_data.totalPages / 3)
+    # Si el documento se sigue procesando, esperar a que se planifique este bloque
+    document = pdf_data['document']
+    message = await wait_for_ingestion(document, block=max(block_index, 0), timeout=None)
+    if message:
+        return {'success': False, 'message': message}
+    blocks = get_blocks(pdf_data)
+    total_blocks = count_blocks(pdf_data)
+    
+    # Verificar si el bloque solicitado es válido
+    if block_index < 0 or block_index >= len(blocks):
+        logger.warning(f"Bloque {block_index + 1} fuera de rango para documento con {total_blocks} bloques")
+        return {
+            'success': False,
+            'message': f'El bloque {block_index + 1} no existe. El documento tiene {total_blocks} bloques.'
+        }
+
+    # Rango de páginas de este bloque
+    start_page, end_page = blocks[block_index]
+    summary_key = cache_key('summary', document['hash'], f"{start_page + 1}-{end_page}", SUMMARY_PROMPT_VERSION, MODEL_NAME)
+    
+    # Buscar el resumen en memoria y en la caché persistente antes de llamar al modelo
+    texto_resumen = document['summaries'].get(block_index)
+    if texto_resumen is None:
+        texto_resumen = await response_cache.get('summaries', summary_key)
+        if texto_resumen is not None:
+            logger.info(f"Resumen del bloque {block_index + 1} recuperado de la caché persistente")
+    if texto_resumen is not None:
+        await store_block_summary(session_id, document, block_index, texto_resumen)
+        publish_block_event(document['hash'], 'block_ready', {
+            'block': block_index + 1,
+            'pageRange': f"{start_page + 1}-{end_page}",
+            'summary': texto_resumen,
+            'totalBlocks': total_blocks
+        })
+        prefetch_after_block(document['hash'], block_index)
+        return {
+            'success': True,
+            'blockIndex': block_index + 1,
+            'pageRange': f"{start_page + 1}-{end_page}",
+            'summary': texto_resumen,
+            'totalBlocks': total_blocks
+        }
+    
+    logger.info(f"Generando resumen para bloque {block_index+1} (páginas {start_page+1}-{end_page})")
+    publish_block_event(document['hash'], 'block_started', {
+        'block': block_index + 1,
+        'pageRange': f"{start_page + 1}-{end_page}",
+        'totalBlocks': total_blocks
+    })
+    
+    # Construir el prompt para Gemini - optimizado para un solo bloque (texto limpio, dentro del presupuesto)
+    pages_info = pages_prompt_text(document, range(start_page, end_page), 'summary')
+    
+    prompt_resumen = f"""
+        Eres Briefly, un asistente virtual especializado en resumir documentos.
         
-        # Verificar si el bloque solicitado es válido
-        if block_index < 0 or block_index >= total_blocks:
-            logger.warning(f"Bloque {block_index + 1} fuera de rango para documento con {total_blocks} bloques")
-            return {
-                'success': False,
-                'message': f'El bloque {block_index + 1} no existe. El documento tiene {total_blocks} bloques.'
-            }
+        Genera un resumen conciso y completo del siguiente bloque de páginas (Bloque {block_index + 1}) del documento "{pdf_data['name']}".
+        Este resumen debe capturar los puntos clave y la información esencial, incluyendo tanto el texto como el contenido visual de las imágenes que se te proporcionan.
+        
+        {pages_info}
+        
+        Formato de respuesta:
+        "BLOQUE {block_index + 1} (Páginas {start_page + 1}-{end_page}):\n
+        [Resumen que capture los puntos clave de estas páginas en 3-5 oraciones, incluyendo descripción de elementos visuales importantes]"
+        
+        Mantén el resumen claro y directo, destacando solo la información más relevante. Incluye descripciones de cualquier gráfico, tabla o imagen importante que veas.
+    """
+    
+    try:
+        # Imágenes de las páginas con contenido visual (renderizadas bajo demanda). El resumen
+        # se genera una sola vez: las imágenes van incrustadas salvo que ya estén registradas.
+        # Un fallo al renderizar se informa como cualquier otro error del resumen.
+        block_images = await get_page_parts(document['hash'], document['buffer'], document['pages'], range(start_page, end_page),
+                                            context_cache=context_cache, register=False)
+        
+        # Crear un array de partes para el modelo de visión
+        parts = [
+            {"text": prompt_resumen},
+            *block_images  # Agregar todas las imágenes del bloque
+        ]
+        
+        # Usar el modelo para procesar imágenes y texto con timeout
+        start_time = time.time()
+        # Una precarga que el usuario ya pidió (ver record_prefetch_lookup) sube de prioridad
+        key = (document['hash'], block_index)
+        if priority == PRIORITY_PREFETCH and key not in prefetch_inflight:
+            priority = PRIORITY_BACKGROUND
+        resultado = await call_model(parts, session_id, priority, 60, 'summary', key)  # Timeout de 60 segundos
+        texto_resumen = resultado.text.strip()
+        logger.info(f"Resumen generado en {time.time() - start_time:.2f} segundos")
+        
+        await store_block_summary(session_id, document, block_index, texto_resumen)
+        publish_block_event(document['hash'], 'block_ready', {
+            'block': block_index + 1,
+            'pageRange': f"{start_page + 1}-{end_page}",
+            'summary': texto_resumen,
+            'totalBlocks': total_blocks
+        })
+        await response_cache.put('summaries', summary_key, texto_resumen)
+        prefetch_after_block(document['hash'], block_index)
+        
+        return {
+            'success': True,
+            'blockIndex': block_index + 1,
+            'pageRange': f"{start_page + 1}-{end_page}",
+            'summary': texto_resumen,
+            'totalBlocks': total_blocks
+        }
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout al generar resumen para el bloque {block_index + 1}")
+        message = f"Tiempo de espera agotado al generar el resumen para el Bloque {block_index + 1}. Intenta nuevamente."
+    except Exception as error:
+        logger.error(f"Error al generar resumen para el bloque {block_index + 1}: {error}")
+        message = f"No se pudo generar el resumen para el Bloque {block_index + 1} (Páginas {start_page + 1}-{end_page}): {describe_error(error)}"
+    
+    publish_block_event(document['hash'], 'error', {'block': block_index + 1, 'message': message})
+    return {
+        'success': False,
+        'message': message
+    }
+
+# Función para iniciar la generación de un resumen, o reutilizar la que ya está en curso
+# para el mismo bloque del mismo documento (single-flight)
+def start_block_summary(session_id, block_index, priority=PRIORITY_BACKGROUND):
+    pdf_data = pdf_store.get(session_id)
+    if not pdf_data:
+        return None
+    key = (pdf_data['docHash'], block_index)
+    task = summary_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_block_summary(session_id, block_index, priority))
+        summary_inflight[key] = task
 
-        # Calcular el rango de páginas para este bloque
-        start_page = block_index * 3
-        end_page = min(start_page + 3, pdf_data['totalPages'])
+        def forget(finished, key=key):
+            if summary_inflight.get(key) is finished:
+                del summary_inflight[key]
+        task.add_done_callback(forget)
+    return task
+
+# Función para esperar el resumen de un bloque sin lanzar generaciones duplicadas
+async def request_block_summary(session_id, block_index, priority=PRIORITY_BACKGROUND, timeout=None):
+    task = start_block_summary(session_id, block_index, priority)
+    if task is None:
+        return {'success': False, 'message': 'No se encontró el PDF'}
+    key = (pdf_store[session_id]['docHash'], block_index)
+    waiters = summary_waiters.setdefault(key, Counter())
+    waiters[session_id] += 1
+    try:
+        # shield: si este llamador se cancela o agota su espera, la generación sigue para los demás
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError:
+        return {'success': False, 'pending': True, 'message': f'El resumen del bloque {block_index + 1} aún se está generando.'}
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return {'success': False, 'message': f'Se canceló la generación del resumen del bloque {block_index + 1}.'}
+        raise
+    finally:
+        waiters[session_id] -= 1
+        if waiters[session_id] <= 0:
+            del waiters[session_id]
+        if not waiters and summary_waiters.get(key) is waiters:
+            del summary_waiters[key]
+
+# Función para combinar varios resúmenes consecutivos en uno solo (un paso de la reducción).
+# `items` son diccionarios con el texto y el rango de páginas que resumen.
+async def reduce_summaries(session_id, pdf_data, items, final):
+    start_page = items[0]['startPage']
+    end_page = items[-1]['endPage']
+    summaries_info = "\n\n".join(item['text'] for item in items)
+    if final:
+        instructions = f"""Redacta el resumen general del documento completo ({pdf_data['totalPages']} páginas).
+        Empieza con una visión global de 2-3 oraciones y después enumera las ideas principales en el orden en que aparecen, indicando las páginas."""
+    else:
+        instructions = f"""Combínalos en el resumen de una sección del documento con el formato:
+        SECCIÓN (Páginas {start_page}-{end_page}):\n[Resumen de 4-6 oraciones con los puntos clave de la sección]."""
+    
+    prompt_reduccion = f"""
+        Eres Briefly, un asistente virtual especializado en resumir documentos.
         
-        logger.info(f"Generando resumen para bloque {block_index+1} (páginas {start_page+1}-{end_page})")
+        A continuación tienes los resúmenes de {len(items)} partes consecutivas (páginas {start_page}-{end_page}) del documento "{pdf_data['name']}".
         
-        # Obtener el contenido de las páginas en este bloque
-        block_pages = []
-        block_images = []
+        {summaries_info}
         
-        for i in range(start_page, end_page):
-            block_pages.append({
-                'pageNumber': i + 1,
-                'content': pdf_data['pages'][i]['text']
-            })
-            
-            # Añadir la imagen de la página completa
-            block_images.append({
-                'inline_data': {
-                    'data': pdf_data['pages'][i]['fullPageImage'],
-                    'mime_type': "image/png"
-                }
-            })
+        {instructions}
         
-        # Construir el prompt para Gemini - optimizado para un solo bloque
-        pages_info = "\n".join([
-            f"--- PÁGINA {page['pageNumber']} ---\n{page['content']}\n"
-            for page in block_pages
-        ])
+        No repitas información ni inventes datos que no aparezcan en los resúmenes. Conserva las descripciones de gráficos, tablas o imágenes importantes.
+    """
+    
+    resultado = await call_model(prompt_reduccion, session_id, PRIORITY_BACKGROUND, 60, 'reduce')
+    return {'text': resultado.text.strip(), 'startPage': start_page, 'endPage': end_page}
+
+# Función para generar el resumen del documento completo (map-reduce): resume todos los
+# bloques en paralelo reutilizando los que ya existen, y después combina los resúmenes por
+# grupos (bloques -> secciones -> documento), publicando el progreso de cada etapa.
+async def generate_document_summary(session_id):
+    pdf_data = pdf_store.get(session_id)
+    if not pdf_data:
+        return {'success': False, 'message': 'No se encontró el PDF'}
+    
+    # El resumen completo necesita todos los bloques: esperar a que termine el procesamiento
+    document = pdf_data['document']
+    message = await wait_for_ingestion(document, timeout=None)
+    if message:
+        return {'success': False, 'message': message}
+    doc_hash = document['hash']
+    blocks = get_blocks(pdf_data)
+    total_blocks = len(blocks)
+    summary_key = cache_key('document-summary', doc_hash, block_plan_signature(), DOCUMENT_SUMMARY_GROUP_SIZE,
+                            SUMMARY_PROMPT_VERSION, MODEL_NAME)
+    
+    texto_resumen = document.get('documentSummary') or await response_cache.get('summaries', summary_key)
+    if texto_resumen is not None:
+        document['documentSummary'] = texto_resumen
+        publish_block_event(doc_hash, 'document_ready', {'summary': texto_resumen, 'totalBlocks': total_blocks})
+        return {'success': True, 'summary': texto_resumen, 'totalBlocks': total_blocks}
+    
+    start_time = time.time()
+    semaphore = asyncio.Semaphore(DOCUMENT_SUMMARY_CONCURRENCY)
+    progress = {'completed': 0}
+    
+    def report(stage, level, total):
+        progress['completed'] += 1
+        publish_block_event(doc_hash, 'document_progress', {
+            'stage': stage,
+            'level': level,
+            'completed': progress['completed'],
+            'total': total
+        })
+    
+    # Etapa map: un resumen por bloque (los ya generados se reutilizan)
+    async def summarize_block(block_index):
+        if block_index not in document['summaries']:
+            async with semaphore:
+                result = await request_block_summary(session_id, block_index, PRIORITY_BACKGROUND)
+            if not result['success']:
+                raise RuntimeError(result['message'])
+        report('map', 0, total_blocks)
+        return {
+            'text': document['summaries'][block_index],
+            'startPage': blocks[block_index][0] + 1,
+            'endPage': blocks[block_index][1]
+        }
+    
+    # Etapa reduce: combinar grupos de resúmenes hasta que quede uno
+    async def reduce_group(items, level, total, final):
+        async with semaphore:
+            reduced = await reduce_summaries(session_id, pdf_data, items, final)
+        report('reduce', level, total)
+        return reduced
+    
+    try:
+        reused = sum(1 for i in range(total_blocks) if i in document['summaries'])
+        logger.info(f"Resumen completo: {total_blocks} bloques ({reused} reutilizados)")
+        items = await asyncio.gather(*[summarize_block(i) for i in range(total_blocks)])
         
-        prompt_resumen = f"""
-            Eres Briefly, un asistente virtual especializado en resumir documentos.
-            
-            Genera un resumen conciso y completo del siguiente bloque de páginas (Bloque {block_index + 1}) del documento "{pdf_data['name']}".
-            Este resumen debe capturar los puntos clave y la información esencial, incluyendo tanto el texto como el contenido visual de las imágenes que se te proporcionan.
-            
-            {pages_info}
-            
-            Formato de respuesta:
-            "BLOQUE {block_index + 1} (Páginas {start_page + 1}-{end_page}):\n
-            [Resumen que capture los puntos clave de estas páginas en 3-5 oraciones, incluyendo descripción de elementos visuales importantes]"
-            
-            Mantén el resumen claro y directo, destacando solo la información más relevante. Incluye descripciones de cualquier gráfico, tabla o imagen importante que veas.
-        """
+        level = 0
+        while True:
+            level += 1
+            groups = [items[i:i + DOCUMENT_SUMMARY_GROUP_SIZE] for i in range(0, len(items), DOCUMENT_SUMMARY_GROUP_SIZE)]
+            final = len(groups) == 1
+            progress['completed'] = 0
+            items = await asyncio.gather(*[reduce_group(group, level, len(groups), final) for group in groups])
+            if final:
+                break
         
+        texto_resumen = items[0]['text']
+        logger.info(f"Resumen completo generado en {time.time() - start_time:.2f} segundos ({level} niveles de reducción)")
+        document['documentSummary'] = texto_resumen
+        publish_block_event(doc_hash, 'document_ready', {'summary': texto_resumen, 'totalBlocks': total_blocks})
+        await session_state.save_summary(doc_hash, 'document', texto_resumen)
+        await response_cache.put('summaries', summary_key, texto_resumen)
+        return {'success': True, 'summary': texto_resumen, 'totalBlocks': total_blocks}
+    except asyncio.TimeoutError:
+        logger.error("Timeout al generar el resumen completo")
+        message = "Tiempo de espera agotado al generar el resumen completo. Intenta nuevamente."
+    except Exception as error:
+        logger.error(f"Error al generar el resumen completo: {error}")
+        message = f"No se pudo generar el resumen completo: {describe_error(error)}"
+    
+    publish_block_event(doc_hash, 'error', {'documentSummary': True, 'message': message})
+    return {'success': False, 'message': message}
+
+# Función para esperar el resumen completo, compartiendo la generación entre las sesiones del documento
+async def request_document_summary(session_id, timeout=None):
+    pdf_data = pdf_store.get(session_id)
+    if not pdf_data:
+        return {'success': False, 'message': 'No se encontró el PDF'}
+    key = (pdf_data['docHash'], 'document')
+    task = summary_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_document_summary(session_id))
+        summary_inflight[key] = task
+
+        def forget(finished, key=key):
+            if summary_inflight.get(key) is finished:
+                del summary_inflight[key]
+        task.add_done_callback(forget)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError:
+        return {'success': False, 'pending': True, 'message': 'El resumen completo del documento se está generando. Te lo mostraré en cuanto esté listo.'}
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return {'success': False, 'message': 'Se canceló la generación del resumen completo.'}
+        raise
+
+# Función para generar por adelantado, con prioridad baja, los resúmenes de los
+# PREFETCH_BLOCKS bloques que siguen a `block_index`
+def prefetch_following_blocks(session_id, block_index):
+    pdf_data = pdf_store.get(session_id)
+    if PREFETCH_BLOCKS <= 0 or not pdf_data:
+        return
+    if pdf_data['lastAccess'] < time.time() - PREFETCH_IDLE_TIMEOUT:
+        return
+    document = pdf_data['document']
+    total_blocks = len(get_blocks(pdf_data))
+    for block in range(block_index + 1, min(block_index + 1 + PREFETCH_BLOCKS, total_blocks)):
+        key = (document['hash'], block)
+        if block in document['summaries'] or key in summary_inflight:
+            continue
+        task = start_block_summary(session_id, block, PRIORITY_PREFETCH)
+        prefetch_inflight[key] = session_id
+        prefetched_blocks.setdefault(document['hash'], set()).add(block)
+        prefetch_stats['started'] += 1
+
+        def finish(finished, key=key):
+            if prefetch_inflight.pop(key, None) is None:
+                return  # El usuario ya lo pidió: dejó de ser una precarga
+            if finished.cancelled():
+                prefetch_stats['cancelled'] += 1
+                prefetched_blocks.get(key[0], set()).discard(key[1])
+            elif finished.exception() is not None:
+                prefetched_blocks.get(key[0], set()).discard(key[1])
+            elif finished.result().get('success'):
+                prefetch_stats['completed'] += 1
+        task.add_done_callback(finish)
+
+# Función para precargar los bloques siguientes en las sesiones que están leyendo el bloque que acaba de estar listo
+def prefetch_after_block(doc_hash, block_index):
+    for session_id, pdf_data in list(pdf_store.items()):
+        control = block_summary_control.get(session_id)
+        if pdf_data['docHash'] == doc_hash and control and control['lastBlock'] == block_index:
+            prefetch_following_blocks(session_id, block_index)
+
+# Función para cancelar las precargas iniciadas por una sesión (eliminada o inactiva)
+def cancel_prefetch(session_id):
+    for key, owner in list(prefetch_inflight.items()):
+        task = summary_inflight.get(key)
+        # La generación es compartida: no se cancela si otra sesión está esperando el resumen
+        waiting = summary_waiters.get(key, {})
+        if owner == session_id and task and not any(waiter != session_id for waiter in waiting):
+            task.cancel()
+
+# Función para registrar si el bloque pedido con "siguiente bloque" ya estaba precargado.
+# Si la precarga sigue en curso, pasa a ser una petición del usuario y sube de prioridad.
+def record_prefetch_lookup(session_id, doc_hash, block_index, ready):
+    key = (doc_hash, block_index)
+    owner = prefetch_inflight.pop(key, None)
+    if owner is not None:
+        prefetch_stats['inflightHits'] += 1
+        model_scheduler.promote(owner, PRIORITY_BACKGROUND, key)
+    elif ready and block_index in prefetched_blocks.get(doc_hash, ()):
+        prefetch_stats['hits'] += 1
+    elif PREFETCH_BLOCKS > 0 and not ready:
+        prefetch_stats['misses'] += 1
+
+# Función que procesa un archivo subido (lectura -> extracción -> índice) y crea su sesión.
+# El resumen del primer bloque empieza en cuanto termina este archivo, sin esperar al resto del lote.
+async def ingest_upload(file, semaphore):
+    logger.info(f"Procesando archivo: {file.filename}")
+    # Verificar que es un PDF
+    if not file.filename.lower().endswith('.pdf'):
+        return {'success': False, 'fileName': file.filename, 'error': 'Solo se permiten archivos PDF'}
+    
+    try:
+        # Turno del lote (el turno global de procesamiento lo toma la extracción)
+        async with semaphore:
+            # Leer el archivo PDF (sin await). Si ya se procesó un PDF idéntico se
+            # reutilizan su texto y sus resúmenes; si no, se extrae el texto en el
+            # pool de procesos. Las imágenes se renderizan solo cuando se necesitan.
+            file_buffer = file.read()
+            doc_hash = await asyncio.to_thread(document_hash, file_buffer)
+
+            # La extracción avanza por tandas en segundo plano y el documento se entrega en
+            # cuanto está planificado el primer bloque; el resto de páginas se añaden al
+            # documento (y al índice BM25 de las preguntas libres) a medida que llegan.
+            # Con el estado compartido se espera al documento completo: los demás workers
+            # solo pueden cargar del directorio compartido documentos ya procesados.
+            async def load_document():
+                index = PageIndex()
+                ingestion = PdfIngestion(file_buffer, on_pages=lambda start, pages: index.add_pages(pages, start))
+                # Con la cola de procesamiento llena, la extracción falla con AdmissionRejected
+                ingestion.start(admission.extraction_slot())
+                if session_state.shared:
+                    await ingestion.wait()
+                else:
+                    await ingestion.wait_for_block(0)
+                if isinstance(ingestion.error, AdmissionRejected):
+                    raise ingestion.error
+                if ingestion.error:
+                    raise Exception(f'No se pudo procesar el archivo PDF: {str(ingestion.error)}')
+                pdf_data = dict(ingestion.result(), buffer=file_buffer, index=index)
+                if ingestion.finished:
+                    pdf_data['ingested'] = ingestion.progress()
+                else:
+                    pdf_data['ingestion'] = ingestion
+                    ingestions[doc_hash] = asyncio.create_task(track_ingestion(doc_hash, pdf_data, ingestion))
+                logger.info(f"PDF disponible: {len(ingestion.pages)}/{ingestion.total_pages} páginas procesadas")
+                return pdf_data
+
+            document, cached = await document_store.acquire(doc_hash, load_document)
+            try:
+                # Con varios workers, el documento (ya completo) se guarda en el directorio compartido
+                if 'ingestion' not in document:
+                    await session_state.save_document(doc_hash, document)
+            except BaseException:
+                # Sin sesión nadie liberaría la referencia que se acaba de tomar (también si
+                # el cliente cancela la petición)
+                document_store.release(doc_hash)
+                raise
+    except AdmissionRejected as rejected:
+        return {'success': False, 'fileName': file.filename, 'message': str(rejected), 'retryAfter': rejected.retry_after}
+    except Exception as error:
+        logger.error(f"Error al procesar el archivo {file.filename}: {error}")
+        return {
+            'success': False,
+            'fileName': file.filename,
+            'message': f"Ocurrió un problema procesando tu consulta: {str(error)}"
+        }
+    # Guardar en el almacenamiento sin esperas desde que se tomó la referencia al documento:
+    # a partir de aquí la sesión la libera (drop_session o el limpiador de sesiones)
+    new_session_id = generate_session_id()
+    pdf_store[new_session_id] = {
+        'name': secure_filename(file.filename),
+        'docHash': doc_hash,
+        'document': document,
+        'totalPages': document['totalPages'],
+        'timestamp': time.time(),
+        'lastAccess': time.time()
+    }
+    # Respetar el presupuesto de memoria en cuanto llega el documento, sin esperar al limpiador
+    await document_store.enforce_budget()
+    total_blocks = count_blocks(pdf_store[new_session_id])
+    
+    # Mensaje inicial informativo - PRIMER MENSAJE
+    if 'ingestion' in document:
+        message = (f"PDF \"{file.filename}\" cargado correctamente. {document['totalPages']} páginas en unos {total_blocks} bloques "
+                   f"(el resto del documento se sigue procesando en segundo plano).\n\n")
+    else:
+        message = f"PDF \"{file.filename}\" cargado correctamente. {document['totalPages']} páginas en {total_blocks} bloques.\n\n"
+    message += f"Procesando el Bloque 1 (de {total_blocks})...\n"
+    message += "Para ver los siguientes bloques, escribe \"siguiente bloque\" después de recibir cada resumen."
+    
+    block_summary_control[new_session_id] = {
+        'lastBlock': 0,
+        'lastSent': time.time(),
+        'summaries': document['summaries']
+    }
+    session_record = {key: value for key, value in pdf_store[new_session_id].items() if key != 'document'}
+    await session_state.save_session(new_session_id, dict(
+        session_record, lastBlock=0, lastSent=block_summary_control[new_session_id]['lastSent']))
+    
+    # Iniciar el proceso de generación del primer resumen en segundo plano
+    # Esto generará el SEGUNDO MENSAJE (resumen del primer bloque).
+    # Si el documento ya estaba en caché, el resumen puede estar listo.
+    if 0 not in document['summaries']:
+        start_block_summary(new_session_id, 0)
+    else:
+        prefetch_following_blocks(new_session_id, 0)
+    
+    return {
+        'success': True,
+        'fileName': file.filename,
+        'message': message,
+        'sessionId': new_session_id,
+        'totalPages': document['totalPages'],
+        'totalBlocks': total_blocks,
+        'processingBlock': 1,
+        'ingestion': ingestion_progress(document),
+        'cached': cached
+    }
+
+# Función para responder en streaming: reenvía al cliente el texto parcial del modelo
+# como eventos "chunk" y termina con un evento "done" que lleva el mismo sobre
+# success/message que la respuesta JSON. Registra por separado el tiempo hasta
+# el primer token y la latencia total. Con `question`, la respuesta completa se
+# guarda como un turno de la conversación de la sesión.
+async def stream_model_answer(parts, session_id, timeout, envelope, answer_key, timeout_message, kind, question=None):
+    observe_payload(kind, parts)
+    
+    async def stream():
+        start_time = time.time()
+        chunks = []
+        model_started = None
+        outcome = 'error'
         try:
-            # Crear un array de partes para el modelo de visión
-            parts = [
-                {"text": prompt_resumen},
-                *block_images  # Agregar todas las imágenes del bloque
-            ]
-            
-            # Usar el modelo para procesar imágenes y texto con timeout
-            start_time = time.time()
-            resultado = await asyncio.wait_for(
-                model.generate_content_async(parts),
-                timeout=60  # Timeout de 60 segundos
-            )
-            texto_resumen = resultado.text.strip()
-            logger.info(f"Resumen generado en {time.time() - start_time:.2f} segundos")
-            
-            # Guardar el resumen en el control de bloques
-            control = block_summary_control.get(session_id, {
-                'lastBlock': block_index,
-                'lastSent': time.time(),
-                'summaries': {}
-            })
-            
-            control['summaries'][block_index] = texto_resumen
-            block_summary_control[session_id] = control
+            resilient_caller.check(kind)
+            async with model_scheduler.slot(session_id, PRIORITY_INTERACTIVE):
+                model_started = time.perf_counter()
+                deadline = time.monotonic() + timeout
+                
+                # Los reintentos solo son posibles antes de enviar el primer fragmento
+                async def attempt(attempt_timeout):
+                    return await asyncio.wait_for(model.generate_content_async(parts, stream=True), attempt_timeout)
+                
+                response = await resilient_caller.call(attempt, timeout, kind)
+                iterator = response.__aiter__()
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Fragmentos sin texto (por ejemplo, solo metadatos)
+                        continue
+                    if not text:
+                        continue
+                    if not chunks:
+                        logger.info(f"Primer token en {time.time() - start_time:.2f} segundos")
+                        model_first_token_seconds.observe(time.perf_counter() - model_started, kind=kind)
+                    chunks.append(text)
+                    yield format_sse('chunk', {'text': text})
             
-            return {
-                'success': True,
-                'blockIndex': block_index + 1,
-                'pageRange': f"{start_page + 1}-{end_page}",
-                'summary': texto_resumen,
-                'totalBlocks': total_blocks
-            }
+            outcome = 'success'
+            texto_respuesta = ''.join(chunks).strip()
+            logger.info(f"Respuesta en streaming completada en {time.time() - start_time:.2f} segundos")
+            if answer_key:
+                await response_cache.put('answers', answer_key, texto_respuesta)
+            if question:
+                await record_turn(session_id, question, texto_respuesta)
+            yield format_sse('done', {'success': True, 'message': texto_respuesta, **envelope})
         except asyncio.TimeoutError:
-            logger.error(f"Timeout al generar resumen para el bloque {block_index + 1}")
-            return {
-                'success': False,
-                'message': f"Tiempo de espera agotado al generar el resumen para el Bloque {block_index + 1}. Intenta nuevamente."
-            }
+            outcome = 'timeout'
+            logger.error("Timeout al procesar consulta en streaming")
+            yield format_sse('done', {'success': False, 'message': timeout_message})
         except Exception as error:
-            logger.error(f"Error al generar resumen para el bloque {block_index + 1}: {error}")
-            return {
-                'success': False,
-                'message': f"No se pudo generar el resumen para el Bloque {block_index + 1} (Páginas {start_page + 1}-{end_page}): {str(error)}"
-            }
+            logger.error(f"Error al procesar la consulta en streaming: {error}")
+            yield format_sse('done', {'success': False, 'message': f"Error al procesar la consulta: {describe_error(error)}"})
+        finally:
+            if model_started is not None:
+                model_call_seconds.observe(time.perf_counter() - model_started, kind=kind, outcome=outcome)
+    
+    response = await make_response(stream(), {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.timeout = None
+    return response
+
+# Función para resumir los contadores de la precarga con su tasa de aciertos
+def prefetch_summary_stats():
+    lookups = prefetch_stats['hits'] + prefetch_stats['inflightHits'] + prefetch_stats['misses']
+    hits = prefetch_stats['hits'] + prefetch_stats['inflightHits']
+    return dict(
+        prefetch_stats,
+        blocks=PREFETCH_BLOCKS,
+        inflight=len(prefetch_inflight),
+        hitRatio=round(hits / lookups, 3) if lookups else 0.0
+    )
+
+# Empezar a medir cada petición (duración total y tiempo por etapa)
+@app.before_request
+async def start_request_metrics():
+    g.request_started = time.perf_counter()
+    start_request_timings()
+
+# Registrar la duración de la petición y, si está activado, añadir la cabecera Server-Timing
+@app.after_request
+async def finish_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+    http_request_seconds.observe(elapsed, method=request.method, endpoint=endpoint, status=response.status_code)
+    if METRICS_TIMING_HEADER:
+        response.headers['Server-Timing'] = server_timing_header(elapsed)
+    return response
+
+# Endpoint de métricas en el formato de texto de Prometheus
+@app.route('/metrics')
+async def metrics():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 # Endpoint de salud
 @app.route('/api/health')
 async def health_check():
     return jsonify({'status': 'healthy', 'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
 
+# Endpoint con estadísticas de la caché de renderizado y de las imágenes enviadas
+@app.route('/api/stats')
+async def stats():
+    return jsonify({
+        'renderCache': render_cache.stats(),
+        'imageParts': dict(image_part_stats),
+        'documentCache': document_store.stats(),
+        'responseCache': response_cache.stats(),
+        'scheduler': model_scheduler.stats(),
+        'admission': admission.stats(),
+        'ingestions': {
+            doc_hash[:12]: ingestion_progress(document_store.get(doc_hash))
+            for doc_hash in ingestions if document_store.get(doc_hash)
+        },
+        'eventStreams': event_bus.stats(),
+        'prefetch': prefetch_summary_stats(),
+        'modelCalls': resilient_caller.stats(),
+        'contextCache': context_cache.stats(),
+        'textCleanup': dict(
+            cleanup_stats,
+            savedRatio=round(1 - cleanup_stats['cleanChars'] / cleanup_stats['rawChars'], 3) if cleanup_stats['rawChars'] else 0.0
+        ),
+        'conversations': {
+            'sessions': len(conversations),
+            'bytes': conversation_bytes(),
+            'compacting': sum(1 for conversation in conversations.values() if conversation.compacting)
+        },
+        'sessionState': session_state.stats()
+    })
+
+# Endpoint de eventos de la sesión (Server-Sent Events): avisa cuando un bloque
+# empieza a generarse, cuando su resumen está listo o si se produjo un error
+@app.route('/api/sessions/<session_id>/events')
+async def session_events(session_id):
+    if not await load_session(session_id):
+        return jsonify({'success': False, 'message': 'Sesión no encontrada'}), 404
+    
+    queue = event_bus.subscribe(session_id)
+    # Con el estado compartido, los resúmenes generados en otro worker no pasan por el
+    # bus de eventos de este: se consultan periódicamente
+    poll_interval = 2 if session_state.shared else 15
+    
+    async def stream():
+        sent_blocks = set()
+        
+        # Función para enviar el resumen del bloque actual si ya está listo y no se envió
+        def current_block_ready():
+            control = block_summary_control.get(session_id)
+            pdf_data = pdf_store.get(session_id)
+            if not control or not pdf_data or control['lastBlock'] not in control['summaries']:
+                return None
+            if control['lastBlock'] + 1 in sent_blocks:
+                return None
+            sent_blocks.add(control['lastBlock'] + 1)
+            return format_sse('block_ready', {
+                'block': control['lastBlock'] + 1,
+                'summary': control['summaries'][control['lastBlock']],
+                'totalBlocks': count_blocks(pdf_data)
+            })
+        
+        try:
+            # Si el resumen del bloque actual ya está listo, enviarlo de inmediato
+            ready_event = current_block_ready()
+            if ready_event:
+                yield ready_event
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=poll_interval)
+                except asyncio.TimeoutError:
+                    if session_state.shared:
+                        if not await load_session(session_id, touch=False):
+                            break
+                        ready_event = current_block_ready()
+                        if ready_event:
+                            yield ready_event
+                            continue
+                    # Comentario periódico para mantener viva la conexión
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:  # La sesión se eliminó
+                    break
+                event, data = item
+                if event == 'block_ready':
+                    sent_blocks.add(data['block'])
+                yield format_sse(event, data)
+        finally:
+            event_bus.unsubscribe(session_id, queue)
+    
+    response = await make_response(stream(), {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.timeout = None  # El flujo dura lo que la sesión
+    return response
+
 # Endpoint principal para consultas
 @app.route('/api/query', methods=['POST'])
 async def query():
     try:
+        # Sin capacidad para procesar más PDFs, las subidas se rechazan antes de recibir el cuerpo
+        if (request.content_length or 0) >= UPLOAD_BODY_MIN_BYTES:
+            admission.check_upload_capacity()
+        
         # Extraer datos de la solicitud
         form_data = await request.form
         query = form_data.get('query')
         session_id = form_data.get('sessionId')
+        # Permite forzar el envío de imágenes aunque las páginas sean solo texto
+        force_images = form_data.get('forceImages', '').lower() == 'true'
+        # Las consultas al modelo pueden responderse en streaming (Server-Sent Events)
+        stream_requested = form_data.get('stream', '').lower() == 'true'
         files = await request.files
         
         if not query and not files and not session_id:
@@ -216,52 +1181,60 @@ async def query():
                 'success': False,
                 'error': 'Se requiere una consulta, archivos o un ID de sesión'
             }), 400
+        
+        # Límite por cliente y capacidad del servidor (429/503 con Retry-After)
+        if files:
+            admission.check_upload(client_id(request), len(files.getlist('files')[:MAX_UPLOAD_FILES]))
+        else:
+            admission.check_query(client_id(request))
+        
+        # Cargar la sesión (puede venir de otro worker) con su bloque actual y sus resúmenes
+        if session_id and not files:
+            await load_session(session_id)
 
-        # Procesar archivos PDF si se han subido
+        # Procesar archivos PDF si se han subido. Todos los archivos del lote se procesan
+        # a la vez (con un límite de concurrencia) y cada uno obtiene su propia sesión.
         if files:
-            file = files.getlist('files')[0]  # Tomamos solo el primer archivo
-            new_session_id = generate_session_id()
+            uploads = files.getlist('files')[:MAX_UPLOAD_FILES]
+            semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+            results = await asyncio.gather(*[ingest_upload(file, semaphore) for file in uploads])
             
-            logger.info(f"Procesando archivo: {file.filename}")
-            # Verificar que es un PDF
-            if not file.filename.lower().endswith('.pdf'):
-                return jsonify({
-                    'success': False,
-                    'error': 'Solo se permiten archivos PDF'
-                }), 400
-                
-            # Leer el archivo PDF (sin await)
-            file_buffer = file.read()
-            pdf_data = extract_pdf_contents(file_buffer)
-            logger.info(f"PDF procesado: {pdf_data['totalPages']} páginas")
+            if len(results) == 1:
+                result = results[0]
+                if not result['success']:
+                    if 'retryAfter' in result:
+                        return jsonify({'success': False, 'message': result['message']}), 503, {'Retry-After': str(result['retryAfter'])}
+                    if 'error' in result:
+                        return jsonify({'success': False, 'error': result['error']}), 400
+                    return jsonify({'success': False, 'message': result['message']}), 500
+                return jsonify({key: value for key, value in result.items() if key != 'fileName'})
             
-            # Guardar en el almacenamiento
-            pdf_store[new_session_id] = {
-                'name': secure_filename(file.filename),
-                'totalPages': pdf_data['totalPages'],
-                'pages': pdf_data['pages'],
-                'timestamp': time.time()
+            # Lote: estado de cada archivo y, como sesión activa, la del primero que se cargó
+            loaded = [result for result in results if result['success']]
+            message = f"{len(loaded)} de {len(results)} PDFs cargados correctamente:\n"
+            for result in results:
+                if result['success']:
+                    message += f"- {result['fileName']}: {result['totalPages']} páginas en {result['totalBlocks']} bloques\n"
+                else:
+                    message += f"- {result['fileName']}: {result.get('error') or result['message']}\n"
+            response = {
+                'success': bool(loaded),
+                'message': message.strip(),
+                'documents': results
             }
-            
-            total_blocks = (pdf_data['totalPages'] + 2) // 3
-            
-            # Mensaje inicial informativo - PRIMER MENSAJE
-            message = f"PDF \"{file.filename}\" cargado correctamente. {pdf_data['totalPages']} páginas en {total_blocks} bloques.\n\n"
-            message += f"Procesando el Bloque 1 (de {total_blocks})...\n"
-            message += "Para ver los siguientes bloques, escribe \"siguiente bloque\" después de recibir cada resumen."
-            
-            # Iniciar el proceso de generación del primer resumen en segundo plano
-            # Esto generará el SEGUNDO MENSAJE (resumen del primer bloque)
-            asyncio.create_task(generate_block_summary(new_session_id, 0))
-            
-            return jsonify({
-                'success': True,
-                'message': message,
-                'sessionId': new_session_id,
-                'totalPages': pdf_data['totalPages'],
-                'totalBlocks': total_blocks,
-                'processingBlock': 1
-            })
+            if not loaded and any('retryAfter' in result for result in results):
+                retry_after = max(result.get('retryAfter', 0) for result in results)
+                return jsonify(response), 503, {'Retry-After': str(retry_after)}
+            if loaded:
+                first = loaded[0]
+                response.update({
+                    'sessionId': first['sessionId'],
+                    'totalPages': first['totalPages'],
+                    'totalBlocks': first['totalBlocks'],
+                    'processingBlock': 1,
+                    'cached': first['cached']
+                })
+            return jsonify(response), 200 if loaded else 400
 
         # Verificar si es una solicitud para obtener el resumen del bloque actual
         if query and query.lower() == "obtener resumen" and session_id:
@@ -278,8 +1251,8 @@ async def query():
             # Verificar si tenemos el resumen de este bloque
             if 'summaries' in control and last_block in control['summaries']:
                 # Obtener el total de bloques para actualizar la barra de progreso
-                pdf_data = pdf_store.get(session_id)
-                total_blocks = (pdf_data['totalPages'] + 2) // 3 if pdf_data else 0
+                pdf_data = get_session(session_id)
+                total_blocks = count_blocks(pdf_data) if pdf_data else 0
                 
                 return jsonify({
                     'success': True,
@@ -289,8 +1262,15 @@ async def query():
                     'isBlockSummary': True
                 })
             else:
-                # Si no tenemos el resumen, intentar generarlo
-                summary = await generate_block_summary(session_id, last_block)
+                # Si no tenemos el resumen, esperar a la generación en curso (o iniciarla)
+                summary = await request_block_summary(session_id, last_block, PRIORITY_INTERACTIVE, SUMMARY_WAIT_TIMEOUT)
+                if summary.get('pending'):
+                    return jsonify({
+                        'success': True,
+                        'message': summary['message'],
+                        'block': last_block + 1,
+                        'pending': True
+                    })
                 if summary['success']:
                     return jsonify({
                         'success': True,
@@ -305,6 +1285,34 @@ async def query():
                         'message': 'No se pudo obtener el resumen del bloque actual: ' + summary['message']
                     })
 
+        # Verificar si es una solicitud del resumen del documento completo
+        if query and query.lower() == "resumen completo" and session_id:
+            if not get_session(session_id):
+                return jsonify({
+                    'success': False,
+                    'message': 'No hay ningún PDF cargado para esta sesión. Por favor, sube un PDF primero.'
+                })
+            
+            summary = await request_document_summary(session_id, SUMMARY_WAIT_TIMEOUT)
+            if summary.get('pending'):
+                return jsonify({
+                    'success': True,
+                    'message': summary['message'],
+                    'pending': True,
+                    'documentSummaryPending': True
+                })
+            if summary['success']:
+                return jsonify({
+                    'success': True,
+                    'message': summary['summary'],
+                    'totalBlocks': summary['totalBlocks'],
+                    'isDocumentSummary': True
+                })
+            return jsonify({
+                'success': False,
+                'message': summary['message']
+            })
+
         # Verificar si es una solicitud para el siguiente bloque
         if query and query.lower() == "siguiente bloque" and session_id:
             control = block_summary_control.get(session_id)
@@ -314,39 +1322,66 @@ async def query():
                     'message': 'No hay información de bloques para esta sesión. Por favor, sube un PDF primero.'
                 })
             
-            pdf_data = pdf_store.get(session_id)
+            pdf_data = get_session(session_id)
             if not pdf_data:
                 return jsonify({
                     'success': False,
                     'message': 'No se encontró el PDF para esta sesión.'
                 })
             
-            total_blocks = (pdf_data['totalPages'] + 2) // 3
             next_block = control['lastBlock'] + 1
+            # Si el documento se sigue procesando, el siguiente bloque puede no estar planificado aún
+            message = await wait_for_ingestion(pdf_data['document'], block=next_block)
+            if message:
+                return jsonify({'success': False, 'message': message, 'pending': True})
+            total_blocks = count_blocks(pdf_data)
             
             # Verificar si ya se procesaron todos los bloques
-            if next_block >= total_blocks:
+            if next_block >= len(get_blocks(pdf_data)):
                 return jsonify({
                     'success': True,
                     'message': 'Has llegado al final del documento. Ya se han procesado todos los bloques disponibles.',
                     'complete': True
                 })
             
-            # Verificar límite de tiempo (15 segundos entre bloques - reducido de 30)
+            document = pdf_data['document']
             now = time.time()
+            ready = next_block in document['summaries']
+            
+            # Si el resumen ya está listo (por ejemplo, precargado), devolverlo sin esperar
+            if ready:
+                record_prefetch_lookup(session_id, document['hash'], next_block, ready)
+                control['lastBlock'] = next_block
+                control['lastSent'] = now
+                await session_state.update_control(session_id, next_block, now)
+                prefetch_following_blocks(session_id, next_block)
+                return jsonify({
+                    'success': True,
+                    'message': document['summaries'][next_block],
+                    'block': next_block + 1,
+                    'totalBlocks': total_blocks,
+                    'isBlockSummary': True
+                })
+            
+            # Verificar límite de tiempo (BLOCK_REQUEST_INTERVAL segundos entre bloques).
+            # No aplica si el resumen ya se está generando (por ejemplo, una precarga).
             time_since_last_sent = now - control['lastSent']
+            generating = (document['hash'], next_block) in summary_inflight
             
-            if time_since_last_sent < 15:  # 15 segundos entre bloques
-                wait_time = int(15 - time_since_last_sent)
+            if time_since_last_sent < BLOCK_REQUEST_INTERVAL and not generating:
+                wait_time = int(BLOCK_REQUEST_INTERVAL - time_since_last_sent)
                 return jsonify({
                     'success': False,
                     'message': f"Por favor espera {wait_time} segundos antes de solicitar el siguiente bloque."
                 })
             
+            record_prefetch_lookup(session_id, document['hash'], next_block, ready)
+            
             # Actualizar el control para el siguiente bloque
             control['lastBlock'] = next_block
             control['lastSent'] = now
             block_summary_control[session_id] = control
+            await session_state.update_control(session_id, next_block, now)
             
             # Mensaje informativo mientras se procesa
             message = f"Procesando el Bloque {next_block + 1} (de {total_blocks})...\n"
@@ -356,7 +1391,7 @@ async def query():
                 message += "Este es el último bloque del documento."
             
             # Iniciar el proceso de generación del resumen en segundo plano
-            asyncio.create_task(generate_block_summary(session_id, next_block))
+            start_block_summary(session_id, next_block)
             
             return jsonify({
                 'success': True,
@@ -374,48 +1409,54 @@ async def query():
             block_number = int(block_match.group(1))
             block_query = block_match.group(2).strip()
             
-            pdf_data = pdf_store.get(session_id)
+            pdf_data = get_session(session_id)
             if not pdf_data:
                 return jsonify({
                     'success': False,
                     'message': 'No hay ningún PDF cargado para esta sesión. Por favor, sube un PDF primero.'
                 })
             
-            total_blocks = (pdf_data['totalPages'] + 2) // 3
+            # Si el documento se sigue procesando, esperar a que se planifique el bloque
+            message = await wait_for_ingestion(pdf_data['document'], block=max(block_number - 1, 0))
+            if message:
+                return jsonify({'success': False, 'message': message, 'pending': True})
+            total_blocks = count_blocks(pdf_data)
             
-            if block_number < 1 or block_number > total_blocks:
+            if block_number < 1 or block_number > len(get_blocks(pdf_data)):
                 return jsonify({
                     'success': False,
                     'message': f"El número de bloque debe estar entre 1 y {total_blocks}."
                 })
             
             # Obtener las páginas correspondientes al bloque
-            start_page = (block_number - 1) * 3
-            end_page = min(start_page + 3, pdf_data['totalPages'])
-            
-            # Obtener el contenido y las imágenes de las páginas en este bloque
-            block_pages = []
-            block_images = []
+            start_page, end_page = get_blocks(pdf_data)[block_number - 1]
             
-            for i in range(start_page, end_page):
-                block_pages.append({
-                    'pageNumber': i + 1,
-                    'content': pdf_data['pages'][i]['text']
-                })
-                
-                # Añadir imagen de la página
-                block_images.append({
-                    'inline_data': {
-                        'data': pdf_data['pages'][i]['fullPageImage'],
-                        'mime_type': "image/png"
-                    }
+            # Responder desde la caché persistente si la pregunta ya se hizo
+            document = pdf_data['document']
+            answer_key = cache_key('answer', document['hash'], f"bloque:{start_page + 1}-{end_page}",
+                                   normalize_question(block_query), force_images, QUERY_PROMPT_VERSION, MODEL_NAME,
+                                   *conversation_cache_context(session_id))
+            cached_answer = await response_cache.get('answers', answer_key)
+            if cached_answer is not None:
+                await record_turn(session_id, query, cached_answer)
+                return jsonify({
+                    'success': True,
+                    'message': cached_answer,
+                    'block': block_number,
+                    'pageRange': f"{start_page + 1}-{end_page}",
+                    'documentName': pdf_data['name'],
+                    'totalBlocks': total_blocks,
+                    'cached': True
                 })
             
-            # Construir el prompt para Gemini
-            pages_info = "\n".join([
-                f"--- PÁGINA {page['pageNumber']} ---\n{page['content']}\n"
-                for page in block_pages
-            ])
+            # Añadir imágenes de las páginas con contenido visual
+            block_images = await get_page_parts(document['hash'], document['buffer'], document['pages'], range(start_page, end_page), force_images,
+                                                context_cache=context_cache)
+            images_note = ("Además, te comparto las imágenes de las páginas con contenido visual que también debes analizar."
+                           if block_images else "Estas páginas solo contienen texto.")
+            
+            # Construir el prompt para Gemini (texto limpio de las páginas, dentro del presupuesto)
+            pages_info = pages_prompt_text(document, range(start_page, end_page), 'block')
             
             prompt_consulta = f"""
                 Eres Briefly, un asistente virtual amigable y útil.
@@ -426,7 +1467,7 @@ async def query():
                 
                 {pages_info}
                 
-                Además, te comparto las imágenes de las páginas que también debes analizar.
+                {images_note}
                 
                 Responde de manera concisa y directa a la consulta del usuario basándote en la información proporcionada (texto e imágenes).
                 Si la información no está en el contenido (texto o imágenes) de las páginas, indícalo claramente.
@@ -434,19 +1475,28 @@ async def query():
                 Describe cualquier contenido visual relevante para la consulta.
             """
             
-            # Crear array de partes para el modelo de visión
-            parts = [
+            # Crear array de partes para el modelo de visión, tras el historial de la conversación
+            parts = with_conversation(session_id, [
                 {"text": prompt_consulta},
                 *block_images
-            ]
+            ])
+            
+            # Variante en streaming: el texto se envía al cliente a medida que se genera
+            if stream_requested:
+                return await stream_model_answer(parts, session_id, 60, {
+                    'block': block_number,
+                    'pageRange': f"{start_page + 1}-{end_page}",
+                    'documentName': pdf_data['name'],
+                    'totalBlocks': total_blocks
+                }, answer_key, "La consulta está tomando demasiado tiempo. Por favor, intenta con una pregunta más específica o consulta otro bloque.", 'block',
+                    question=query)
             
             try:
-                # Usar timeout para evitar esperas infinitas
-                resultado = await asyncio.wait_for(
-                    model.generate_content_async(parts),
-                    timeout=60  # 60 segundos máximo
-                )
+                # Usar timeout para evitar esperas infinitas (60 segundos máximo)
+                resultado = await call_model(parts, session_id, PRIORITY_INTERACTIVE, 60, 'block')
                 texto_respuesta = resultado.text.strip()
+                await response_cache.put('answers', answer_key, texto_respuesta)
+                await record_turn(session_id, query, texto_respuesta)
                 
                 return jsonify({
                     'success': True,
@@ -466,7 +1516,7 @@ async def query():
                 logger.error(f"Error al procesar la consulta con imágenes: {error}")
                 return jsonify({
                     'success': False,
-                    'message': f"Error al procesar la consulta: {str(error)}"
+                    'message': f"Error al procesar la consulta: {describe_error(error)}"
                 })
 
         # Verificar si es una consulta sobre una página específica
@@ -477,7 +1527,7 @@ async def query():
             page_number = int(page_match.group(1))
             page_query = page_match.group(2).strip()
             
-            pdf_data = pdf_store.get(session_id)
+            pdf_data = get_session(session_id)
             if not pdf_data:
                 return jsonify({
                     'success': False,
@@ -490,14 +1540,36 @@ async def query():
                     'message': f"El número de página debe estar entre 1 y {pdf_data['totalPages']}."
                 })
             
+            # Si el documento se sigue procesando, esperar solo hasta que esté extraída esta página
+            document = pdf_data['document']
+            message = await wait_for_ingestion(document, pages=page_number)
+            if message:
+                return jsonify({'success': False, 'message': message, 'pending': True})
+            
+            # Responder desde la caché persistente si la pregunta ya se hizo
+            answer_key = cache_key('answer', document['hash'], f"pagina:{page_number}",
+                                   normalize_question(page_query), force_images, QUERY_PROMPT_VERSION, MODEL_NAME,
+                                   *conversation_cache_context(session_id))
+            cached_answer = await response_cache.get('answers', answer_key)
+            if cached_answer is not None:
+                await record_turn(session_id, query, cached_answer)
+                return jsonify({
+                    'success': True,
+                    'message': cached_answer,
+                    'page': page_number,
+                    'documentName': pdf_data['name'],
+                    'cached': True
+                })
+            
             # Obtener el contenido y la imagen de la página
-            page_content = pdf_data['pages'][page_number - 1]['text']
-            page_image = {
-                'inline_data': {
-                    'data': pdf_data['pages'][page_number - 1]['fullPageImage'],
-                    'mime_type': "image/png"
-                }
-            }
+            page_content = document['pages'][page_number - 1].text
+            if len(page_content) > PROMPT_MAX_CHARS:
+                report_truncation('page', [page_number], len(page_content) - PROMPT_MAX_CHARS)
+                page_content = truncate_text(page_content, PROMPT_MAX_CHARS)
+            page_images = await get_page_parts(document['hash'], document['buffer'], document['pages'], [page_number - 1], force_images,
+                                               context_cache=context_cache)
+            images_note = ("Además, te comparto una imagen de la página completa que también debes analizar."
+                           if page_images else "Esta página solo contiene texto.")
             
             # Construir el prompt para Gemini
             prompt_contexto = f"""
@@ -511,26 +1583,33 @@ async def query():
                 {page_content}
                 ---FIN DEL CONTENIDO TEXTUAL---
                 
-                Además, te comparto una imagen de la página completa que también debes analizar.
+                {images_note}
                 
                 Responde de manera concisa y directa a la consulta del usuario basándote en la información proporcionada (texto e imagen).
                 Si la información no está en el contenido de la página, indícalo claramente.
                 Describe cualquier contenido visual relevante para la consulta.
             """
             
-            # Crear array de partes para el modelo de visión
-            parts = [
+            # Crear array de partes para el modelo de visión, tras el historial de la conversación
+            parts = with_conversation(session_id, [
                 {"text": prompt_contexto},
-                page_image
-            ]
+                *page_images
+            ])
+            
+            # Variante en streaming: el texto se envía al cliente a medida que se genera
+            if stream_requested:
+                return await stream_model_answer(parts, session_id, 60, {
+                    'page': page_number,
+                    'documentName': pdf_data['name']
+                }, answer_key, "La consulta está tomando demasiado tiempo. Por favor, intenta con una pregunta más específica.", 'page',
+                    question=query)
             
             try:
-                # Usar timeout para evitar esperas infinitas
-                resultado = await asyncio.wait_for(
-                    model.generate_content_async(parts),
-                    timeout=60  # 60 segundos máximo
-                )
+                # Usar timeout para evitar esperas infinitas (60 segundos máximo)
+                resultado = await call_model(parts, session_id, PRIORITY_INTERACTIVE, 60, 'page')
                 texto_respuesta = resultado.text.strip()
+                await response_cache.put('answers', answer_key, texto_respuesta)
+                await record_turn(session_id, query, texto_respuesta)
                 
                 return jsonify({
                     'success': True,
@@ -548,7 +1627,93 @@ async def query():
                 logger.error(f"Error al procesar la consulta con imagen: {error}")
                 return jsonify({
                     'success': False,
-                    'message': f"Error al procesar la consulta: {str(error)}"
+                    'message': f"Error al procesar la consulta: {describe_error(error)}"
+                })
+        
+        # Pregunta libre sobre el PDF de la sesión: enviar solo las páginas más relevantes según el índice
+        pdf_data = get_session(session_id) if query and session_id else None
+        matches = pdf_data['document']['index'].search(query) if pdf_data else []
+        if matches:
+            document = pdf_data['document']
+            page_indices = sorted(i for i, _ in matches)
+            page_numbers = [i + 1 for i in page_indices]
+            logger.info(f"Páginas relevantes para la consulta: {page_numbers}")
+            
+            # Responder desde la caché persistente si la pregunta ya se hizo
+            answer_key = cache_key('answer', document['hash'], f"indice:{','.join(map(str, page_numbers))}",
+                                   normalize_question(query), force_images, QUERY_PROMPT_VERSION, MODEL_NAME,
+                                   *conversation_cache_context(session_id))
+            cached_answer = await response_cache.get('answers', answer_key)
+            if cached_answer is not None:
+                await record_turn(session_id, query, cached_answer)
+                return jsonify({
+                    'success': True,
+                    'message': cached_answer,
+                    'pages': page_numbers,
+                    'documentName': pdf_data['name'],
+                    'cached': True
+                })
+            
+            # Texto e imágenes de las páginas seleccionadas
+            pages_info = pages_prompt_text(document, page_indices, 'search')
+            page_images = await get_page_parts(document['hash'], document['buffer'], document['pages'], page_indices, force_images,
+                                               context_cache=context_cache)
+            images_note = ("Además, te comparto las imágenes de las páginas con contenido visual que también debes analizar."
+                           if page_images else "Estas páginas solo contienen texto.")
+            
+            prompt_consulta = f"""
+                Eres Briefly, un asistente virtual amigable y útil.
+                La consulta del usuario es: "{query}"
+                Esta consulta se refiere al documento "{pdf_data['name']}" ({pdf_data['totalPages']} páginas).
+                Estas son las páginas más relacionadas con la consulta:
+                
+                {pages_info}
+                
+                {images_note}
+                
+                Responde de manera concisa y directa a la consulta del usuario basándote en la información proporcionada (texto e imágenes).
+                Incluye en tu respuesta a qué páginas específicas te refieres cuando cites información.
+                Si la información no está en estas páginas, indícalo claramente y sugiere preguntar por un bloque o página concretos
+                con "bloque X: tu pregunta" o "pagina X: tu pregunta".
+            """
+            
+            parts = with_conversation(session_id, [
+                {"text": prompt_consulta},
+                *page_images
+            ])
+            
+            # Variante en streaming: el texto se envía al cliente a medida que se genera
+            if stream_requested:
+                return await stream_model_answer(parts, session_id, 60, {
+                    'pages': page_numbers,
+                    'documentName': pdf_data['name']
+                }, answer_key, "La consulta está tomando demasiado tiempo. Por favor, intenta con una pregunta más específica.", 'search',
+                    question=query)
+            
+            try:
+                # Usar timeout para evitar esperas infinitas (60 segundos máximo)
+                resultado = await call_model(parts, session_id, PRIORITY_INTERACTIVE, 60, 'search')
+                texto_respuesta = resultado.text.strip()
+                await response_cache.put('answers', answer_key, texto_respuesta)
+                await record_turn(session_id, query, texto_respuesta)
+                
+                return jsonify({
+                    'success': True,
+                    'message': texto_respuesta,
+                    'pages': page_numbers,
+                    'documentName': pdf_data['name']
+                })
+            except asyncio.TimeoutError:
+                logger.error("Timeout al procesar consulta sobre el documento")
+                return jsonify({
+                    'success': False,
+                    'message': "La consulta está tomando demasiado tiempo. Por favor, intenta con una pregunta más específica."
+                })
+            except Exception as error:
+                logger.error(f"Error al procesar la consulta sobre el documento: {error}")
+                return jsonify({
+                    'success': False,
+                    'message': f"Error al procesar la consulta: {describe_error(error)}"
                 })
         
         # Si es una consulta general (no sobre un bloque o página específica)
@@ -562,19 +1727,26 @@ async def query():
             Si la consulta es sobre un documento PDF, recuérdale al usuario que:
             - Puede escribir "obtener resumen" para ver el resumen del bloque actual
             - Puede solicitar el siguiente bloque escribiendo "siguiente bloque"
+            - Puede obtener un resumen de todo el documento escribiendo "resumen completo"
             - Puede preguntar sobre un bloque específico usando "bloque X: tu pregunta"
             - Puede preguntar sobre una página específica usando "pagina X: tu pregunta"
             
             El sistema ahora también puede analizar imágenes y contenido visual en los PDFs.
         """
+        # Las preguntas de seguimiento sin páginas relacionadas se responden con el historial de la conversación
+        contents = with_conversation(session_id, prompt_contexto)
+        
+        # Variante en streaming: el texto se envía al cliente a medida que se genera
+        if stream_requested:
+            return await stream_model_answer(contents, session_id, 30, {}, None,
+                                             "La consulta está tomando demasiado tiempo. Por favor, intenta con una pregunta más específica.",
+                                             'general', question=query)
         
         try:
-            # Usar timeout para evitar esperas infinitas
-            resultado = await asyncio.wait_for(
-                model.generate_content_async(prompt_contexto),
-                timeout=30  # 30 segundos máximo para consultas generales
-            )
+            # Usar timeout para evitar esperas infinitas (30 segundos máximo para consultas generales)
+            resultado = await call_model(contents, session_id, PRIORITY_INTERACTIVE, 30, 'general')
             texto_respuesta = resultado.text.strip()
+            await record_turn(session_id, query, texto_respuesta)
             
             return jsonify({
                 'success': True,
@@ -587,20 +1759,20 @@ async def query():
                 'message': "La consulta está tomando demasiado tiempo. Por favor, intenta con una pregunta más específica."
             })
 
+    except AdmissionRejected as rejected:
+        logger.warning(f"Petición rechazada ({rejected.reason}): {rejected}")
+        return jsonify({'success': False, 'message': str(rejected)}), rejected.status, {'Retry-After': str(rejected.retry_after)}
     except Exception as error:
         logger.error(f'Error general: {error}')
         return jsonify({
             'success': False,
-            'message': f"Ocurrió un problema procesando tu consulta: {str(error)}"
+            'message': f"Ocurrió un problema procesando tu consulta: {describe_error(error)}"
         }), 500
 
 # Endpoint para limpiar manualmente una sesión
 @app.route('/api/sessions/<session_id>', methods=['DELETE'])
 async def delete_session(session_id):
-    if session_id in pdf_store:
-        del pdf_store[session_id]
-        if session_id in block_summary_control:
-            del block_summary_control[session_id]
+    if await remove_session(session_id):
         logger.info(f"Sesión {session_id} eliminada manualmente")
         return jsonify({'success': True, 'message': f"Sesión {session_id} eliminada correctamente"})
     else:
@@ -609,18 +1781,43 @@ async def delete_session(session_id):
 # Endpoint para obtener información de una sesión
 @app.route('/api/sessions/<session_id>')
 async def get_session_info(session_id):
-    if session_id in pdf_store:
-        pdf_data = pdf_store[session_id]
+    pdf_data = await load_session(session_id)
+    if pdf_data:
         control = block_summary_control.get(session_id, {})
+        document = pdf_data['document']
+        conversation = conversations.get(session_id)
         
         return jsonify({
             'success': True,
             'sessionInfo': {
                 'documentName': pdf_data['name'],
                 'totalPages': pdf_data['totalPages'],
-                'totalBlocks': (pdf_data['totalPages'] + 2) // 3,
+                'totalBlocks': count_blocks(pdf_data),
+                # Tabla de bloques planificada al procesar el documento (mientras se sigue
+                # procesando, solo los bloques ya planificados)
+                'blocks': [
+                    {'block': i + 1, 'pageRange': f"{start + 1}-{end}"}
+                    for i, (start, end) in enumerate(get_blocks(pdf_data))
+                ],
                 'currentBlock': (control.get('lastBlock', 0) + 1),
-                'createdAt': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(pdf_data['timestamp']))
+                'createdAt': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(pdf_data['timestamp'])),
+                'lastAccess': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(pdf_data['lastAccess'])),
+                # Memoria del documento (compartida con otras sesiones que subieron el mismo PDF)
+                # Texto de las páginas antes y después de quitar encabezados, pies y espacios
+                'textCleanup': document.get('cleanup'),
+                # Avance del procesamiento del PDF (páginas y bloques listos)
+                'ingestion': ingestion_progress(document),
+                'memory': {
+                    # Documento residente más el historial de esta sesión
+                    'residentBytes': (document['indexBytes'] + (0 if document['spilled'] else document['memoryBytes'])
+                                      + (conversation.memory_bytes() if conversation else 0)),
+                    'spilled': document['spilled'],
+                    'sharedSessions': document['refs'],
+                    'indexBytes': document['indexBytes'],
+                    # Historial de la conversación de esta sesión (no se comparte)
+                    'historyBytes': conversation.memory_bytes() if conversation else 0
+                },
+                'conversation': conversation.stats() if conversation else None
             }
         })
     else:
@@ -641,11 +1838,11 @@ async def download_conversation():
         content += f"Fecha: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}\n\n"
         
         session_id = data.get('sessionId')
-        if session_id and session_id in pdf_store:
-            pdf_data = pdf_store[session_id]
+        pdf_data = await load_session(session_id) if session_id else None
+        if pdf_data:
             content += f"Documento: {pdf_data['name']}\n"
             content += f"Páginas: {pdf_data['totalPages']}\n"
-            content += f"Bloques: {(pdf_data['totalPages'] + 2) // 3}\n\n"
+            content += f"Bloques: {count_blocks(pdf_data)}\n\n"
         
         content += "## Historial de conversación\n\n"
         
@@ -711,17 +1908,29 @@ async def serve_static(path):
         return await send_from_directory('static', 'index.html')
     return await send_from_directory('static', path)
 
-# Función para limpiar PDFs antiguos
+# Función para limpiar sesiones inactivas (según su último acceso) y volcar a
+# disco los documentos fríos si se supera el presupuesto de memoria
 async def clean_old_sessions():
     while True:
-        await asyncio.sleep(3600)  # Esperar una hora
-        one_hour_ago = time.time() - 3600
-        for session_id in list(pdf_store.keys()):
-            if pdf_store[session_id]['timestamp'] < one_hour_ago:
-                del pdf_store[session_id]
-                if session_id in block_summary_control:
-                    del block_summary_control[session_id]
+        await asyncio.sleep(SESSION_CLEANUP_INTERVAL)
+        idle_limit = time.time() - SESSION_IDLE_TIMEOUT
+        prefetch_limit = time.time() - PREFETCH_IDLE_TIMEOUT
+        # Sesiones de este worker y sesiones inactivas de cualquier worker; el último
+        # acceso es el más reciente registrado en el estado de las sesiones o en este worker
+        expired = await session_state.expired_sessions(idle_limit)
+        for session_id in set(pdf_store) | set(expired):
+            record = await session_state.load_session(session_id)
+            pdf_data = pdf_store.get(session_id)
+            last_access = max(record['lastAccess'] if record else 0, pdf_data['lastAccess'] if pdf_data else 0)
+            if record is None:
+                drop_session(session_id)  # Se eliminó desde otro worker
+            elif last_access < idle_limit:
+                await remove_session(session_id)
                 logger.info(f"Sesión {session_id} eliminada por inactividad")
+            elif last_access < prefetch_limit:
+                cancel_prefetch(session_id)
+        await context_cache.expire()
+        await document_store.enforce_budget()
 
 # Iniciar proceso de limpieza en segundo plano
 @app.before_serving
@@ -732,6 +1941,13 @@ async def startup():
     asyncio.create_task(clean_old_sessions())
     logger.info("Servidor iniciado y tareas de mantenimiento configuradas")
 
+# Liberar el pool de procesos al detener el servidor
+@app.after_serving
+async def shutdown():
+    shutdown_executor()
+    response_cache.close()
+    session_state.close()
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 3000))
     print(f"Servidor iniciado en http://0.0.0.0:{port}")
@@ -739,6 +1955,17 @@ if __name__ == '__main__':
     import hypercorn.asyncio
     config = hypercorn.Config()
     config.bind = [f"0.0.0.0:{port}"]
-    config.debug = True
-    asyncio.run(hypercorn.asyncio.serve(app, config))
+    if WEB_WORKERS > 1:
+        # Varios procesos en el mismo puerto: cada uno importa la aplicación y comparte
+        # las sesiones a través del estado compartido
+        if not session_state.shared:
+            raise ValueError("WEB_WORKERS > 1 requiere SESSION_BACKEND=sqlite")
+        import hypercorn.run
+        config.application_path = 'app:app'
+        config.workers = WEB_WORKERS
+        print(f"{WEB_WORKERS} workers con estado de sesiones compartido")
+        hypercorn.run.run(config)
+    else:
+        config.debug = True
+        asyncio.run(hypercorn.asyncio.serve(app, config))
 
@@ -0,0 +1,82 @@
+# Benchmark de la caché de contexto con el modelo simulado: bytes enviados al modelo
+# por pregunta sobre el mismo bloque con las imágenes incrustadas en cada petición
+# frente a registradas una vez y citadas por su identificador.
+#
+# Uso:
+#   python benchmarks/bench_context_cache.py
+#   python benchmarks/bench_context_cache.py --pages 40 --questions 20 --block 2
+import io
+import os
+import sys
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sample_pdfs import build_image_pdf  # noqa: E402
+from load_test import unique_pdf  # noqa: E402
+
+
+# Función para sumar los bytes enviados al modelo por las preguntas sobre bloques
+def block_payload_bytes(metrics):
+    return sum(value for key, value in metrics.model_payload_bytes_total._values.items() if ('kind', 'block') in key)
+
+
+# Función para subir un PDF y hacer varias preguntas sobre el mismo bloque
+async def run_questions(app_module, test_client, buffer, args):
+    from quart.datastructures import FileStorage
+    response = await test_client.post('/api/query', files={'files': FileStorage(io.BytesIO(buffer), filename='figuras.pdf')})
+    session_id = (await response.get_json())['sessionId']
+    for i in range(args.questions):
+        await test_client.post('/api/query', form={
+            'query': f"bloque {args.block}: ¿qué muestra la figura {i + 1}?",
+            'sessionId': session_id
+        })
+    await test_client.delete(f'/api/sessions/{session_id}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la caché de contexto de los documentos")
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--block', type=int, default=2, help="Bloque (desde 1) sobre el que se pregunta")
+    args = parser.parse_args()
+
+    os.environ.update({
+        'MODEL_BACKEND': 'stub',
+        'STUB_LATENCY': '0.01',
+        'STUB_JITTER': '0',
+        'RESPONSE_CACHE_PATH': '',
+        'RATE_LIMIT_QUERIES_PER_MINUTE': '0'
+    })
+    import metrics
+    import pdf_processing
+    import app as app_module
+    logging.getLogger('Briefly-pdf').setLevel(logging.WARNING)
+    base = build_image_pdf(args.pages)
+
+    async def run():
+        test_client = app_module.app.test_client()
+        async with app_module.app.test_app():
+            print(f"{args.questions} preguntas sobre el bloque {args.block} de un PDF de {args.pages} páginas con imágenes\n")
+            print(f"{'modo':<26} {'KB por pregunta':>16} {'KB subidos una vez':>19} {'KB totales':>11}")
+            for client, enabled in enumerate((False, True)):
+                app_module.context_cache.enabled = enabled
+                before = block_payload_bytes(metrics)
+                uploaded_before = app_module.context_cache.stats()['bytesUploaded']
+                await run_questions(app_module, test_client, unique_pdf(base, client), args)
+                sent = block_payload_bytes(metrics) - before
+                uploaded = app_module.context_cache.stats()['bytesUploaded'] - uploaded_before
+                mode = 'identificadores' if enabled else 'imágenes incrustadas'
+                print(f"{mode:<26} {sent / args.questions / 1024:>16.1f} {uploaded / 1024:>19.1f} "
+                      f"{(sent + uploaded) / 1024:>11.1f}")
+
+    try:
+        asyncio.run(run())
+    finally:
+        pdf_processing.shutdown_executor()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Benchmark de extracción de PDF: páginas/segundo según el número de procesos y
+# segundos hasta que el documento se puede usar (primer bloque extraído).
+#
+# Uso:
+#   python benchmarks/bench_extraction.py --pages 120 --workers 1 2 4 8
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_processing  # noqa: E402
+from sample_pdfs import build_sample_pdf  # noqa: E402
+
+
+async def run(buffer, workers, repeat):
+    # Calentar el pool para no medir el arranque de los procesos
+    await pdf_processing.extract_pdf_contents(buffer, workers=workers)
+    best = first_block = None
+    for _ in range(repeat):
+        ingestion = pdf_processing.PdfIngestion(buffer, workers)
+        await ingestion.run()
+        best = ingestion.elapsed if best is None else min(best, ingestion.elapsed)
+        first_block = ingestion.first_block_seconds if first_block is None else min(first_block, ingestion.first_block_seconds)
+    return ingestion.total_pages, best, first_block
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de extracción de PDF")
+    parser.add_argument('--pages', type=int, default=120)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    buffer = build_sample_pdf(args.pages)
+    print(f"PDF sintético: {args.pages} páginas, {len(buffer) / 1024:.0f} KB, {os.cpu_count()} núcleos\n")
+    print(f"{'procesos':>8}  {'segundos':>9}  {'páginas/s':>10}  {'aceleración':>11}  {'primer bloque':>13}")
+
+    baseline = None
+    for workers in args.workers:
+        pages, elapsed, first_block = asyncio.run(run(buffer, workers, args.repeat))
+        pdf_processing.shutdown_executor()
+        rate = pages / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>8}  {elapsed:>9.3f}  {rate:>10.1f}  {rate / baseline:>10.2f}x  {first_block:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
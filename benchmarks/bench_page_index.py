@@ -0,0 +1,76 @@
+# Benchmark del índice BM25 de páginas: tiempo de construcción (completa e incremental
+# por tandas), memoria estimada y latencia de búsqueda.
+#
+# Uso:
+#   python benchmarks/bench_page_index.py --pages 1000
+#   python benchmarks/bench_page_index.py documento.pdf
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_processing  # noqa: E402
+from pdf_processing import PageRecord  # noqa: E402
+from page_index import PageIndex, build_page_index  # noqa: E402
+
+
+# Función para generar páginas sintéticas con un vocabulario variado (distribución tipo Zipf)
+def synthetic_pages(total_pages, words_per_page=450, vocabulary_size=20000, seed=1):
+    rng = random.Random(seed)
+    vocabulary = [f"termino{i}" for i in range(vocabulary_size)]
+    weights = [1 / (i + 1) for i in range(vocabulary_size)]
+    return [
+        PageRecord(i + 1, ' '.join(rng.choices(vocabulary, weights, k=words_per_page)))
+        for i in range(total_pages)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del índice BM25 de páginas")
+    parser.add_argument('pdf', nargs='?', help="PDF a indexar (por defecto, páginas sintéticas)")
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=50, help="Páginas por tanda en la construcción incremental")
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, 'rb') as f:
+            pages = asyncio.run(pdf_processing.extract_pdf_contents(f.read()))['pages']
+        pdf_processing.shutdown_executor()
+    else:
+        pages = synthetic_pages(args.pages)
+    characters = sum(len(page.text) for page in pages)
+    print(f"{len(pages)} páginas, {characters / 1024 / 1024:.1f} MB de texto\n")
+
+    start = time.perf_counter()
+    index = build_page_index(pages)
+    full = time.perf_counter() - start
+
+    incremental = PageIndex()
+    batches = []
+    for offset in range(0, len(pages), args.batch):
+        start = time.perf_counter()
+        incremental.add_pages(pages[offset:offset + args.batch], offset)
+        batches.append(time.perf_counter() - start)
+
+    rng = random.Random(2)
+    words = [word for page in rng.sample(pages, min(20, len(pages))) for word in page.text.split()[:50]]
+    queries = [' '.join(rng.sample(words, 4)) for _ in range(args.queries)]
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query)
+    search = (time.perf_counter() - start) / len(queries)
+
+    print(f"{'construcción completa':<28} {full:>8.3f} s  ({len(pages) / full:,.0f} páginas/s)")
+    print(f"{'construcción incremental':<28} {sum(batches):>8.3f} s  (máx. {max(batches) * 1000:.1f} ms por tanda de {args.batch})")
+    print(f"{'términos distintos':<28} {len(index.postings):>8,}")
+    print(f"{'memoria estimada':<28} {index.memory_bytes() / 1024 / 1024:>8.1f} MB")
+    print(f"{'búsqueda (top-k)':<28} {search * 1000:>8.2f} ms por consulta")
+
+
+if __name__ == '__main__':
+    main()
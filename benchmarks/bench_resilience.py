@@ -0,0 +1,115 @@
+# Benchmark de la capa de llamadas al modelo contra el modelo simulado: efecto de
+# los reintentos y de las peticiones duplicadas en la latencia de cola (p95/p99) y
+# en los errores, y comportamiento del interruptor de circuito durante una caída.
+#
+# Uso:
+#   python benchmarks/bench_resilience.py
+#   python benchmarks/bench_resilience.py --requests 500 --slow-rate 0.05 --failure-rate 0.05 --hedge 0.9
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_backend import StubModel  # noqa: E402
+from resilience import ResilientCaller, CircuitBreaker, CircuitOpenError  # noqa: E402
+from load_test import percentile  # noqa: E402
+
+
+# Función para lanzar `total` llamadas (con `concurrency` a la vez) y medir su latencia
+async def run_calls(caller, stub, total, concurrency, timeout, hedge):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors, rejected = [], 0, 0
+
+    async def attempt(attempt_timeout):
+        return await asyncio.wait_for(stub.generate_content_async("pregunta de prueba"), attempt_timeout)
+
+    async def one():
+        nonlocal errors, rejected
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                caller.check('bench')
+                await caller.call(attempt, timeout, 'bench', hedge=hedge)
+            except CircuitOpenError:
+                rejected += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[one() for _ in range(total)])
+    return latencies, errors, rejected
+
+
+def stub_for(args):
+    return StubModel(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                     response_words=20, seed=args.seed, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+
+
+async def bench_tail_latency(args):
+    scenarios = [
+        ('sin reintentos', dict(retries=0, hedge_percentile=0), False),
+        (f'{args.retries} reintentos', dict(retries=args.retries, hedge_percentile=0), False),
+        (f'reintentos + duplicado p{args.hedge * 100:.0f}', dict(retries=args.retries, hedge_percentile=args.hedge), True),
+    ]
+    print(f"{args.requests} llamadas ({args.concurrency} a la vez), latencia {args.latency}s ± {args.jitter}s, "
+          f"{args.slow_rate:.0%} lentas ({args.slow_latency}s), {args.failure_rate:.0%} fallos\n")
+    print(f"{'escenario':<28} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'máx ms':>8} {'errores':>8} {'llamadas':>9}")
+    for name, options, hedge in scenarios:
+        stub = stub_for(args)
+        caller = ResilientCaller(base_delay=args.base_delay, attempt_timeout=args.timeout,
+                                 breaker=CircuitBreaker(failure_threshold=10 ** 9), **options)
+        latencies, errors, _ = await run_calls(caller, stub, args.requests, args.concurrency, args.timeout, hedge)
+        print(f"{name:<28} {percentile(latencies, 0.5) * 1000:>8.0f} {percentile(latencies, 0.95) * 1000:>8.0f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.0f} {max(latencies) * 1000:>8.0f} {errors:>8} {stub.calls:>9}")
+    print()
+
+
+# Durante una caída (todas las llamadas fallan) el circuito abierto responde al
+# instante en lugar de agotar los reintentos de cada llamada
+async def bench_outage(args):
+    print(f"Caída del servicio: {args.requests // 2} llamadas con 100% de fallos; tras {args.reset_timeout}s, "
+          f"{args.requests // 2} llamadas (de una en una) con el servicio recuperado\n")
+    print(f"{'escenario':<28} {'rechazadas':>10} {'errores':>8} {'media ms':>9} {'llamadas':>9} {'fallos tras recuperarse':>24}")
+    for name, threshold in (('sin circuito', 10 ** 9), ('con circuito', 5)):
+        stub = stub_for(args)
+        stub.slow_rate = 0
+        caller = ResilientCaller(retries=args.retries, base_delay=args.base_delay, attempt_timeout=args.timeout,
+                                 hedge_percentile=0, breaker=CircuitBreaker(threshold, reset_timeout=args.reset_timeout))
+        stub.failure_rate = 1.0
+        outage, errors, rejected = await run_calls(caller, stub, args.requests // 2, args.concurrency, args.timeout, False)
+        stub.failure_rate = 0.0
+        await asyncio.sleep(args.reset_timeout)
+        outage_calls = stub.calls
+        _, recovery_errors, recovery_rejected = await run_calls(caller, stub, args.requests // 2, 1, args.timeout, False)
+        print(f"{name:<28} {rejected:>10} {errors:>8} {sum(outage) / len(outage) * 1000:>9.0f} "
+              f"{outage_calls:>9} {recovery_errors + recovery_rejected:>24}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de reintentos, peticiones duplicadas e interruptor de circuito")
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2, help="Latencia media del modelo simulado (s)")
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--slow-rate', type=float, default=0.05, help="Proporción de respuestas lentas")
+    parser.add_argument('--slow-latency', type=float, default=3.0, help="Latencia de las respuestas lentas (s)")
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--base-delay', type=float, default=0.05, help="Espera antes del primer reintento (s)")
+    parser.add_argument('--hedge', type=float, default=0.9, help="Percentil de latencia para duplicar la petición")
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--reset-timeout', type=float, default=1.0, help="Segundos que el circuito permanece abierto")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+    logging.getLogger('Briefly-pdf').setLevel(logging.ERROR)
+
+    asyncio.run(bench_tail_latency(args))
+    asyncio.run(bench_outage(args))
+
+
+if __name__ == '__main__':
+    main()
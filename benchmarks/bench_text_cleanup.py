@@ -0,0 +1,66 @@
+# Benchmark de la limpieza del texto de las páginas: caracteres y tokens estimados
+# enviados al modelo por documento antes y después de quitar encabezados, pies,
+# números de página, cortes con guion y espacios repetidos, y tiempo de limpieza.
+#
+# Uso:
+#   python benchmarks/bench_text_cleanup.py
+#   python benchmarks/bench_text_cleanup.py --pages 200 --budget 8000
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sample_pdfs import build_report_pdf, build_sample_pdf, build_slide_pdf, build_image_pdf  # noqa: E402
+from text_cleanup import clean_pages, fit_pages  # noqa: E402
+from conversation import estimate_tokens  # noqa: E402
+from pdf_processing import extract_page_range, plan_blocks  # noqa: E402
+
+PDF_BUILDERS = {
+    'informe': build_report_pdf,
+    'texto': build_sample_pdf,
+    'diapositivas': build_slide_pdf,
+    'imágenes': build_image_pdf
+}
+
+
+# Función para medir los tokens de los prompts de todos los bloques de un documento
+def block_prompt_tokens(pages, budget):
+    blocks = plan_blocks(pages)
+    tokens = truncated = 0
+    for start, end in blocks:
+        pages_info, truncation = fit_pages([(i + 1, pages[i].text) for i in range(start, end)], budget)
+        tokens += estimate_tokens(pages_info)
+        truncated += truncation['droppedChars'] if truncation else 0
+    return tokens, truncated, len(blocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la limpieza del texto de las páginas")
+    parser.add_argument('--pages', type=int, default=60, help="Páginas de cada PDF de ejemplo")
+    parser.add_argument('--budget', type=int, default=24000, help="Presupuesto de caracteres por llamada")
+    args = parser.parse_args()
+
+    print(f"{'documento':<14} {'tokens antes':>13} {'tokens después':>15} {'ahorro':>7} {'líneas repetidas':>17} "
+          f"{'ms limpieza':>12} {'tokens bloques':>15} {'recortados':>11}")
+    for name, builder in PDF_BUILDERS.items():
+        buffer = builder(args.pages)
+        pages = extract_page_range(buffer, 0, args.pages)
+        raw = [page.text for page in pages]
+
+        start = time.perf_counter()
+        cleaned, report = clean_pages(raw)
+        elapsed = time.perf_counter() - start
+
+        before = sum(estimate_tokens(text) for text in raw)
+        after = sum(estimate_tokens(text) for text in cleaned)
+        for page, text in zip(pages, cleaned):
+            page.text = text
+        block_tokens, dropped, _ = block_prompt_tokens(pages, args.budget)
+        print(f"{name:<14} {before:>13} {after:>15} {1 - after / before:>7.1%} {report['boilerplateLines']:>17} "
+              f"{elapsed * 1000:>12.1f} {block_tokens:>15} {dropped:>11}")
+
+
+if __name__ == '__main__':
+    main()
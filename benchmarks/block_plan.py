@@ -0,0 +1,54 @@
+# Comparación de la planificación de bloques por presupuesto con los bloques fijos de 3 páginas:
+# número de bloques (llamadas al modelo para resumir el documento) y tamaño de cada bloque.
+#
+# Uso:
+#   python benchmarks/block_plan.py --pages 200
+#   python benchmarks/block_plan.py documento.pdf
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_processing  # noqa: E402
+from sample_pdfs import build_sample_pdf, build_slide_pdf  # noqa: E402
+
+
+# Función para describir una tabla de bloques: número de bloques y caracteres/imágenes por bloque
+def describe(pages, blocks):
+    chars = [sum(len(pages[i].text.strip()) for i in range(start, end)) for start, end in blocks]
+    images = [sum(1 for i in range(start, end) if pages[i].has_visual) for start, end in blocks]
+    return len(blocks), max(chars), sum(chars) / len(chars), max(images)
+
+
+def report(name, buffer):
+    result = asyncio.run(pdf_processing.extract_pdf_contents(buffer))
+    pages = result['pages']
+    fixed = [(start, min(start + 3, len(pages))) for start in range(0, len(pages), 3)]
+    print(f"\n{name}: {len(pages)} páginas")
+    print(f"{'plan':>12}  {'bloques':>8}  {'máx. car.':>10}  {'media car.':>10}  {'máx. img.':>9}")
+    for label, blocks in (('fijo (3)', fixed), ('presupuesto', result['blocks'])):
+        count, max_chars, avg_chars, max_images = describe(pages, blocks)
+        print(f"{label:>12}  {count:>8}  {max_chars:>10}  {avg_chars:>10.0f}  {max_images:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planificación de bloques por presupuesto")
+    parser.add_argument('pdf', nargs='?', help="PDF a analizar (por defecto, documentos sintéticos)")
+    parser.add_argument('--pages', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"Presupuesto: {pdf_processing.BLOCK_MAX_CHARS} caracteres, {pdf_processing.BLOCK_MAX_IMAGES} imágenes, "
+          f"{pdf_processing.BLOCK_MAX_PAGES} páginas por bloque")
+    if args.pdf:
+        with open(args.pdf, 'rb') as f:
+            report(os.path.basename(args.pdf), f.read())
+    else:
+        report("Texto denso", build_sample_pdf(args.pages))
+        report("Presentación", build_slide_pdf(args.pages))
+    pdf_processing.shutdown_executor()
+
+
+if __name__ == '__main__':
+    main()
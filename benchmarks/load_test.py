@@ -0,0 +1,172 @@
+# Prueba de carga con el modelo simulado (MODEL_BACKEND=stub): rendimiento de la
+# ingesta por tipo y tamaño de PDF, memoria por sesión y latencia de extremo a
+# extremo (p50/p95/p99) de subida, "siguiente bloque", "obtener resumen" y
+# "bloque N: pregunta" con N clientes concurrentes. Con --max-extractions se aplica
+# el control de admisión y se cuentan las peticiones rechazadas (429/503). No se
+# llama a Gemini.
+#
+# Uso:
+#   python benchmarks/load_test.py --clients 20 --pages 60
+#   python benchmarks/load_test.py --sizes 10 100 1000 --latency 2 --jitter 0.5 --failure-rate 0.05
+#   python benchmarks/load_test.py --clients 20 --pages 200 --sizes --max-extractions 2
+import io
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sample_pdfs import build_sample_pdf, build_image_pdf  # noqa: E402
+
+PDF_BUILDERS = {'texto': build_sample_pdf, 'imágenes': build_image_pdf}
+
+
+# Función para calcular un percentil (interpolación lineal) de una lista de tiempos
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+# Función para que cada cliente suba un PDF distinto (el almacén deduplica por contenido)
+def unique_pdf(buffer, client):
+    import fitz
+    doc = fitz.open(stream=buffer, filetype='pdf')
+    doc.set_metadata({'title': f"Cliente {client}"})
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+# Función para medir el rendimiento de la extracción por tipo y tamaño de PDF
+async def bench_ingestion(pdf_processing, sizes):
+    print(f"{'tipo':<10} {'páginas':>8} {'MB':>7} {'segundos':>9} {'páginas/s':>10}")
+    for kind, builder in PDF_BUILDERS.items():
+        for total_pages in sizes:
+            buffer = builder(total_pages)
+            start = time.perf_counter()
+            await pdf_processing.extract_pdf_contents(buffer)
+            elapsed = time.perf_counter() - start
+            print(f"{kind:<10} {total_pages:>8} {len(buffer) / 1024 / 1024:>7.1f} {elapsed:>9.2f} {total_pages / elapsed:>10.0f}")
+    print()
+
+
+# Función que ejecuta el recorrido de un cliente y guarda la latencia de cada operación
+async def run_client(client, test_client, buffer, latencies, errors, rejected):
+    from quart.datastructures import FileStorage
+
+    async def timed(operation, **kwargs):
+        start = time.perf_counter()
+        response = await test_client.post('/api/query', **kwargs)
+        data = await response.get_json()
+        latencies.setdefault(operation, []).append(time.perf_counter() - start)
+        if response.status_code in (429, 503):
+            rejected[operation] = rejected.get(operation, 0) + 1
+        elif response.status_code >= 400 or not data.get('success'):
+            errors[operation] = errors.get(operation, 0) + 1
+        return data
+
+    upload = await timed('subida', files={'files': FileStorage(io.BytesIO(buffer), filename=f"cliente{client}.pdf")})
+    session_id = upload.get('sessionId')
+    if not session_id:
+        return None
+    await timed('siguiente bloque', form={'query': 'siguiente bloque', 'sessionId': session_id})
+    await timed('obtener resumen', form={'query': 'obtener resumen', 'sessionId': session_id})
+    await timed('bloque N: pregunta', form={'query': 'bloque 1: ¿Cuál es la idea principal?', 'sessionId': session_id})
+    return session_id
+
+
+# Función para lanzar los clientes concurrentes contra la aplicación en proceso
+async def bench_clients(app_module, args):
+    builder = PDF_BUILDERS[args.kind]
+    base = builder(args.pages)
+    buffers = [unique_pdf(base, client) for client in range(args.clients)]
+    latencies, errors, rejected = {}, {}, {}
+
+    test_client = app_module.app.test_client()
+    async with app_module.app.test_app():
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        sessions = await asyncio.gather(*[
+            run_client(client, test_client, buffer, latencies, errors, rejected)
+            for client, buffer in enumerate(buffers)
+        ])
+        elapsed = time.perf_counter() - start
+        # Esperar a que terminen las tareas en segundo plano antes de medir la memoria
+        await asyncio.sleep(0.1)
+        retained = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        sessions = [session_id for session_id in sessions if session_id]
+
+        print(f"{args.clients} clientes, PDF de {args.kind} de {args.pages} páginas, "
+              f"modelo simulado {args.latency}s ± {args.jitter}s, fallos {args.failure_rate:.0%}")
+        print(f"{len(sessions)} sesiones en {elapsed:.2f} s, "
+              f"memoria retenida {retained / max(1, len(sessions)) / 1024:.0f} KB por sesión "
+              f"(objetos Python, sin contar los procesos de extracción)\n")
+        print(f"{'operación':<22} {'n':>5} {'errores':>8} {'rechazos':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for operation, values in latencies.items():
+            print(f"{operation:<22} {len(values):>5} {errors.get(operation, 0):>8} {rejected.get(operation, 0):>9} "
+                  f"{percentile(values, 0.5) * 1000:>9.0f} {percentile(values, 0.95) * 1000:>9.0f} "
+                  f"{percentile(values, 0.99) * 1000:>9.0f}")
+        print(f"\nllamadas al modelo simulado: {app_module.model.calls}")
+
+        for session_id in sessions:
+            await test_client.delete(f'/api/sessions/{session_id}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga con el modelo simulado")
+    parser.add_argument('--clients', type=int, default=10, help="Clientes concurrentes")
+    parser.add_argument('--pages', type=int, default=30, help="Páginas del PDF de cada cliente")
+    parser.add_argument('--kind', choices=list(PDF_BUILDERS), default='texto')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10, 100],
+                        help="Tamaños (páginas) para medir la ingesta; vacío para omitirla")
+    parser.add_argument('--latency', type=float, default=1.0, help="Latencia media del modelo simulado (s)")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Variación de la latencia (s)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Proporción de llamadas que fallan")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-extractions', type=int, default=0,
+                        help="PDFs procesados a la vez (control de admisión); 0 = uno por cliente")
+    parser.add_argument('--rate-limit', action='store_true',
+                        help="Aplicar el límite por cliente (todos los clientes comparten dirección)")
+    args = parser.parse_args()
+
+    # La configuración se lee al importar la aplicación
+    os.environ.update({
+        'MODEL_BACKEND': 'stub',
+        'STUB_LATENCY': str(args.latency),
+        'STUB_JITTER': str(args.jitter),
+        'STUB_FAILURE_RATE': str(args.failure_rate),
+        'STUB_SEED': str(args.seed),
+        'RESPONSE_CACHE_PATH': '',
+        'BLOCK_REQUEST_INTERVAL': '0',
+        'ADMISSION_MAX_EXTRACTIONS': str(args.max_extractions or args.clients)
+    })
+    if not args.rate_limit:
+        os.environ.update({'RATE_LIMIT_QUERIES_PER_MINUTE': '0', 'RATE_LIMIT_UPLOADS_PER_MINUTE': '0'})
+    import pdf_processing
+    import app as app_module
+    logging.getLogger('Briefly-pdf').setLevel(logging.WARNING)
+
+    async def run():
+        if args.sizes:
+            await bench_ingestion(pdf_processing, args.sizes)
+        await bench_clients(app_module, args)
+
+    try:
+        asyncio.run(run())
+    finally:
+        pdf_processing.shutdown_executor()
+
+
+if __name__ == '__main__':
+    main()
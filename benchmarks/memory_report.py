@@ -0,0 +1,85 @@
+# Informe de memoria: bytes por página de la representación antigua (dict con
+# PNG en base64) frente a PageRecord + PageImage con bytes crudos.
+#
+# Uso:
+#   python benchmarks/memory_report.py                  # documento sintético
+#   python benchmarks/memory_report.py documento.pdf --dpi 86 120
+import os
+import sys
+import base64
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_processing  # noqa: E402
+from sample_pdfs import build_sample_pdf  # noqa: E402
+
+
+# Función para medir el tamaño de un objeto incluyendo sus atributos y elementos
+def deep_size(obj, seen=None):
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Informe de memoria por página")
+    parser.add_argument('pdf', nargs='?', help="PDF de referencia (por defecto, uno sintético)")
+    parser.add_argument('--pages', type=int, default=30, help="Páginas del documento sintético")
+    parser.add_argument('--dpi', type=int, nargs='+', default=[pdf_processing.PAGE_IMAGE_DPI])
+    parser.add_argument('--quality', type=int, default=pdf_processing.PAGE_IMAGE_QUALITY)
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, 'rb') as f:
+            buffer = f.read()
+    else:
+        buffer = build_sample_pdf(args.pages)
+
+    total_pages = pdf_processing.count_pages(buffer)
+    records = pdf_processing.extract_page_range(buffer, 0, total_pages)
+    indices = list(range(total_pages))
+    print(f"Documento de referencia: {total_pages} páginas, {len(buffer) / 1024:.0f} KB\n")
+    print(f"{'representación':<28} {'dpi':>4} {'bytes/página':>13} {'vs. antigua':>12}")
+
+    for dpi in args.dpi:
+        png_images = pdf_processing.render_page_images(buffer, indices, dpi=dpi, image_format='png')
+
+        # Representación antigua: un dict por página con el PNG en base64
+        old_pages = [
+            {
+                'pageNumber': record.page_number,
+                'text': record.text,
+                'fullPageImage': base64.b64encode(image.data).decode('utf-8')
+            }
+            for record, image in zip(records, png_images)
+        ]
+        old_size = deep_size(old_pages) / total_pages
+        print(f"{'dict + PNG base64':<28} {dpi:>4} {old_size:>13,.0f} {'1.00x':>12}")
+
+        formats = ('png', 'jpeg', 'webp') if pdf_processing.HAS_PILLOW else ('png', 'jpeg')
+        for image_format in formats:
+            if image_format == 'png':
+                images = png_images
+            else:
+                images = pdf_processing.render_page_images(buffer, indices, dpi=dpi,
+                                                           image_format=image_format,
+                                                           quality=args.quality)
+            label = f"PageRecord + {images[0].mime_type}"
+            if image_format != 'png':
+                label += f" q{args.quality}"
+            new_size = deep_size((records, images)) / total_pages
+            print(f"{label:<28} {dpi:>4} {new_size:>13,.0f} {new_size / old_size:>11.2f}x")
+
+
+if __name__ == '__main__':
+    main()
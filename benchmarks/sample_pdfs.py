@@ -0,0 +1,93 @@
+# Generadores de PDFs sintéticos para los benchmarks
+import fitz  # PyMuPDF
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+    "exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. "
+)
+
+
+# Función para generar un PDF sintético con texto y algunos gráficos vectoriales
+def build_sample_pdf(total_pages):
+    doc = fitz.open()
+    for i in range(total_pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Página de prueba {i + 1}", fontsize=18)
+        page.insert_textbox(fitz.Rect(72, 100, 540, 500), LOREM * 6, fontsize=10)
+        if i % 3 == 0:
+            page.draw_rect(fitz.Rect(72, 520, 300, 700), color=(0, 0, 1), fill=(0.8, 0.9, 1))
+            page.draw_circle(fitz.Point(420, 610), 80, color=(1, 0, 0))
+    buffer = doc.tobytes()
+    doc.close()
+    return buffer
+
+
+# Función para generar una presentación sintética: diapositivas con poco texto,
+# algunas con gráficos, y un índice (outline) con un capítulo cada `chapter_every` páginas
+def build_slide_pdf(total_pages, chapter_every=10):
+    doc = fitz.open()
+    for i in range(total_pages):
+        page = doc.new_page(width=842, height=595)
+        page.insert_text((60, 80), f"Diapositiva {i + 1}", fontsize=28)
+        page.insert_text((60, 140), "Idea principal de la diapositiva en una línea.", fontsize=16)
+        if i % 4 == 0:
+            page.draw_rect(fitz.Rect(420, 200, 780, 520), color=(0, 0, 1), fill=(0.8, 0.9, 1))
+            for x in range(440, 780, 40):
+                page.draw_rect(fitz.Rect(x, 520 - (x % 200), x + 25, 520), fill=(0.2, 0.4, 0.8))
+    doc.set_toc([[1, f"Capítulo {c + 1}", c * chapter_every + 1] for c in range((total_pages - 1) // chapter_every + 1)])
+    buffer = doc.tobytes()
+    doc.close()
+    return buffer
+
+
+# Función para generar un PDF con muchas imágenes: cada página lleva una o dos
+# imágenes rasterizadas (fotos o escaneos simulados) y un pie de texto corto
+def build_image_pdf(total_pages, image_size=400):
+    doc = fitz.open()
+    for i in range(total_pages):
+        page = doc.new_page()
+        page.insert_text((72, 60), f"Figura {i + 1}", fontsize=14)
+        for j in range(1 + i % 2):
+            pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, image_size, image_size), False)
+            pix.clear_with(200)
+            step = image_size // 8
+            for x in range(0, image_size, step):
+                shade = (37 * (i + j) + x) % 256
+                pix.set_rect(fitz.IRect(x, 0, x + step, image_size - x // 2), (shade, 255 - shade, (shade * 3) % 256))
+            top = 90 + j * 330
+            page.insert_image(fitz.Rect(72, top, 372, top + 300), pixmap=pix)
+        page.insert_text((72, 770), "Pie de figura con una descripción breve.", fontsize=9)
+    buffer = doc.tobytes(deflate=True)
+    doc.close()
+    return buffer
+
+
+# Función para generar un informe sintético con encabezado y pie de página en cada
+# página, número de página, palabras cortadas con guion al final de línea y espacios
+# repetidos, como los que deja la extracción de texto de muchos PDFs reales
+def build_report_pdf(total_pages):
+    doc = fitz.open()
+    words = LOREM.split()
+    for i in range(total_pages):
+        page = doc.new_page()
+        page.insert_text((72, 40), "Informe anual 2024   —   Empresa Ejemplo S.A.", fontsize=9)
+        page.insert_text((400, 40), "Documento confidencial", fontsize=9)
+        y = 90
+        for line in range(36):
+            start = (i * 7 + line * 11) % (len(words) - 12)
+            text = '  '.join(words[start:start + 10])
+            if line % 4 == 3:
+                # Palabra cortada al final de la línea
+                text += " compro-"
+                page.insert_text((72, y), text, fontsize=10)
+                y += 16
+                page.insert_text((72, y), "bación de los resultados.", fontsize=10)
+            else:
+                page.insert_text((72, y), text, fontsize=10)
+            y += 16
+        page.insert_text((72, 800), f"Página {i + 1} de {total_pages}", fontsize=9)
+        page.insert_text((400, 800), "www.empresa-ejemplo.com", fontsize=9)
+    buffer = doc.tobytes(deflate=True)
+    doc.close()
+    return buffer
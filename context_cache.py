@@ -0,0 +1,169 @@
+import os
+import time
+import asyncio
+import logging
+
+from metrics import context_upload_bytes_total, context_reused_bytes_total
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Registrar las imágenes de las páginas en el backend del modelo (una sola vez) y
+# citarlas por su identificador en lugar de reenviar los bytes en cada pregunta
+CONTEXT_CACHE = os.getenv('CONTEXT_CACHE', 'true').lower() == 'true'
+# Segundos sin uso tras los que se borra un archivo registrado (por defecto, la
+# vida de una sesión inactiva)
+CONTEXT_CACHE_TTL = float(os.getenv('CONTEXT_CACHE_TTL', os.getenv('SESSION_IDLE_TIMEOUT', 3600)))
+# Vida máxima de un archivo en el backend (Gemini los borra a las 48 horas)
+CONTEXT_FILE_MAX_AGE = 47 * 3600
+# Segundos sin intentar subidas tras un fallo del almacén de archivos
+CONTEXT_UPLOAD_BACKOFF = 60
+
+
+# Caché de contexto de los documentos: las imágenes de página se suben una vez al
+# almacén de archivos del backend (`file_store`) y las peticiones siguientes las
+# citan con una parte `file_data`. Cada archivo caduca tras CONTEXT_CACHE_TTL
+# segundos sin uso y se borra cuando ninguna sesión usa ya el documento. Si una
+# subida falla, la imagen se envía incrustada como antes.
+#
+# Las llamadas de un solo uso (como los resúmenes de bloque) piden las partes con
+# `register=False`: reutilizan los archivos ya registrados pero no suben nada la
+# primera vez que envían una página, solo si la misma página vuelve a pedirse.
+class DocumentContextCache:
+    def __init__(self, file_store, enabled=CONTEXT_CACHE, ttl=CONTEXT_CACHE_TTL):
+        self.file_store = file_store
+        self.enabled = enabled
+        self.ttl = ttl
+        self._handles = {}   # (documento, página) -> {'name', 'uri', 'mimeType', 'bytes', 'uploaded', 'expires'}
+        self._pending = {}   # subidas en curso, compartidas por las peticiones simultáneas
+        self._inline = set() # páginas ya enviadas incrustadas una vez sin registrarlas
+        self._invalidated = set()  # subidas en curso de documentos que ya no usa nadie
+        self._paused_until = 0.0
+        self.stats_counters = {'uploads': 0, 'reused': 0, 'inline': 0, 'failures': 0, 'deleted': 0,
+                               'bytesUploaded': 0, 'bytesReused': 0}
+
+    # Función para obtener las partes de las páginas que ya tienen un archivo registrado
+    # vigente, sin necesidad de renderizarlas. Devuelve {página: parte}.
+    def registered_parts(self, doc_key, page_indices):
+        if not self.enabled or time.time() < self._paused_until:
+            return {}
+        parts = {}
+        for page_index in page_indices:
+            part = self._reuse((doc_key, page_index))
+            if part is not None:
+                parts[page_index] = part
+        return parts
+
+    # Función para obtener las partes de unas imágenes de página, registrándolas si hace falta
+    # (con `register=False`, solo a partir del segundo uso de cada página)
+    async def get_parts(self, doc_key, page_indices, images, register=True):
+        if not self.enabled or time.time() < self._paused_until:
+            return [image.to_part() for image in images]
+        return list(await asyncio.gather(*[
+            self._get_part(doc_key, page_index, image, register) for page_index, image in zip(page_indices, images)
+        ]))
+
+    async def _get_part(self, doc_key, page_index, image, register=True):
+        key = (doc_key, page_index)
+        part = self._reuse(key, image.mime_type)
+        if part is not None:
+            return part
+
+        if not register and key not in self._inline:
+            # Primer uso de una llamada de un solo uso: incrustar sin registrar
+            self._inline.add(key)
+            self.stats_counters['inline'] += 1
+            return image.to_part()
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._upload(key, image))
+            self._pending[key] = task
+            task.add_done_callback(lambda finished, key=key: self._pending.pop(key, None))
+        handle = await asyncio.shield(task)
+        return self._file_part(handle) if handle else image.to_part()
+
+    # Citar el archivo registrado de una página si sigue vigente (y renovar su caducidad)
+    def _reuse(self, key, mime_type=None):
+        now = time.time()
+        handle = self._handles.get(key)
+        if not handle or handle['expires'] <= now or (mime_type and handle['mimeType'] != mime_type):
+            return None
+        handle['expires'] = min(now + self.ttl, handle['uploaded'] + CONTEXT_FILE_MAX_AGE)
+        self.stats_counters['reused'] += 1
+        self.stats_counters['bytesReused'] += handle['bytes']
+        context_reused_bytes_total.inc(handle['bytes'])
+        return self._file_part(handle)
+
+    async def _upload(self, key, image):
+        try:
+            uploaded = await self.file_store.upload(image.data, image.mime_type)
+        except Exception as error:
+            self._invalidated.discard(key)
+            self.stats_counters['failures'] += 1
+            # Mientras el almacén de archivos falle, las imágenes se envían incrustadas
+            self._paused_until = time.time() + CONTEXT_UPLOAD_BACKOFF
+            logger.warning(f"No se pudo registrar la página {key[1] + 1} en el backend del modelo: {error}")
+            return None
+        if key in self._invalidated:
+            # El documento se invalidó durante la subida: nadie usará el archivo
+            self._invalidated.discard(key)
+            self._schedule_delete([uploaded])
+            return None
+        now = time.time()
+        stale = self._handles.get(key)
+        if stale:
+            self._schedule_delete([stale])
+        handle = {
+            'name': uploaded['name'],
+            'uri': uploaded['uri'],
+            'mimeType': image.mime_type,
+            'bytes': len(image.data),
+            'uploaded': now,
+            'expires': min(now + self.ttl, now + CONTEXT_FILE_MAX_AGE)
+        }
+        self._handles[key] = handle
+        self.stats_counters['uploads'] += 1
+        self.stats_counters['bytesUploaded'] += handle['bytes']
+        context_upload_bytes_total.inc(handle['bytes'])
+        return handle
+
+    @staticmethod
+    def _file_part(handle):
+        return {'file_data': {'mime_type': handle['mimeType'], 'file_uri': handle['uri']}}
+
+    # Borrar los archivos de un documento que ya no usa ninguna sesión
+    def invalidate(self, doc_key):
+        handles = [self._handles.pop(key) for key in [k for k in self._handles if k[0] == doc_key]]
+        self._inline = {key for key in self._inline if key[0] != doc_key}
+        self._invalidated.update(key for key in self._pending if key[0] == doc_key)
+        self._schedule_delete(handles)
+
+    # Borrar los archivos caducados (se llama desde la limpieza periódica de sesiones)
+    async def expire(self):
+        now = time.time()
+        expired = [key for key, handle in self._handles.items() if handle['expires'] <= now]
+        await self._delete([self._handles.pop(key) for key in expired])
+
+    def _schedule_delete(self, handles):
+        if not handles:
+            return
+        try:
+            asyncio.get_running_loop().create_task(self._delete(handles))
+        except RuntimeError:
+            pass  # Sin bucle de eventos: el backend los borrará al caducar
+
+    async def _delete(self, handles):
+        for handle in handles:
+            try:
+                await self.file_store.delete(handle['name'])
+                self.stats_counters['deleted'] += 1
+            except Exception as error:
+                logger.warning(f"No se pudo borrar el archivo {handle['name']} del backend del modelo: {error}")
+
+    def stats(self):
+        return dict(
+            self.stats_counters,
+            enabled=self.enabled,
+            files=len(self._handles),
+            bytes=sum(handle['bytes'] for handle in self._handles.values())
+        )
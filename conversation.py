@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import hashlib
+
+# Conversación de varios turnos por sesión: las preguntas siguientes se envían al
+# modelo con las anteriores para que pueda resolver referencias como "y la segunda tabla?"
+CHAT_HISTORY = os.getenv('CHAT_HISTORY', 'true').lower() == 'true'
+# Tokens (estimados) del historial que se envían con cada pregunta; al superarlos, los
+# turnos más antiguos se condensan en un resumen de la conversación
+CHAT_HISTORY_TOKENS = max(200, int(os.getenv('CHAT_HISTORY_TOKENS', 2000)))
+# Tamaño máximo (en tokens estimados) del resumen de los turnos antiguos
+CHAT_SUMMARY_TOKENS = max(50, int(os.getenv('CHAT_SUMMARY_TOKENS', 300)))
+# Turnos recientes que se conservan siempre literales, aunque se supere el presupuesto
+CHAT_KEEP_TURNS = 2
+# Estimación de caracteres por token (no hace falta el tokenizador del modelo)
+CHARS_PER_TOKEN = 4
+
+HISTORY_NOTE = ("Esta pregunta continúa la conversación anterior con el usuario: "
+                "interpreta con ese contexto las referencias a lo ya hablado.")
+
+
+# Función para estimar los tokens de un texto
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+# Historial de la conversación de una sesión: los turnos recientes (pregunta del
+# usuario y respuesta) literales y un resumen de los anteriores. Cada turno guarda
+# solo la pregunta y la respuesta, no el prompt con las páginas, de modo que el
+# historial enviado al modelo queda acotado por CHAT_HISTORY_TOKENS aunque la
+# conversación siga indefinidamente.
+class Conversation:
+    def __init__(self, summary='', turns=None, summarized=0, updated=0.0, budget=CHAT_HISTORY_TOKENS):
+        self.summary = summary
+        self.turns = list(turns or [])  # [{'question', 'answer'}]
+        self.summarized = summarized    # turnos condensados en el resumen
+        self.updated = updated
+        self.budget = budget
+        self.compacting = None          # tarea de condensación en curso
+
+    @staticmethod
+    def _turn_tokens(turn):
+        return estimate_tokens(turn['question']) + estimate_tokens(turn['answer'])
+
+    def tokens(self):
+        return estimate_tokens(self.summary) + sum(self._turn_tokens(turn) for turn in self.turns)
+
+    def memory_bytes(self):
+        return len(self.summary.encode('utf-8')) + sum(
+            len(turn['question'].encode('utf-8')) + len(turn['answer'].encode('utf-8')) for turn in self.turns
+        )
+
+    def add_turn(self, question, answer):
+        self.turns.append({'question': question, 'answer': answer})
+        self.updated = time.time()
+
+    # Función para construir el contenido de una llamada: el resumen y los turnos más
+    # recientes que caben en el presupuesto, seguidos de la pregunta actual (`parts`)
+    def contents(self, parts):
+        if isinstance(parts, str):
+            parts = [{'text': parts}]
+        if not self.summary and not self.turns:
+            return parts
+
+        available = self.budget - estimate_tokens(self.summary)
+        recent = []
+        for turn in reversed(self.turns):
+            available -= self._turn_tokens(turn)
+            if available < 0:
+                break
+            recent.insert(0, turn)
+
+        contents = []
+        if self.summary:
+            contents.append({'role': 'user', 'parts': [{'text': f"Resumen de nuestra conversación anterior:\n{self.summary}"}]})
+            contents.append({'role': 'model', 'parts': [{'text': "De acuerdo, lo tendré en cuenta."}]})
+        for turn in recent:
+            contents.append({'role': 'user', 'parts': [{'text': turn['question']}]})
+            contents.append({'role': 'model', 'parts': [{'text': turn['answer']}]})
+        contents.append({'role': 'user', 'parts': [{'text': HISTORY_NOTE}, *parts]})
+        return contents
+
+    # Claves adicionales de la caché de respuestas: una misma pregunta puede tener
+    # otra respuesta según lo que se haya hablado antes
+    def cache_context(self):
+        if not self.summary and not self.turns:
+            return ()
+        history = json.dumps([self.summary, self.turns], ensure_ascii=False)
+        return (hashlib.sha256(history.encode('utf-8')).hexdigest(),)
+
+    # Función para elegir cuántos turnos antiguos condensar: los necesarios para que
+    # los que quedan ocupen como mucho la mitad del presupuesto (0 si no hace falta)
+    def compaction_batch(self):
+        if self.tokens() <= self.budget:
+            return 0
+        kept, count = 0, len(self.turns)
+        for turn in reversed(self.turns):
+            cost = self._turn_tokens(turn)
+            if len(self.turns) - count >= CHAT_KEEP_TURNS and kept + cost > self.budget // 2:
+                break
+            kept += cost
+            count -= 1
+        return count
+
+    # Sustituir los `count` turnos más antiguos por el nuevo resumen
+    def apply_compaction(self, summary, count):
+        self.summary = summary[:CHAT_SUMMARY_TOKENS * CHARS_PER_TOKEN]
+        del self.turns[:count]
+        self.summarized += count
+        self.updated = time.time()
+
+    def to_dict(self):
+        return {'summary': self.summary, 'turns': self.turns, 'summarized': self.summarized, 'updated': self.updated}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['summary'], data['turns'], data['summarized'], data['updated'])
+
+    def stats(self):
+        return {
+            'turns': len(self.turns),
+            'summarizedTurns': self.summarized,
+            'estimatedTokens': self.tokens(),
+            'tokenBudget': self.budget,
+            'bytes': self.memory_bytes()
+        }
+
+
+# Función para construir el prompt que condensa unos turnos en el resumen de la conversación
+def compaction_prompt(document_name, summary, turns):
+    words = CHAT_SUMMARY_TOKENS * 3 // 4
+    previous = f"Resumen anterior de la conversación:\n{summary}\n" if summary else ""
+    exchanges = "\n".join(f"Usuario: {turn['question']}\nBriefly: {turn['answer']}\n" for turn in turns)
+    return f"""
+        Eres Briefly, un asistente que ayuda a estudiar el documento "{document_name}".
+        Resume en un máximo de {words} palabras la conversación entre el usuario y Briefly.
+        Conserva lo que el usuario preguntó, los datos, cifras y páginas citadas en las respuestas
+        y cualquier tabla, figura o sección a la que el usuario pueda volver a referirse.
+        Responde solo con el resumen.
+
+        {previous}
+        Turnos nuevos:
+        {exchanges}
+    """
@@ -0,0 +1,303 @@
+import os
+import json
+import mmap
+import time
+import asyncio
+import hashlib
+import logging
+
+from pdf_processing import PageRecord
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Presupuesto de memoria (MB) para los documentos residentes; al superarlo se
+# vuelcan a disco los documentos usados hace más tiempo
+SESSION_MEMORY_MB = float(os.getenv('SESSION_MEMORY_MB', 512))
+# Directorio donde se vuelcan los documentos poco usados
+SPILL_DIR = os.getenv('SPILL_DIR', os.path.join(os.getcwd(), 'cache', 'spill'))
+
+
+# Función para calcular el hash de contenido (SHA-256) de un PDF
+def document_hash(buffer):
+    return hashlib.sha256(buffer).hexdigest()
+
+
+# Función para estimar la memoria que ocupan los bytes y el texto de un documento
+def estimate_document_bytes(buffer, pages):
+    return len(buffer) + sum(len(page.text) for page in pages)
+
+
+# Función para estimar la memoria del índice BM25 de un documento. El índice no se
+# vuelca a disco (lo usan todas las preguntas libres), así que cuenta siempre como residente.
+def estimate_index_bytes(document):
+    index = document.get('index')
+    return index.memory_bytes() if index is not None else 0
+
+
+# Función para escribir el texto de las páginas en un archivo indexado:
+# [longitud de la cabecera][cabecera JSON con desplazamientos][textos UTF-8]
+def write_pages_file(path, pages):
+    encoded = [page.text.encode('utf-8') for page in pages]
+    index = []
+    offset = 0
+    for page, data in zip(pages, encoded):
+        index.append([offset, len(data), page.has_visual])
+        offset += len(data)
+    header = json.dumps(index).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for data in encoded:
+            f.write(data)
+
+
+# Páginas de un documento volcado a disco. El archivo se mapea en memoria y el
+# texto de cada página se decodifica solo cuando se accede a ella, así que un
+# documento frío no vuelve a ocupar memoria del proceso al consultarse.
+class MappedPages:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_length = int.from_bytes(self._map[:8], 'little')
+        self._index = json.loads(self._map[8:8 + header_length])
+        self._base = 8 + header_length
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        offset, length, has_visual = self._index[i]
+        start = self._base + offset
+        text = self._map[start:start + length].decode('utf-8')
+        return PageRecord(i + 1, text, has_visual)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+# Almacén de documentos direccionado por contenido. Varias sesiones que suben el
+# mismo PDF comparten el texto extraído, los bytes del PDF y los resúmenes de
+# bloques. Cada sesión mantiene una referencia; el documento se libera cuando
+# ninguna sesión lo usa. Si los documentos residentes superan el presupuesto de
+# memoria, los menos usados recientemente se vuelcan a disco. `session_bytes` da la
+# memoria de las sesiones que no se puede volcar (el historial de conversación), que
+# también cuenta en el presupuesto.
+class DocumentStore:
+    def __init__(self, on_evict=None, max_bytes=int(SESSION_MEMORY_MB * 1024 * 1024), spill_dir=SPILL_DIR,
+                 session_bytes=None):
+        self.on_evict = on_evict
+        self.session_bytes = session_bytes
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self._documents = {}
+        self._pending = {}
+        self._claims = {}  # documentos en carga -> referencias reservadas por quienes esperan
+        self._retired = []  # documentos fuera del índice por contenido que aún usan sesiones (ver retire)
+
+    # Obtener un documento (cargándolo con `loader` si no existe) y sumar una referencia.
+    # Devuelve (documento, estaba_en_cache).
+    async def acquire(self, doc_hash, loader):
+        cached = doc_hash in self._documents or doc_hash in self._pending
+        if doc_hash in self._documents:
+            document = self._documents[doc_hash]
+            document['refs'] += 1
+        else:
+            task = self._pending.get(doc_hash)
+            if task is None:
+                # Subidas simultáneas del mismo PDF esperan a una sola extracción
+                task = asyncio.ensure_future(self._load(doc_hash, loader))
+                self._pending[doc_hash] = task
+            # La referencia se reserva antes de esperar y _load la suma al documento, de
+            # modo que si el llamador se cancela siempre queda algo que devolver
+            self._claims[doc_hash] = self._claims.get(doc_hash, 0) + 1
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    self.release(doc_hash)
+                elif doc_hash in self._claims:
+                    self._claims[doc_hash] -= 1
+                raise
+            document = self._documents[doc_hash]
+        document['lastAccess'] = time.time()
+        if cached:
+            self.hits += 1
+            logger.info(f"Documento {doc_hash[:12]} reutilizado desde caché ({document['refs']} sesiones)")
+        else:
+            self.misses += 1
+        return document, cached
+
+    async def _load(self, doc_hash, loader):
+        try:
+            document = await loader()
+            # Los documentos cargados del directorio compartido ya se leen desde disco
+            shared = document.get('shared', False)
+            document.update({
+                'hash': doc_hash,
+                # Las referencias las reservan quienes esperaban la carga (ver acquire)
+                'refs': self._claims.pop(doc_hash, 0),
+                'summaries': {},
+                'memoryBytes': 0 if shared else estimate_document_bytes(document['buffer'], document['pages']),
+                'indexBytes': estimate_index_bytes(document),
+                'spilled': False,
+                'shared': shared,
+                'lastAccess': time.time()
+            })
+            self._documents[doc_hash] = document
+            if document['refs'] <= 0:
+                # Todos los que esperaban la carga se cancelaron
+                self._evict(doc_hash)
+        finally:
+            self._pending.pop(doc_hash, None)
+            self._claims.pop(doc_hash, None)
+
+    def get(self, doc_hash):
+        return self._documents.get(doc_hash)
+
+    # Recalcular la memoria de un documento (cuando termina de extraerse en segundo plano)
+    def update_size(self, doc_hash):
+        document = self._documents.get(doc_hash)
+        if document is None:
+            return
+        document['indexBytes'] = estimate_index_bytes(document)
+        if not document['spilled'] and not document['shared']:
+            document['memoryBytes'] = estimate_document_bytes(document['buffer'], document['pages'])
+
+    # Registrar un acceso al documento (para el orden de volcado a disco)
+    def touch(self, doc_hash, document=None):
+        document = document or self._documents.get(doc_hash)
+        if document:
+            document['lastAccess'] = time.time()
+
+    # Retirar del índice por contenido un documento que no se pudo procesar entero: las
+    # sesiones que ya lo usan conservan sus páginas y la siguiente subida del mismo PDF
+    # lo vuelve a extraer en lugar de reutilizarlo
+    def retire(self, doc_hash):
+        document = self._documents.pop(doc_hash, None)
+        if document is not None:
+            self._retired.append(document)
+
+    # Restar una referencia y liberar el documento si ya no lo usa ninguna sesión. Con
+    # `document`, la referencia se resta a ese documento aunque se haya retirado.
+    def release(self, doc_hash, document=None):
+        live = self._documents.get(doc_hash)
+        document = document or live
+        if document is None or (document is not live and not self._is_retired(document)):
+            return
+        document['refs'] -= 1
+        if document['refs'] <= 0:
+            self._evict(doc_hash, document)
+
+    def _evict(self, doc_hash, document=None):
+        retired = document is not None and self._documents.get(doc_hash) is not document
+        if retired:
+            self._retired = [d for d in self._retired if d is not document]
+        else:
+            document = self._documents.pop(doc_hash)
+        if document['spilled']:
+            self._remove_spill_files(document)
+        elif document['shared']:
+            document['pages'].close()
+        # Al liberar un documento retirado, lo asociado a su hash se conserva si el PDF
+        # se volvió a subir y sigue en uso
+        if self.on_evict and not (retired and (doc_hash in self._documents or doc_hash in self._pending)):
+            self.on_evict(doc_hash)
+        logger.info(f"Documento {doc_hash[:12]} liberado")
+
+    # Documentos en memoria, incluidos los retirados
+    def _resident_documents(self):
+        return list(self._documents.values()) + self._retired
+
+    def _is_retired(self, document):
+        return any(d is document for d in self._retired)
+
+    def _holds(self, document):
+        return self._documents.get(document['hash']) is document or self._is_retired(document)
+
+    # Memoria de los documentos residentes más la de los índices y las sesiones, que nunca se vuelcan
+    def resident_bytes(self):
+        documents = sum(d['indexBytes'] + (0 if d['spilled'] else d['memoryBytes']) for d in self._resident_documents())
+        return documents + (self.session_bytes() if self.session_bytes else 0)
+
+    # Volcar a disco los documentos usados hace más tiempo hasta respetar el presupuesto.
+    # Los que aún se están extrayendo no se vuelcan: sus páginas siguen llegando.
+    async def enforce_budget(self):
+        resident = self.resident_bytes()
+        if resident <= self.max_bytes:
+            return
+        candidates = sorted(
+            (d for d in self._resident_documents()
+             if not d['spilled'] and not d['shared'] and not d.get('spilling') and not d.get('ingestion')),
+            key=lambda d: d['lastAccess']
+        )
+        for document in candidates:
+            if resident <= self.max_bytes:
+                break
+            resident -= await self.spill(document)
+
+    # Función para volcar un documento a disco; devuelve los bytes liberados
+    async def spill(self, document):
+        document['spilling'] = True
+        try:
+            pdf_path, pages_path = await asyncio.to_thread(
+                self._write_spill_files, document['hash'], document['buffer'], document['pages']
+            )
+        except OSError as error:
+            logger.error(f"No se pudo volcar el documento {document['hash'][:12]} a disco: {error}")
+            return 0
+        finally:
+            document['spilling'] = False
+
+        if not self._holds(document):
+            # El documento se liberó mientras se escribía
+            for path in (pdf_path, pages_path):
+                os.remove(path)
+            return 0
+
+        # Los procesos de renderizado abren el PDF desde la ruta en disco
+        document['buffer'] = pdf_path
+        document['pages'] = MappedPages(pages_path)
+        document['spilled'] = True
+        self.spills += 1
+        logger.info(f"Documento {document['hash'][:12]} volcado a disco ({document['memoryBytes'] / 1024 / 1024:.1f} MB liberados)")
+        return document['memoryBytes']
+
+    def _write_spill_files(self, doc_hash, buffer, pages):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        base = os.path.join(self.spill_dir, f"{doc_hash}-{os.getpid()}")
+        with open(base + '.pdf', 'wb') as f:
+            f.write(buffer)
+        write_pages_file(base + '.pages', pages)
+        return base + '.pdf', base + '.pages'
+
+    def _remove_spill_files(self, document):
+        document['pages'].close()
+        for path in (document['buffer'], document['pages'].path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self._documents)
+
+    def stats(self):
+        documents = self._resident_documents()
+        return {
+            'documents': len(documents),
+            'retiredDocuments': len(self._retired),
+            'references': sum(d['refs'] for d in documents),
+            'hits': self.hits,
+            'misses': self.misses,
+            'residentBytes': self.resident_bytes(),
+            'indexBytes': sum(d['indexBytes'] for d in documents),
+            'sessionBytes': self.session_bytes() if self.session_bytes else 0,
+            'maxBytes': self.max_bytes,
+            'spilledDocuments': sum(1 for d in documents if d['spilled']),
+            'spills': self.spills
+        }
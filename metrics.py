@@ -0,0 +1,226 @@
+import os
+import time
+import bisect
+import contextvars
+from contextlib import contextmanager
+
+# Añadir a cada respuesta la cabecera Server-Timing con el tiempo de cada etapa
+METRICS_TIMING_HEADER = os.getenv('METRICS_TIMING_HEADER', 'false').lower() == 'true'
+
+# Límites (segundos) de los histogramas de latencia
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+# Límites (bytes) de los histogramas de tamaño
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Tiempos por etapa de la petición en curso (para la cabecera Server-Timing)
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+# Función para formatear las etiquetas de una serie en el formato de Prometheus
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in items) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Contador que solo crece (por ejemplo, llamadas al modelo o bytes enviados)
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, key, None, value
+
+
+# Valor instantáneo que se lee en el momento de exportar (por ejemplo, sesiones activas).
+# `read` devuelve un número o un diccionario {valor de la etiqueta: número}.
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, read, labelname=None):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        self.labelname = labelname
+
+    def samples(self):
+        value = self.read()
+        if self.labelname is None:
+            yield self.name, (), None, value
+            return
+        for label, item in sorted(value.items()):
+            yield self.name, ((self.labelname, label),), None, item
+
+
+# Histograma acumulativo con límites fijos
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series['counts'][index] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    # Medir la duración de un bloque de código
+    @contextmanager
+    def time(self, timing=None, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, **labels)
+            if timing:
+                record_timing(timing, elapsed)
+
+    def samples(self):
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                yield self.name + '_bucket', key, ('le', format_value(float(bound))), cumulative
+            yield self.name + '_bucket', key, ('le', '+Inf'), series['count']
+            yield self.name + '_sum', key, None, series['sum']
+            yield self.name + '_count', key, None, series['count']
+
+
+# Registro de métricas exportadas en /metrics
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, read, labelname=None):
+        return self.register(Gauge(name, help_text, read, labelname))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    # Función para exportar todas las métricas en el formato de texto de Prometheus
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, extra, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels, extra)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Métricas de las etapas del procesamiento
+extract_page_seconds = registry.histogram(
+    'briefly_extract_page_seconds', 'Tiempo de extracción por página y etapa (text, classify)', ('stage',))
+extract_document_seconds = registry.histogram(
+    'briefly_extract_document_seconds', 'Tiempo total de extracción de un PDF')
+ingest_ready_seconds = registry.histogram(
+    'briefly_ingest_ready_seconds', 'Tiempo hasta que un PDF se puede usar (primer bloque extraído)')
+render_page_seconds = registry.histogram(
+    'briefly_render_page_seconds', 'Tiempo de renderizado por página y etapa (render, encode)', ('stage',))
+scheduler_wait_seconds = registry.histogram(
+    'briefly_scheduler_wait_seconds', 'Espera de turno en el planificador de llamadas al modelo', ('priority',))
+model_call_seconds = registry.histogram(
+    'briefly_model_call_seconds', 'Duración de las llamadas al modelo', ('kind', 'outcome'))
+model_first_token_seconds = registry.histogram(
+    'briefly_model_first_token_seconds', 'Tiempo hasta el primer fragmento en las respuestas en streaming', ('kind',))
+model_payload_bytes = registry.histogram(
+    'briefly_model_payload_bytes', 'Bytes enviados al modelo por llamada (texto e imágenes)', ('kind',), SIZE_BUCKETS)
+model_payload_bytes_total = registry.counter(
+    'briefly_model_payload_bytes_total', 'Bytes enviados al modelo', ('kind', 'part'))
+context_upload_bytes_total = registry.counter(
+    'briefly_context_upload_bytes_total', 'Bytes de imágenes de página registrados una vez en el backend del modelo')
+context_reused_bytes_total = registry.counter(
+    'briefly_context_reused_bytes_total', 'Bytes de imágenes citados por identificador en lugar de reenviarse')
+model_retries_total = registry.counter(
+    'briefly_model_retries_total', 'Reintentos de llamadas al modelo tras un error transitorio', ('kind',))
+model_hedges_total = registry.counter(
+    'briefly_model_hedges_total', 'Peticiones duplicadas al modelo por latencia alta, según cuál respondió antes', ('kind', 'winner'))
+model_circuit_rejections_total = registry.counter(
+    'briefly_model_circuit_rejections_total', 'Llamadas rechazadas con el circuito del modelo abierto', ('kind',))
+text_cleanup_chars_total = registry.counter(
+    'briefly_text_cleanup_chars_total', 'Caracteres del texto de las páginas antes (raw) y después (clean) de la limpieza', ('stage',))
+prompt_truncated_chars_total = registry.counter(
+    'briefly_prompt_truncated_chars_total', 'Caracteres de texto omitidos por superar el presupuesto de una llamada', ('kind',))
+conversation_compactions_total = registry.counter(
+    'briefly_conversation_compactions_total', 'Condensaciones del historial de conversación en un resumen', ('outcome',))
+admission_rejections_total = registry.counter(
+    'briefly_admission_rejections_total', 'Peticiones rechazadas por el control de admisión', ('reason',))
+http_request_seconds = registry.histogram(
+    'briefly_http_request_seconds', 'Duración de las peticiones HTTP', ('method', 'endpoint', 'status'))
+
+
+# Función para registrar el tiempo de una etapa en la petición en curso
+def record_timing(name, seconds):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+# Función para empezar a acumular los tiempos por etapa de una petición
+def start_request_timings():
+    _request_timings.set({})
+
+
+# Función para construir la cabecera Server-Timing de la petición en curso
+def server_timing_header(total):
+    timings = _request_timings.get() or {}
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+
+# Función para medir los bytes de las partes enviadas al modelo (texto, imágenes
+# incrustadas y referencias a archivos ya registrados en el backend)
+def observe_payload(kind, parts):
+    if isinstance(parts, str):
+        parts = [{'text': parts}]
+    # Conversación de varios turnos: se cuentan las partes de todos los turnos
+    parts = [part for content in parts for part in (content['parts'] if 'role' in content else [content])]
+    text_bytes = sum(len(part['text'].encode('utf-8')) for part in parts if 'text' in part)
+    image_bytes = sum(len(part['inline_data']['data']) for part in parts if 'inline_data' in part)
+    file_bytes = sum(len(part['file_data']['file_uri']) for part in parts if 'file_data' in part)
+    model_payload_bytes.observe(text_bytes + image_bytes + file_bytes, kind=kind)
+    model_payload_bytes_total.inc(text_bytes, kind=kind, part='text')
+    model_payload_bytes_total.inc(image_bytes, kind=kind, part='image')
+    model_payload_bytes_total.inc(file_bytes, kind=kind, part='file')
@@ -0,0 +1,150 @@
+import io
+import os
+import uuid
+import random
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger('Briefly-pdf')
+
+GEMINI_MODEL_NAME = "gemini-1.5-flash"  # Usar solo este modelo
+
+STUB_WORDS = (
+    "el documento describe los resultados principales del estudio y resume los datos de cada sección "
+    "incluye tablas gráficos y conclusiones sobre el análisis realizado en las páginas indicadas"
+).split()
+
+
+# Fallo simulado del modelo; se comporta como un error 503 (transitorio) de la API
+class StubModelError(Exception):
+    code = 503
+
+
+# Respuesta del modelo simulado (misma interfaz que la de Gemini: atributo `text`)
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+# Respuesta en streaming del modelo simulado: entrega el texto por fragmentos
+class StubStream:
+    def __init__(self, chunks, delay):
+        self._chunks = chunks
+        self._delay = delay
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._delay)
+            yield StubResponse(chunk)
+
+
+# Modelo local simulado para desarrollo, pruebas de carga y benchmarks sin gastar
+# cuota de la API. La latencia, la variación, la tasa de fallos y la cola de
+# respuestas lentas son configurables, y la secuencia de tiempos y errores es
+# reproducible para una misma semilla.
+class StubModel:
+    def __init__(self, latency=None, jitter=None, failure_rate=None, response_words=None, seed=None,
+                 slow_rate=None, slow_latency=None):
+        self.latency = float(os.getenv('STUB_LATENCY', 1.0)) if latency is None else latency
+        self.jitter = float(os.getenv('STUB_JITTER', 0.2)) if jitter is None else jitter
+        self.failure_rate = float(os.getenv('STUB_FAILURE_RATE', 0)) if failure_rate is None else failure_rate
+        # Proporción de respuestas lentas (cola de latencia) y su latencia
+        self.slow_rate = float(os.getenv('STUB_SLOW_RATE', 0)) if slow_rate is None else slow_rate
+        self.slow_latency = float(os.getenv('STUB_SLOW_LATENCY', 10.0)) if slow_latency is None else slow_latency
+        self.response_words = int(os.getenv('STUB_RESPONSE_WORDS', 80)) if response_words is None else response_words
+        self._random = random.Random(int(os.getenv('STUB_SEED', 42)) if seed is None else seed)
+        self.calls = 0
+
+    # Función para simular la duración y el resultado de una llamada
+    def _plan_call(self):
+        self.calls += 1
+        delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        if self._random.random() < self.slow_rate:
+            delay = self.slow_latency
+        fails = self._random.random() < self.failure_rate
+        return delay, fails
+
+    # Función para generar un texto determinista a partir de la petición
+    def _answer(self, parts):
+        if isinstance(parts, str):
+            parts = [{'text': parts}]
+        parts = [part for content in parts for part in (content['parts'] if 'role' in content else [content])]
+        prompt = ''.join(part.get('text', '') for part in parts)
+        images = sum(1 for part in parts if 'inline_data' in part or 'file_data' in part)
+        digest = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16)
+        words = [STUB_WORDS[(digest >> i) % len(STUB_WORDS)] for i in range(self.response_words)]
+        return f"[Respuesta simulada: {len(prompt)} caracteres y {images} imágenes recibidos] " + ' '.join(words) + '.'
+
+    async def generate_content_async(self, parts, stream=False):
+        delay, fails = self._plan_call()
+        text = self._answer(parts)
+        if stream:
+            # La latencia se reparte entre el primer fragmento y el resto
+            await asyncio.sleep(delay / 2)
+            if fails:
+                raise StubModelError("Fallo simulado del modelo")
+            words = text.split(' ')
+            chunks = [' '.join(words[i:i + 8]) + ' ' for i in range(0, len(words), 8)]
+            return StubStream(chunks, delay / 2 / max(1, len(chunks)))
+        await asyncio.sleep(delay)
+        if fails:
+            raise StubModelError("Fallo simulado del modelo")
+        return StubResponse(text)
+
+
+# Función para crear el modelo según MODEL_BACKEND ('gemini' o 'stub').
+# Devuelve (modelo, nombre del modelo); el nombre forma parte de las claves de caché.
+def create_model(backend=None):
+    backend = (backend or os.getenv('MODEL_BACKEND', 'gemini')).lower()
+    if backend == 'stub':
+        model = StubModel()
+        logger.warning(f"Usando el modelo simulado (latencia {model.latency}s ± {model.jitter}s, "
+                       f"fallos {model.failure_rate:.0%}); no se llama a Gemini")
+        return model, 'stub'
+
+    if backend != 'gemini':
+        raise ValueError(f"MODEL_BACKEND no válido: {backend}. Usa 'gemini' o 'stub'")
+
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        logger.error("No se encontró la API KEY de Gemini. Verifica tu archivo .env")
+        raise ValueError("GEMINI_API_KEY no está configurada en el archivo .env")
+
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name=GEMINI_MODEL_NAME), GEMINI_MODEL_NAME
+
+
+# Archivos del modelo simulado: guarda en memoria el tamaño de cada archivo subido
+# y devuelve identificadores locales, como haría la API de archivos de Gemini
+class StubFileStore:
+    def __init__(self):
+        self.files = {}
+
+    async def upload(self, data, mime_type):
+        name = f"files/{uuid.uuid4().hex}"
+        self.files[name] = len(data)
+        return {'name': name, 'uri': f"stub://{name}"}
+
+    async def delete(self, name):
+        self.files.pop(name, None)
+
+
+# Archivos subidos a la API de archivos de Gemini: cada imagen se sube una vez y
+# las llamadas posteriores la citan por su URI (Gemini los conserva 48 horas)
+class GeminiFileStore:
+    async def upload(self, data, mime_type):
+        import google.generativeai as genai
+        uploaded = await asyncio.to_thread(genai.upload_file, io.BytesIO(data), mime_type=mime_type)
+        return {'name': uploaded.name, 'uri': uploaded.uri}
+
+    async def delete(self, name):
+        import google.generativeai as genai
+        await asyncio.to_thread(genai.delete_file, name)
+
+
+# Función para crear el almacén de archivos del backend configurado en MODEL_BACKEND
+def create_file_store(backend=None):
+    backend = (backend or os.getenv('MODEL_BACKEND', 'gemini')).lower()
+    return StubFileStore() if backend == 'stub' else GeminiFileStore()
@@ -0,0 +1,97 @@
+import os
+import re
+import math
+import heapq
+import unicodedata
+from collections import Counter
+
+# Número de páginas que se envían al modelo en las preguntas generales sobre el documento
+PAGE_INDEX_TOP_K = max(1, int(os.getenv('PAGE_INDEX_TOP_K', 4)))
+
+# Palabras vacías (español e inglés) que no aportan a la búsqueda
+STOPWORDS = frozenset("""
+    a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales cuando de del desde
+    donde dos el ella ellas ellos en entre era es esa esas ese eso esos esta estas este esto estos fue ha hay
+    la las le les lo los mas me mi mis muy no nos o os para pero por que quien se sea segun ser si sin sobre
+    son su sus tambien te tiene tu un una uno unos y ya
+    about an and are as at be by for from has have in is it its of on or that the their this to was were
+    what when which who why with
+    dice dicen documento pagina paginas explica habla
+""".split())
+
+TOKEN_REGEX = re.compile(r'\w+')
+
+
+# Función para dividir un texto en términos normalizados (minúsculas, sin tildes ni palabras vacías)
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [
+        token for token in TOKEN_REGEX.findall(text)
+        if len(token) > 1 and token not in STOPWORDS and not token.isdigit()
+    ]
+
+
+# Índice invertido BM25 de las páginas de un documento. Se construye de forma
+# incremental (las páginas se pueden añadir por tandas) y se consulta sin
+# llamar al modelo, para enviarle solo las páginas relevantes.
+class PageIndex:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # término -> {índice de página: frecuencia}
+        self.lengths = {}   # índice de página -> número de términos
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # Añadir (o reemplazar) el texto de una página
+    def add_page(self, page_index, text):
+        if page_index in self.lengths:
+            self.remove_page(page_index)
+        counts = Counter(tokenize(text))
+        for term, frequency in counts.items():
+            self.postings.setdefault(term, {})[page_index] = frequency
+        length = sum(counts.values())
+        self.lengths[page_index] = length
+        self.total_length += length
+
+    def add_pages(self, pages, start=0):
+        for offset, page in enumerate(pages):
+            self.add_page(start + offset, page.text)
+
+    def remove_page(self, page_index):
+        self.total_length -= self.lengths.pop(page_index)
+        for term in [t for t, pages in self.postings.items() if page_index in pages]:
+            del self.postings[term][page_index]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    # Buscar las `k` páginas más relevantes; devuelve [(índice de página, puntuación)]
+    def search(self, query, k=PAGE_INDEX_TOP_K):
+        total_pages = len(self.lengths)
+        if not total_pages:
+            return []
+        average_length = self.total_length / total_pages or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            pages = self.postings.get(term)
+            if not pages:
+                continue
+            idf = math.log(1 + (total_pages - len(pages) + 0.5) / (len(pages) + 0.5))
+            for page_index, frequency in pages.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[page_index] / average_length)
+                scores[page_index] = scores.get(page_index, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    # Estimación aproximada de la memoria del índice (bytes)
+    def memory_bytes(self):
+        return sum(len(term) + 64 + 48 * len(pages) for term, pages in self.postings.items())
+
+
+# Función para construir el índice de todas las páginas de un documento
+def build_page_index(pages):
+    index = PageIndex()
+    index.add_pages(pages)
+    return index
@@ -0,0 +1,598 @@
+import os
+import time
+import asyncio
+import logging
+import contextlib
+import itertools
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
+
+import fitz  # PyMuPDF
+
+from metrics import extract_page_seconds, extract_document_seconds, ingest_ready_seconds, render_page_seconds, text_cleanup_chars_total, record_timing
+from text_cleanup import TEXT_CLEANUP, PageCleaner
+
+try:
+    import PIL  # noqa: F401  Pillow es opcional: solo se usa para codificar WebP
+    HAS_PILLOW = True
+except ImportError:
+    HAS_PILLOW = False
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Número de procesos para extraer PDFs (por defecto, uno por núcleo)
+PDF_WORKERS = max(1, int(os.getenv('PDF_WORKERS', os.cpu_count() or 1)))
+# Mínimo de páginas por tarea para que el coste de abrir el documento compense
+PDF_MIN_PAGES_PER_TASK = max(1, int(os.getenv('PDF_MIN_PAGES_PER_TASK', 4)))
+# Páginas de cada tanda de la extracción incremental: el documento se puede usar en
+# cuanto se extrae la primera tanda y el resto se añade en segundo plano
+INGEST_CHUNK_PAGES = max(PDF_MIN_PAGES_PER_TASK, int(os.getenv('INGEST_CHUNK_PAGES', 32)))
+# Tamaño máximo (en MB) de la caché de páginas renderizadas
+RENDER_CACHE_MB = float(os.getenv('RENDER_CACHE_MB', 64))
+# Formato (png, jpeg o webp), calidad y resolución de las imágenes de página
+PAGE_IMAGE_FORMAT = os.getenv('PAGE_IMAGE_FORMAT', 'png').lower()
+PAGE_IMAGE_QUALITY = int(os.getenv('PAGE_IMAGE_QUALITY', 80))
+PAGE_IMAGE_DPI = int(os.getenv('PAGE_IMAGE_DPI', 86))  # 86 dpi ≈ escala 1.2
+
+# Modo de envío de imágenes: 'auto' omite las páginas solo texto, 'always' las envía todas
+PAGE_IMAGES_MODE = os.getenv('PAGE_IMAGES_MODE', 'auto').lower()
+# Umbrales para considerar que una página tiene contenido visual
+VISUAL_MIN_DRAWINGS = int(os.getenv('VISUAL_MIN_DRAWINGS', 8))
+VISUAL_MIN_TEXT_COVERAGE = float(os.getenv('VISUAL_MIN_TEXT_COVERAGE', 0.05))
+
+# Presupuesto de cada bloque: caracteres de texto, páginas con imagen y páginas
+BLOCK_MAX_CHARS = int(os.getenv('BLOCK_MAX_CHARS', 8000))
+BLOCK_MAX_IMAGES = int(os.getenv('BLOCK_MAX_IMAGES', 3))
+BLOCK_MAX_PAGES = max(1, int(os.getenv('BLOCK_MAX_PAGES', 12)))
+# Nivel máximo del índice (outline) del PDF cuyas entradas empiezan un bloque nuevo (0 lo ignora)
+BLOCK_OUTLINE_LEVEL = int(os.getenv('BLOCK_OUTLINE_LEVEL', 1))
+
+IMAGE_MIME_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp'
+}
+
+if PAGE_IMAGE_FORMAT == 'webp' and not HAS_PILLOW:
+    logger.warning("PAGE_IMAGE_FORMAT=webp requiere Pillow; se usará JPEG")
+
+# Pool de procesos compartido (se crea la primera vez que se necesita)
+_executor = None
+_executor_workers = 0
+
+
+# Función para obtener (o crear) el pool de procesos de extracción
+def get_executor(workers=None):
+    global _executor, _executor_workers
+    workers = workers or PDF_WORKERS
+    if _executor is not None and _executor_workers != workers:
+        _executor.shutdown(wait=False)
+        _executor = None
+    if _executor is None:
+        if multiprocessing.current_process().daemon:
+            # Los workers de Hypercorn (WEB_WORKERS > 1) son procesos daemon y no pueden
+            # crear procesos hijos; el reparto entre núcleos lo hacen los propios workers.
+            # PyMuPDF no es seguro entre hilos, así que se usa un único hilo por worker.
+            _executor = ThreadPoolExecutor(max_workers=1)
+            logger.warning(f"Proceso daemon: la extracción de PDF usa un solo hilo en este worker "
+                           f"en lugar de {workers} procesos (PyMuPDF no es seguro entre hilos)")
+        else:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+            logger.info(f"Pool de extracción de PDF iniciado con {workers} procesos")
+        _executor_workers = workers
+    return _executor
+
+
+# Función para cerrar el pool de procesos
+def shutdown_executor():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+        _executor_workers = 0
+
+
+# Registro compacto del texto de una página
+class PageRecord:
+    __slots__ = ('page_number', 'text', 'has_visual')
+
+    def __init__(self, page_number, text, has_visual=True):
+        self.page_number = page_number
+        self.text = text
+        self.has_visual = has_visual
+
+
+# Imagen renderizada de una página: se guardan los bytes tal cual, sin base64.
+# La codificación para Gemini ocurre al serializar la petición.
+class PageImage:
+    __slots__ = ('data', 'mime_type')
+
+    def __init__(self, data, mime_type):
+        self.data = data
+        self.mime_type = mime_type
+
+    def __len__(self):
+        return len(self.data)
+
+    # Parte lista para enviar al modelo
+    def to_part(self):
+        return {'inline_data': {'data': self.data, 'mime_type': self.mime_type}}
+
+
+# Función para codificar un pixmap con el formato configurado
+def encode_pixmap(pix, image_format=None, quality=None):
+    image_format = image_format or PAGE_IMAGE_FORMAT
+    quality = quality or PAGE_IMAGE_QUALITY
+    if image_format == 'webp':
+        if HAS_PILLOW:
+            return PageImage(pix.pil_tobytes(format='WEBP', quality=quality), IMAGE_MIME_TYPES['webp'])
+        image_format = 'jpeg'
+    if image_format in ('jpeg', 'jpg'):
+        return PageImage(pix.tobytes('jpeg', jpg_quality=quality), IMAGE_MIME_TYPES['jpeg'])
+    return PageImage(pix.tobytes('png'), IMAGE_MIME_TYPES['png'])
+
+
+# Función para abrir un PDF desde sus bytes o desde la ruta de un documento volcado a disco
+def open_document(source):
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+# Función para contar las páginas de un PDF (se ejecuta en el pool)
+def count_pages(buffer):
+    with open_document(buffer) as doc:
+        return len(doc)
+
+
+# Función para obtener las páginas (índices) donde empieza cada capítulo del índice del PDF (se ejecuta en el pool)
+def outline_starts(buffer, max_level=None):
+    max_level = BLOCK_OUTLINE_LEVEL if max_level is None else max_level
+    if max_level <= 0:
+        return []
+    with open_document(buffer) as doc:
+        toc = doc.get_toc(simple=True)
+    # Cada entrada es [nivel, título, página]; la página es 1-based y -1 si no apunta a ninguna
+    return sorted({page - 1 for level, _, page in toc if level <= max_level and page > 0})
+
+
+# Función para estimar qué fracción de la página ocupa el texto
+def text_coverage(page):
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    text_area = sum(
+        abs(fitz.Rect(block[:4]))
+        for block in page.get_text("blocks")
+        if block[6] == 0  # 0 = bloque de texto, 1 = bloque de imagen
+    )
+    return min(1.0, text_area / page_area)
+
+
+# Función para decidir si una página tiene contenido visual que el modelo debe ver.
+# Las páginas de solo texto se envían únicamente como texto.
+def classify_page(page):
+    if page.get_images(full=False):
+        return True
+    drawings = len(page.get_drawings())
+    if drawings >= VISUAL_MIN_DRAWINGS:
+        return True
+    # Diagramas sencillos con pocas etiquetas
+    return drawings > 0 and text_coverage(page) < VISUAL_MIN_TEXT_COVERAGE
+
+
+# Función que extrae el texto de un rango de páginas dentro de un proceso del pool.
+# Cada proceso abre su propia copia del documento: los objetos de PyMuPDF no se
+# pueden compartir entre procesos. Las imágenes se renderizan más tarde, solo
+# cuando hacen falta (ver get_page_images).
+# Si se pasa `timings`, se añade el tiempo de cada etapa por página.
+def extract_page_range(buffer, start, end, timings=None) -> List[PageRecord]:
+    pages = []
+    with open_document(buffer) as doc:
+        for i in range(start, end):
+            page = doc[i]
+            started = time.perf_counter()
+            text = page.get_text()
+            extracted = time.perf_counter()
+            has_visual = classify_page(page)
+            if timings is not None:
+                timings['text'].append(extracted - started)
+                timings['classify'].append(time.perf_counter() - extracted)
+            pages.append(PageRecord(i + 1, text, has_visual))
+    return pages
+
+
+# Variante para el pool que devuelve también los tiempos por página (el proceso
+# principal los registra en las métricas)
+def extract_page_range_timed(buffer, start, end):
+    timings = {'text': [], 'classify': []}
+    return extract_page_range(buffer, start, end, timings), timings
+
+
+# Función que renderiza páginas concretas con el formato configurado (se ejecuta en el pool)
+def render_page_images(buffer, page_indices, dpi=None, image_format=None, quality=None, timings=None) -> List[PageImage]:
+    images = []
+    with open_document(buffer) as doc:
+        for i in page_indices:
+            started = time.perf_counter()
+            pix = doc[i].get_pixmap(dpi=dpi or PAGE_IMAGE_DPI)
+            rendered = time.perf_counter()
+            images.append(encode_pixmap(pix, image_format, quality))
+            if timings is not None:
+                timings['render'].append(rendered - started)
+                timings['encode'].append(time.perf_counter() - rendered)
+    return images
+
+
+def render_page_images_timed(buffer, page_indices):
+    timings = {'render': [], 'encode': []}
+    return render_page_images(buffer, page_indices, timings=timings), timings
+
+
+# Función para registrar en las métricas los tiempos por página devueltos por el pool
+def observe_stage_timings(histogram, timings):
+    for stage, values in timings.items():
+        for value in values:
+            histogram.observe(value, stage=stage)
+
+
+# Caché LRU de páginas renderizadas, limitada por el tamaño total en bytes
+class RenderCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        image = self._items.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        size = len(image)
+        if size > self.max_bytes:
+            return
+        if key in self._items:
+            self.current_bytes -= len(self._items.pop(key))
+        self._items[key] = image
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.current_bytes -= len(evicted)
+
+    # Eliminar todas las páginas de un documento
+    def invalidate(self, doc_key):
+        for key in [k for k in self._items if k[0] == doc_key]:
+            self.current_bytes -= len(self._items.pop(key))
+
+    def stats(self):
+        return {
+            'entries': len(self._items),
+            'bytes': self.current_bytes,
+            'maxBytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+render_cache = RenderCache(int(RENDER_CACHE_MB * 1024 * 1024))
+
+
+# Función para obtener las imágenes de varias páginas, renderizando solo las que no están en caché
+async def get_page_images(doc_key, buffer, page_indices) -> List[PageImage]:
+    images = {}
+    missing = []
+    for i in page_indices:
+        image = render_cache.get((doc_key, i))
+        if image is None:
+            missing.append(i)
+        else:
+            images[i] = image
+
+    if missing:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        rendered, timings = await loop.run_in_executor(get_executor(), render_page_images_timed, buffer, missing)
+        record_timing('render', time.perf_counter() - started)
+        observe_stage_timings(render_page_seconds, timings)
+        for i, image in zip(missing, rendered):
+            render_cache.put((doc_key, i), image)
+            images[i] = image
+        logger.info(f"Renderizadas {len(missing)} páginas bajo demanda ({len(page_indices) - len(missing)} desde caché)")
+
+    return [images[i] for i in page_indices]
+
+
+# Contadores de partes de imagen enviadas y omitidas por el modo solo texto
+image_part_stats = {
+    'sent': 0,
+    'skipped': 0
+}
+
+
+# Función para obtener las partes de imagen de unas páginas para el modelo.
+# En modo 'auto' solo se incluyen las páginas con contenido visual. Con una caché
+# de contexto, las imágenes se citan por su identificador en el backend del modelo
+# (con `register=False`, solo las que ya estaban registradas o se piden por segunda vez).
+async def get_page_parts(doc_key, buffer, pages, page_indices, force_images=False, context_cache=None, register=True):
+    page_indices = list(page_indices)
+    if force_images or PAGE_IMAGES_MODE == 'always':
+        selected = page_indices
+    else:
+        selected = [i for i in page_indices if pages[i].has_visual]
+
+    image_part_stats['sent'] += len(selected)
+    image_part_stats['skipped'] += len(page_indices) - len(selected)
+
+    if not selected:
+        return []
+    if context_cache is None:
+        images = await get_page_images(doc_key, buffer, selected)
+        return [image.to_part() for image in images]
+    # Las páginas que ya tienen un archivo registrado se citan sin volver a renderizarlas
+    parts = context_cache.registered_parts(doc_key, selected)
+    missing = [i for i in selected if i not in parts]
+    if missing:
+        images = await get_page_images(doc_key, buffer, missing)
+        parts.update(zip(missing, await context_cache.get_parts(doc_key, missing, images, register)))
+    return [parts[i] for i in selected]
+
+
+# Función para agrupar páginas consecutivas en bloques según el presupuesto de texto
+# e imágenes. Una página que por sí sola supera el presupuesto forma su propio bloque,
+# y cada capítulo del índice empieza un bloque nuevo. Devuelve rangos (inicio, fin)
+# de índices de página, con el fin excluido.
+def plan_blocks(pages, chapter_starts=(), max_chars=None, max_images=None, max_pages=None) -> List[Tuple[int, int]]:
+    planner = BlockPlanner(chapter_starts, max_chars, max_images, max_pages)
+    planner.add(pages)
+    return planner.finish()
+
+
+# Planificador de bloques incremental: recibe las páginas por tandas y cierra cada
+# bloque en cuanto llega la primera página que ya no cabe en él, así que el
+# resultado es el mismo que planificar todas las páginas de una vez
+class BlockPlanner:
+    def __init__(self, chapter_starts=(), max_chars=None, max_images=None, max_pages=None):
+        self.chapter_starts = set(chapter_starts)
+        self.max_chars = max_chars or BLOCK_MAX_CHARS
+        self.max_images = max_images or BLOCK_MAX_IMAGES
+        self.max_pages = max_pages or BLOCK_MAX_PAGES
+        self.all_images = PAGE_IMAGES_MODE == 'always'
+        self.blocks = []
+        self.pages = 0   # páginas recibidas
+        self.start = 0   # primera página del bloque abierto
+        self.chars = self.images = 0
+
+    def add(self, pages):
+        for page in pages:
+            i = self.pages
+            page_chars = len(page.text.strip())
+            page_images = 1 if self.all_images or page.has_visual else 0
+            if i > self.start and (
+                i in self.chapter_starts
+                or i - self.start >= self.max_pages
+                or self.chars + page_chars > self.max_chars
+                or self.images + page_images > self.max_images
+            ):
+                self.blocks.append((self.start, i))
+                self.start = i
+                self.chars = self.images = 0
+            self.chars += page_chars
+            self.images += page_images
+            self.pages += 1
+
+    # Cerrar el último bloque (cuando ya no llegarán más páginas)
+    def finish(self):
+        if self.pages > self.start:
+            self.blocks.append((self.start, self.pages))
+            self.start = self.pages
+        return self.blocks
+
+
+# Función que identifica la configuración del planificador (para las claves de caché)
+def block_plan_signature():
+    return f"{BLOCK_MAX_CHARS}:{BLOCK_MAX_IMAGES}:{BLOCK_MAX_PAGES}:{BLOCK_OUTLINE_LEVEL}:{PAGE_IMAGES_MODE}:{int(TEXT_CLEANUP)}"
+
+
+# Función para dividir las páginas en tandas para la extracción incremental: la
+# primera tiene las páginas que puede ocupar el primer bloque más una (la que lo
+# cierra) y las demás, `chunk_pages` páginas
+def ingest_page_ranges(total_pages, chunk_pages=None) -> List[Tuple[int, int]]:
+    chunk_pages = chunk_pages or INGEST_CHUNK_PAGES
+    ranges = []
+    start, end = 0, min(total_pages, BLOCK_MAX_PAGES + 1)
+    while start < total_pages:
+        ranges.append((start, end))
+        start, end = end, min(total_pages, end + chunk_pages)
+    return ranges
+
+
+# Extracción incremental de un PDF en segundo plano. Las tandas de páginas se
+# extraen en el pool y se incorporan en orden: limpieza del texto, planificación
+# de bloques y `on_pages(inicio, páginas)` (por ejemplo, para añadirlas al índice).
+# El documento puede usarse en cuanto está planificado el primer bloque; quien
+# necesite páginas o bloques posteriores espera con wait_for_pages/wait_for_block.
+# `pages` y `blocks` son listas que crecen a medida que avanza la extracción.
+class PdfIngestion:
+    def __init__(self, buffer, workers=None, on_pages=None, chunk_pages=None):
+        self.buffer = buffer
+        self.workers = workers or PDF_WORKERS
+        self.on_pages = on_pages
+        self.chunk_pages = chunk_pages or INGEST_CHUNK_PAGES
+        self.total_pages = 0
+        self.pages = []
+        self.planner = BlockPlanner()
+        self.blocks = self.planner.blocks
+        self.cleaner = PageCleaner() if TEXT_CLEANUP else None
+        self.finished = False
+        self.error = None
+        self.task = None
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self.first_block_seconds = None
+        self._futures = deque()   # tandas encargadas al pool, en orden
+        self._changed = asyncio.Event()
+
+    # Iniciar la extracción en segundo plano. `slot` es un gestor de contexto asíncrono
+    # opcional que se mantiene durante toda la extracción (el turno de procesamiento).
+    def start(self, slot=None):
+        self.task = asyncio.ensure_future(self.run(slot))
+        return self.task
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+    # Ejecutar la extracción completa. Los errores no se propagan: quedan en `error`
+    # y despiertan a quien esté esperando páginas.
+    async def run(self, slot=None):
+        try:
+            async with slot or contextlib.nullcontext():
+                await self._extract()
+        except asyncio.CancelledError:
+            for future in self._futures:
+                future.cancel()
+            raise
+        except Exception as error:
+            logger.error(f'Error al procesar el PDF: {error}')
+            self.error = error
+            for future in self._futures:
+                future.cancel()
+            # Las páginas ya extraídas tras el último bloque cerrado forman el último bloque
+            self.planner.finish()
+        finally:
+            self.finished = True
+            self.elapsed = time.perf_counter() - self.started
+            # Los bytes del PDF siguen en el documento; la extracción ya no los necesita
+            self.buffer = None
+            self._notify()
+
+    async def _extract(self):
+        executor = get_executor(self.workers)
+        loop = asyncio.get_running_loop()
+        self.started = time.perf_counter()
+
+        self.total_pages, chapter_starts = await asyncio.gather(
+            loop.run_in_executor(executor, count_pages, self.buffer),
+            loop.run_in_executor(executor, outline_starts, self.buffer)
+        )
+        self.planner.chapter_starts = set(chapter_starts)
+        ranges = ingest_page_ranges(self.total_pages, self.chunk_pages)
+        logger.info(f"Procesando PDF con {self.total_pages} páginas en {len(ranges)} tandas ({self.workers} procesos)")
+
+        # Como mucho una tanda por proceso en el pool: la siguiente se encarga al terminar
+        # otra, de modo que la primera tanda de otro PDF subido mientras tanto no espera
+        # a todas las de este. Las tandas se incorporan al documento en orden.
+        pending = iter(ranges)
+        for start, end in itertools.islice(pending, self.workers):
+            self._futures.append(loop.run_in_executor(executor, extract_page_range_timed, self.buffer, start, end))
+        while self._futures:
+            chunk, timings = await self._futures[0]
+            self._futures.popleft()
+            for start, end in itertools.islice(pending, 1):
+                self._futures.append(loop.run_in_executor(executor, extract_page_range_timed, self.buffer, start, end))
+            observe_stage_timings(extract_page_seconds, timings)
+            await self._commit(chunk)
+
+        elapsed = time.perf_counter() - self.started
+        extract_document_seconds.observe(elapsed)
+        record_timing('extract', elapsed)
+        if self.cleaner:
+            cleanup = self.cleaner.report
+            logger.info(f"Texto limpio: {cleanup['rawChars']} -> {cleanup['cleanChars']} caracteres "
+                        f"({cleanup['boilerplateLines']} encabezados o pies repetidos)")
+        logger.info(f"{len(self.pages)}/{self.total_pages} páginas procesadas en {elapsed:.2f} segundos; "
+                    f"{len(self.blocks)} bloques planificados ({len(chapter_starts)} capítulos en el índice)")
+
+    # Incorporar una tanda de páginas al documento
+    async def _commit(self, chunk):
+        start = len(self.pages)
+        # El texto se limpia una sola vez por documento: lo comparten el índice, la
+        # planificación de bloques y todos los prompts
+        if self.cleaner:
+            raw_chars = sum(len(page.text) for page in chunk)
+            cleaned = await asyncio.to_thread(self.cleaner.clean, [page.text for page in chunk], start + 1)
+            for page, text in zip(chunk, cleaned):
+                page.text = text
+            text_cleanup_chars_total.inc(raw_chars, stage='raw')
+            text_cleanup_chars_total.inc(sum(len(text) for text in cleaned), stage='clean')
+        self.pages.extend(chunk)
+        self.planner.add(chunk)
+        if len(self.pages) == self.total_pages:
+            self.planner.finish()
+        if self.on_pages:
+            self.on_pages(start, chunk)
+        if self.first_block_seconds is None and self.blocks:
+            self.first_block_seconds = time.perf_counter() - self.started
+            ingest_ready_seconds.observe(self.first_block_seconds)
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    # Esperar a que estén extraídas las páginas [0, end); devuelve False si la
+    # extracción terminó (o falló) sin llegar a ellas
+    async def wait_for_pages(self, end):
+        while len(self.pages) < end and not self.finished:
+            await self._changed.wait()
+        return len(self.pages) >= end
+
+    # Esperar a que esté planificado el bloque `index`; devuelve False si el
+    # documento no tiene ese bloque o la extracción falló antes de llegar a él
+    async def wait_for_block(self, index):
+        while len(self.blocks) <= index and not self.finished:
+            await self._changed.wait()
+        return len(self.blocks) > index
+
+    # Esperar a que termine la extracción; devuelve False si falló
+    async def wait(self):
+        while not self.finished:
+            await self._changed.wait()
+        return self.error is None
+
+    # Número de bloques estimado: los planificados más los que se esperan para las
+    # páginas que faltan, al mismo ritmo de páginas por bloque
+    def estimated_blocks(self):
+        covered = self.planner.start
+        remaining = self.total_pages - covered
+        if self.finished or not self.blocks or remaining <= 0:
+            return len(self.blocks)
+        return len(self.blocks) + max(1, round(remaining * len(self.blocks) / covered))
+
+    def progress(self):
+        return {
+            'pagesReady': len(self.pages),
+            'totalPages': self.total_pages,
+            'blocksReady': len(self.blocks),
+            'estimatedBlocks': self.estimated_blocks(),
+            'done': self.finished and self.error is None,
+            'error': str(self.error) if self.error else None,
+            'seconds': round(self.elapsed if self.elapsed is not None else time.perf_counter() - self.started, 3),
+            'firstBlockSeconds': round(self.first_block_seconds, 3) if self.first_block_seconds is not None else None
+        }
+
+    def result(self):
+        return {
+            'totalPages': self.total_pages,
+            'pages': self.pages,
+            'blocks': self.blocks,
+            'cleanup': self.cleaner.report if self.cleaner else None
+        }
+
+
+# Función para extraer el texto del PDF completo sin bloquear el event loop
+async def extract_pdf_contents(buffer, workers=None):
+    ingestion = PdfIngestion(buffer, workers)
+    await ingestion.run()
+    if ingestion.error:
+        raise Exception(f'No se pudo procesar el archivo PDF: {str(ingestion.error)}')
+    return ingestion.result()
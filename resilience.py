@@ -0,0 +1,269 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+from metrics import model_retries_total, model_hedges_total, model_circuit_rejections_total
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Reintentos ante errores transitorios (sobrecarga, errores 5xx, tiempo agotado)
+MODEL_RETRIES = max(0, int(os.getenv('MODEL_RETRIES', 2)))
+# Espera antes del primer reintento (se duplica en cada uno, con variación aleatoria) y espera máxima
+MODEL_RETRY_BASE_DELAY = float(os.getenv('MODEL_RETRY_BASE_DELAY', 0.5))
+MODEL_RETRY_MAX_DELAY = float(os.getenv('MODEL_RETRY_MAX_DELAY', 8))
+# Tiempo máximo de cada intento; el tiempo total de la llamada sigue limitado por su timeout
+MODEL_ATTEMPT_TIMEOUT = float(os.getenv('MODEL_ATTEMPT_TIMEOUT', 30))
+# Percentil de latencia a partir del cual se lanza una petición duplicada (0 lo desactiva)
+MODEL_HEDGE_PERCENTILE = float(os.getenv('MODEL_HEDGE_PERCENTILE', 0))
+# Latencias observadas necesarias antes de empezar a duplicar peticiones
+MODEL_HEDGE_MIN_SAMPLES = int(os.getenv('MODEL_HEDGE_MIN_SAMPLES', 20))
+# Fallos consecutivos que abren el circuito y segundos que permanece abierto
+CIRCUIT_FAILURE_THRESHOLD = max(1, int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30))
+
+# Errores de la API que indican un problema transitorio del servicio
+RETRYABLE_ERROR_NAMES = {
+    'ServiceUnavailable', 'ResourceExhausted', 'TooManyRequests', 'InternalServerError',
+    'DeadlineExceeded', 'GatewayTimeout', 'BadGateway', 'Aborted'
+}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+
+# El circuito está abierto: el modelo falló repetidamente y no se le envían llamadas
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"El servicio del modelo no está disponible temporalmente; "
+                         f"vuelve a intentarlo en {int(retry_after) + 1} segundos")
+        self.retry_after = retry_after
+
+
+# Función para decidir si un error del modelo es transitorio (merece reintento)
+def is_retryable(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    return getattr(error, 'code', None) in RETRYABLE_STATUS_CODES
+
+
+# Función para describir al usuario un error del modelo
+def describe_error(error):
+    if isinstance(error, CircuitOpenError):
+        return str(error)
+    if is_retryable(error):
+        return f"El servicio del modelo no respondió correctamente tras varios intentos ({error})"
+    return str(error)
+
+
+# Interruptor de circuito: tras CIRCUIT_FAILURE_THRESHOLD fallos transitorios
+# consecutivos rechaza las llamadas durante CIRCUIT_RESET_TIMEOUT segundos; después
+# deja pasar una llamada de prueba y se cierra si tiene éxito.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self._probing = False
+
+    # Lanzar CircuitOpenError si no se debe llamar al modelo. Con `probe`, la llamada
+    # ocupa la prueba del circuito semiabierto; devuelve True si la ha ocupado.
+    def check(self, probe=True):
+        if self.state == CIRCUIT_CLOSED:
+            return False
+        waited = time.monotonic() - self.opened_at
+        if self.state == CIRCUIT_OPEN and waited >= self.reset_timeout:
+            self.state = CIRCUIT_HALF_OPEN
+            self._probing = False
+        if self.state == CIRCUIT_HALF_OPEN and not self._probing:
+            if probe:
+                self._probing = True  # Solo una llamada de prueba a la vez
+            return probe
+        raise CircuitOpenError(max(0.0, self.reset_timeout - waited))
+
+    def record_success(self):
+        if self.state != CIRCUIT_CLOSED:
+            logger.info("Circuito del modelo cerrado: el servicio responde de nuevo")
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CIRCUIT_OPEN:
+                logger.warning(f"Circuito del modelo abierto tras {self.failures} fallos; "
+                               f"se rechazan las llamadas durante {self.reset_timeout:.0f} s")
+                self.opened += 1
+            self.state = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    # Liberar la llamada de prueba si terminó sin informar del estado del servicio
+    def release_probe(self):
+        if self.state == CIRCUIT_HALF_OPEN:
+            self._probing = False
+
+
+# Latencias recientes de las llamadas con éxito, por tipo de llamada
+class LatencyTracker:
+    def __init__(self, size=200):
+        self.size = size
+        self._samples = {}
+
+    def add(self, kind, seconds):
+        self._samples.setdefault(kind, deque(maxlen=self.size)).append(seconds)
+
+    def percentile(self, kind, q):
+        samples = self._samples.get(kind)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def count(self, kind):
+        return len(self._samples.get(kind, ()))
+
+
+# Capa de llamadas al modelo con reintentos (espera exponencial con variación
+# aleatoria), peticiones duplicadas cuando la primera tarda más que el percentil
+# configurado y un interruptor de circuito compartido por todas las llamadas.
+#
+# `attempt(timeout)` es una función que hace una llamada al modelo respetando el
+# tiempo máximo indicado; la capa la invoca una vez por intento (y por duplicado).
+# La petición duplicada ocupa su propio turno de `scheduler` (ver
+# ModelScheduler.try_acquire) y no se lanza si no hay ninguno libre, de modo que
+# nunca se supera la concurrencia máxima.
+class ResilientCaller:
+    def __init__(self, retries=MODEL_RETRIES, base_delay=MODEL_RETRY_BASE_DELAY, max_delay=MODEL_RETRY_MAX_DELAY,
+                 attempt_timeout=MODEL_ATTEMPT_TIMEOUT, hedge_percentile=MODEL_HEDGE_PERCENTILE,
+                 hedge_min_samples=MODEL_HEDGE_MIN_SAMPLES, breaker=None, scheduler=None):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.scheduler = scheduler
+        self.latencies = LatencyTracker()
+        self.counters = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedgesWon': 0, 'hedgesSkipped': 0, 'rejected': 0, 'failures': 0}
+        self._random = random.Random()
+
+    # Comprobar el circuito antes de esperar turno en el planificador. No ocupa la
+    # llamada de prueba: la ocupa `call`, ya con el turno concedido.
+    def check(self, kind, probe=False):
+        try:
+            return self.breaker.check(probe)
+        except CircuitOpenError:
+            self.counters['rejected'] += 1
+            model_circuit_rejections_total.inc(kind=kind)
+            raise
+
+    async def call(self, attempt, timeout, kind, hedge=False):
+        self.counters['calls'] += 1
+        probe = self.check(kind, probe=True)
+        reported = False
+        deadline = time.monotonic() + timeout
+        try:
+            for number in range(self.retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                started = time.monotonic()
+                try:
+                    attempt_timeout = min(self.attempt_timeout, remaining)
+                    if hedge:
+                        result = await self._hedged(attempt, attempt_timeout, kind)
+                    else:
+                        result = await attempt(attempt_timeout)
+                except Exception as error:
+                    if not is_retryable(error):
+                        raise
+                    self.counters['failures'] += 1
+                    self.breaker.record_failure()
+                    reported = True
+                    delay = min(self.max_delay, self.base_delay * 2 ** number) * self._random.uniform(0.5, 1.0)
+                    last = number == self.retries or self.breaker.state == CIRCUIT_OPEN
+                    if last or time.monotonic() + delay >= deadline:
+                        raise
+                    logger.warning(f"Llamada al modelo ({kind}) fallida: {error}. Reintento {number + 1} en {delay:.1f} s")
+                    self.counters['retries'] += 1
+                    model_retries_total.inc(kind=kind)
+                    await asyncio.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                reported = True
+                self.latencies.add(kind, time.monotonic() - started)
+                return result
+        finally:
+            # Liberar la prueba si la llamada terminó (cancelada, sin tiempo o con un
+            # error no transitorio) sin informar del estado del servicio
+            if probe and not reported:
+                self.breaker.release_probe()
+
+    # Lanzar una segunda petición si la primera supera el percentil de latencia;
+    # gana la primera que responde bien y la otra se cancela
+    async def _hedged(self, attempt, timeout, kind):
+        threshold = None
+        if self.hedge_percentile > 0 and self.latencies.count(kind) >= self.hedge_min_samples:
+            threshold = self.latencies.percentile(kind, self.hedge_percentile)
+        if threshold is None or threshold >= timeout:
+            return await attempt(timeout)
+
+        started = time.monotonic()
+        primary = asyncio.ensure_future(attempt(timeout))
+        tasks = [primary]
+        # Cualquier petición sin terminar se cancela al salir, también si se cancela
+        # al llamador (su turno del planificador se libera al volver)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=threshold)
+            if done:
+                return primary.result()
+
+            if self.scheduler is not None and not self.scheduler.try_acquire():
+                # Sin turno libre: seguir esperando sólo a la primera petición
+                self.counters['hedgesSkipped'] += 1
+                return await primary
+            self.counters['hedges'] += 1
+            backup = asyncio.ensure_future(attempt(max(0.001, timeout - (time.monotonic() - started))))
+            if self.scheduler is not None:
+                # El turno se devuelve cuando la petición duplicada termina de verdad
+                backup.add_done_callback(lambda _: self.scheduler.release())
+            tasks.append(backup)
+            pending = {primary, backup}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        won = task is backup
+                        if won:
+                            self.counters['hedgesWon'] += 1
+                        model_hedges_total.inc(kind=kind, winner='hedge' if won else 'primary')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return dict(
+            self.counters,
+            circuit=self.breaker.state,
+            circuitOpened=self.breaker.opened,
+            consecutiveFailures=self.breaker.failures,
+            maxRetries=self.retries,
+            hedgePercentile=self.hedge_percentile
+        )
@@ -0,0 +1,148 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+import unicodedata
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Ruta de la base de datos SQLite de la caché (vacía para desactivarla)
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', os.path.join(os.getcwd(), 'cache', 'responses.sqlite3'))
+# Tiempo de vida de cada entrada (segundos) y tamaño máximo de la caché (MB)
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+RESPONSE_CACHE_MAX_MB = float(os.getenv('RESPONSE_CACHE_MAX_MB', 100))
+
+
+# Función para normalizar una pregunta: minúsculas, sin tildes, espacios y
+# puntuación final unificados, para que variantes triviales compartan entrada
+def normalize_question(question):
+    text = unicodedata.normalize('NFKD', question.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.strip('¿?¡!.,;: ')
+
+
+# Función para construir la clave de una entrada a partir de sus componentes
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# Caché persistente en SQLite para resúmenes y respuestas ya pagados a Gemini.
+# Sobrevive a reinicios y despliegues; las entradas caducan por TTL y, si se
+# supera el tamaño máximo, se eliminan primero las menos usadas recientemente.
+class ResponseCache:
+    def __init__(self, path, ttl=RESPONSE_CACHE_TTL, max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024)):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats_by_kind = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created REAL NOT NULL,
+                        accessed REAL NOT NULL
+                    )
+                """)
+                self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+                self._conn.commit()
+            except sqlite3.Error as error:
+                logger.error(f"No se pudo abrir la caché de respuestas en {path}: {error}")
+                self._conn = None
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    def _count(self, kind, hit):
+        counters = self.stats_by_kind.setdefault(kind, {'hits': 0, 'misses': 0})
+        counters['hits' if hit else 'misses'] += 1
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now - self.ttl:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def _put(self, key, kind, value):
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, kind, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, kind, value, size, now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    # Eliminar entradas caducadas y, si hace falta, las menos usadas recientemente
+    def _evict(self, now):
+        self._conn.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        evicted = 0
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+            if excess <= 0:
+                break
+            self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            excess -= size
+            evicted += 1
+        logger.info(f"Caché de respuestas: {evicted} entradas eliminadas por tamaño")
+
+    async def get(self, kind, key):
+        if not self.enabled:
+            return None
+        try:
+            value = await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as error:
+            logger.error(f"Error al leer la caché de respuestas: {error}")
+            value = None
+        self._count(kind, value is not None)
+        return value
+
+    async def put(self, kind, key, value):
+        if not self.enabled:
+            return
+        try:
+            await asyncio.to_thread(self._put, key, kind, value)
+        except sqlite3.Error as error:
+            logger.error(f"Error al escribir en la caché de respuestas: {error}")
+
+    def stats(self):
+        stats = {'enabled': self.enabled}
+        for kind, counters in self.stats_by_kind.items():
+            lookups = counters['hits'] + counters['misses']
+            stats[kind] = dict(counters, hitRatio=round(counters['hits'] / lookups, 3) if lookups else 0.0)
+        return stats
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
@@ -0,0 +1,174 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metrics import scheduler_wait_seconds, record_timing
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Número máximo de llamadas simultáneas al modelo
+MODEL_CONCURRENCY = max(1, int(os.getenv('MODEL_CONCURRENCY', 4)))
+
+# Clases de prioridad (menor número = mayor prioridad)
+PRIORITY_INTERACTIVE = 0  # Preguntas del usuario
+PRIORITY_BACKGROUND = 1   # Resúmenes de bloques en segundo plano
+PRIORITY_PREFETCH = 2     # Resúmenes anticipados
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BACKGROUND: 'background',
+    PRIORITY_PREFETCH: 'prefetch'
+}
+
+
+# Planificador central de llamadas al modelo. Limita la concurrencia global,
+# atiende primero las clases de mayor prioridad y, dentro de cada clase,
+# reparte los turnos entre sesiones por turno rotatorio para que una sesión con
+# muchos bloques pendientes no haga esperar a las demás.
+class ModelScheduler:
+    def __init__(self, concurrency=MODEL_CONCURRENCY):
+        self.concurrency = concurrency
+        self.active = 0
+        # prioridad -> {sesión: cola de futuros}, en orden de turno
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        # clave de la llamada -> futuro en espera (para promover una llamada concreta)
+        self._keys = {}
+        self._metrics = {
+            priority: {'granted': 0, 'waitTotal': 0.0, 'waitMax': 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    # Reservar un turno para llamar al modelo. `key` identifica la llamada (por
+    # ejemplo, el bloque que se resume) para poder promoverla mientras espera.
+    @asynccontextmanager
+    async def slot(self, session_id=None, priority=PRIORITY_INTERACTIVE, key=None):
+        queued_at = time.monotonic()
+        await self._acquire(session_id, priority, key)
+        self._record_wait(priority, time.monotonic() - queued_at)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, session_id, priority, key=None):
+        if self.active < self.concurrency and self.queue_depth() == 0:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        sessions = self._queues[priority]
+        sessions.setdefault(session_id, deque()).append(future)
+        if key is not None:
+            self._keys[key] = future
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # El turno ya se había concedido: devolverlo
+                self._release()
+            else:
+                self._discard(priority, session_id, future)
+            raise
+        finally:
+            if key is not None and self._keys.get(key) is future:
+                del self._keys[key]
+
+    # Reservar un turno sólo si hay uno libre y nadie espera (sin bloquear);
+    # lo usan las peticiones duplicadas, que no deben hacer cola
+    def try_acquire(self):
+        if self.active < self.concurrency and self.queue_depth() == 0:
+            self.active += 1
+            return True
+        return False
+
+    # Devolver un turno obtenido con try_acquire
+    def release(self):
+        self._release()
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    # Conceder turnos libres a la siguiente sesión de la clase más prioritaria
+    def _dispatch(self):
+        while self.active < self.concurrency:
+            future = self._next_waiter()
+            if future is None:
+                return
+            self.active += 1
+            future.set_result(None)
+
+    def _next_waiter(self):
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            while sessions:
+                session_id, waiters = next(iter(sessions.items()))
+                future = waiters.popleft()
+                # Rotar la sesión al final para repartir los turnos
+                del sessions[session_id]
+                if waiters:
+                    sessions[session_id] = waiters
+                if not future.cancelled():
+                    return future
+        return None
+
+    def _discard(self, priority, session_id, future):
+        # El turno pudo haberse promovido a otra clase (ver promote)
+        for sessions in self._queues.values():
+            waiters = sessions.get(session_id)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del sessions[session_id]
+                return
+
+    # Subir a `priority` el turno en espera de la llamada `key` de una sesión si está en
+    # una clase menos prioritaria (por ejemplo, el resumen anticipado de un bloque que
+    # el usuario ya pidió); los demás turnos de la sesión no cambian de clase
+    def promote(self, session_id, priority, key):
+        future = self._keys.get(key)
+        if future is None:
+            return
+        for lower in sorted(self._queues):
+            if lower <= priority:
+                continue
+            waiters = self._queues[lower].get(session_id)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._queues[lower][session_id]
+                self._queues[priority].setdefault(session_id, deque()).append(future)
+                return
+
+    def _record_wait(self, priority, waited):
+        metrics = self._metrics[priority]
+        metrics['granted'] += 1
+        metrics['waitTotal'] += waited
+        metrics['waitMax'] = max(metrics['waitMax'], waited)
+        scheduler_wait_seconds.observe(waited, priority=PRIORITY_NAMES[priority])
+        record_timing('queue', waited)
+
+    def queue_depth(self, priority=None):
+        priorities = [priority] if priority is not None else self._queues
+        return sum(len(waiters) for p in priorities for waiters in self._queues[p].values())
+
+    def stats(self):
+        classes = {}
+        for priority, name in PRIORITY_NAMES.items():
+            metrics = self._metrics[priority]
+            granted = metrics['granted']
+            classes[name] = {
+                'queued': self.queue_depth(priority),
+                'granted': granted,
+                'avgWaitSeconds': round(metrics['waitTotal'] / granted, 3) if granted else 0.0,
+                'maxWaitSeconds': round(metrics['waitMax'], 3)
+            }
+        return {
+            'concurrency': self.concurrency,
+            'active': self.active,
+            'queued': self.queue_depth(),
+            'classes': classes
+        }
@@ -0,0 +1,47 @@
+import json
+import asyncio
+
+
+# Función para formatear un evento con el protocolo Server-Sent Events
+def format_sse(event, data):
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+# Bus de eventos por sesión: cada pestaña abierta se suscribe con su propia cola
+# y recibe los eventos de bloques ("block_started", "block_ready", "error")
+# en cuanto se producen, sin necesidad de sondear el servidor.
+class SessionEventBus:
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, session_id):
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, session_id, queue):
+        queues = self._subscribers.get(session_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[session_id]
+
+    def publish(self, session_id, event, data):
+        for queue in self._subscribers.get(session_id, ()):
+            queue.put_nowait((event, data))
+
+    # Cerrar los flujos abiertos de una sesión eliminada
+    def close(self, session_id):
+        for queue in self._subscribers.pop(session_id, ()):
+            queue.put_nowait(None)
+
+    def session_ids(self):
+        return list(self._subscribers)
+
+    def stats(self):
+        return {
+            'sessions': len(self._subscribers),
+            'streams': sum(len(queues) for queues in self._subscribers.values())
+        }
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from document_store import MappedPages, write_pages_file
+
+logger = logging.getLogger('Briefly-pdf')
+
+# Dónde se guarda el estado de las sesiones: 'memory' (un solo proceso) o 'sqlite'
+# (compartido entre varios workers de Hypercorn en la misma máquina)
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory').lower()
+# Base de datos SQLite con las sesiones, el bloque actual de cada una y los resúmenes
+SESSION_STATE_PATH = os.getenv('SESSION_STATE_PATH', os.path.join(os.getcwd(), 'cache', 'sessions.sqlite3'))
+# Directorio compartido con el PDF y el texto de cada documento, para que cualquier
+# worker pueda atender una sesión creada en otro
+SHARED_DOCUMENT_DIR = os.getenv('SHARED_DOCUMENT_DIR', os.path.join(os.getcwd(), 'cache', 'documents'))
+
+
+# Estado de las sesiones en memoria del proceso. Es la opción por defecto: con un
+# solo worker los documentos ya están en el DocumentStore y no hace falta copiarlos.
+#
+# Cada sesión es un registro con los campos name, docHash, totalPages, timestamp,
+# lastAccess, lastBlock y lastSent. Los resúmenes se guardan por documento con la
+# clave del bloque (índice desde 0) o 'document' para el resumen completo.
+# El historial de la conversación de cada sesión solo se guarda en el estado
+# compartido, para que otro worker pueda continuarla.
+class MemorySessionState:
+    shared = False
+
+    def __init__(self):
+        self._sessions = {}
+        self._summaries = {}
+
+    async def save_session(self, session_id, record):
+        self._sessions[session_id] = dict(record)
+
+    async def load_session(self, session_id):
+        record = self._sessions.get(session_id)
+        return dict(record) if record else None
+
+    async def touch_session(self, session_id, last_access):
+        if session_id in self._sessions:
+            self._sessions[session_id]['lastAccess'] = last_access
+
+    async def update_control(self, session_id, last_block, last_sent):
+        if session_id in self._sessions:
+            self._sessions[session_id].update(lastBlock=last_block, lastSent=last_sent)
+
+    # Eliminar una sesión; devuelve True si existía
+    async def delete_session(self, session_id):
+        record = self._sessions.pop(session_id, None)
+        if record and not any(r['docHash'] == record['docHash'] for r in self._sessions.values()):
+            self._summaries.pop(record['docHash'], None)
+        return record is not None
+
+    async def expired_sessions(self, idle_limit):
+        return [session_id for session_id, r in self._sessions.items() if r['lastAccess'] < idle_limit]
+
+    async def save_summary(self, doc_hash, key, text):
+        self._summaries.setdefault(doc_hash, {})[key] = text
+
+    async def load_summaries(self, doc_hash):
+        return dict(self._summaries.get(doc_hash, {}))
+
+    async def save_document(self, doc_hash, document):
+        pass
+
+    # En memoria la conversación solo vive en el worker (ver conversation.py)
+    async def save_conversation(self, session_id, data):
+        pass
+
+    async def load_conversation(self, session_id):
+        return None
+
+    async def load_document(self, doc_hash):
+        return None
+
+    def stats(self):
+        return {'backend': 'memory', 'sessions': len(self._sessions)}
+
+    def close(self):
+        pass
+
+
+# Estado de las sesiones compartido entre procesos: metadatos, bloque actual y
+# resúmenes en SQLite (modo WAL) y, por documento, el PDF y su texto en un
+# directorio compartido. Un worker que recibe una sesión creada en otro la carga
+# desde aquí; el texto se lee mediante mmap, sin copiarlo a la memoria del proceso.
+class SQLiteSessionState:
+    shared = True
+
+    def __init__(self, path=SESSION_STATE_PATH, document_dir=SHARED_DOCUMENT_DIR):
+        self.path = path
+        self.document_dir = document_dir
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        os.makedirs(document_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                doc_hash TEXT NOT NULL,
+                total_pages INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                last_block INTEGER NOT NULL,
+                last_sent REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_doc_hash ON sessions (doc_hash);
+            CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_hash TEXT PRIMARY KEY,
+                total_pages INTEGER NOT NULL,
+                blocks TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                doc_hash TEXT NOT NULL,
+                key TEXT NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (doc_hash, key)
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+        """)
+        self._conn.commit()
+
+    def _execute(self, sql, params=(), fetch=None):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            rows = cursor.fetchall() if fetch == 'all' else cursor.fetchone() if fetch == 'one' else None
+            self._conn.commit()
+            return rows
+
+    def _document_paths(self, doc_hash):
+        base = os.path.join(self.document_dir, doc_hash)
+        return base + '.pdf', base + '.pages'
+
+    async def save_session(self, session_id, record):
+        await asyncio.to_thread(
+            self._execute,
+            'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (session_id, record['name'], record['docHash'], record['totalPages'], record['timestamp'],
+             record['lastAccess'], record['lastBlock'], record['lastSent'])
+        )
+
+    async def load_session(self, session_id):
+        row = await asyncio.to_thread(
+            self._execute,
+            'SELECT name, doc_hash, total_pages, created, last_access, last_block, last_sent FROM sessions WHERE session_id = ?',
+            (session_id,), 'one'
+        )
+        if row is None:
+            return None
+        return dict(zip(('name', 'docHash', 'totalPages', 'timestamp', 'lastAccess', 'lastBlock', 'lastSent'), row))
+
+    async def touch_session(self, session_id, last_access):
+        await asyncio.to_thread(
+            self._execute, 'UPDATE sessions SET last_access = MAX(last_access, ?) WHERE session_id = ?',
+            (last_access, session_id)
+        )
+
+    async def update_control(self, session_id, last_block, last_sent):
+        await asyncio.to_thread(
+            self._execute, 'UPDATE sessions SET last_block = ?, last_sent = ? WHERE session_id = ?',
+            (last_block, last_sent, session_id)
+        )
+
+    # Eliminar una sesión; si era la última del documento se borran también su
+    # texto, su PDF y sus resúmenes. Devuelve True si la sesión existía.
+    async def delete_session(self, session_id):
+        return await asyncio.to_thread(self._delete_session, session_id)
+
+    def _delete_session(self, session_id):
+        with self._lock:
+            row = self._conn.execute('SELECT doc_hash FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                return False
+            doc_hash = row[0]
+            self._conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            self._conn.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,))
+            orphan = self._conn.execute('SELECT 1 FROM sessions WHERE doc_hash = ? LIMIT 1', (doc_hash,)).fetchone() is None
+            if orphan:
+                self._conn.execute('DELETE FROM documents WHERE doc_hash = ?', (doc_hash,))
+                self._conn.execute('DELETE FROM summaries WHERE doc_hash = ?', (doc_hash,))
+            self._conn.commit()
+        if orphan:
+            for path in self._document_paths(doc_hash):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return True
+
+    async def expired_sessions(self, idle_limit):
+        rows = await asyncio.to_thread(
+            self._execute, 'SELECT session_id FROM sessions WHERE last_access < ?', (idle_limit,), 'all'
+        )
+        return [row[0] for row in rows]
+
+    async def save_summary(self, doc_hash, key, text):
+        await asyncio.to_thread(
+            self._execute, 'INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)', (doc_hash, str(key), text)
+        )
+
+    async def load_summaries(self, doc_hash):
+        rows = await asyncio.to_thread(
+            self._execute, 'SELECT key, text FROM summaries WHERE doc_hash = ?', (doc_hash,), 'all'
+        )
+        return {key if key == 'document' else int(key): text for key, text in rows}
+
+    # Guardar el historial de la conversación de una sesión (resumen y turnos recientes)
+    async def save_conversation(self, session_id, data):
+        await asyncio.to_thread(
+            self._execute, 'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+            (session_id, json.dumps(data, ensure_ascii=False), data['updated'])
+        )
+
+    async def load_conversation(self, session_id):
+        row = await asyncio.to_thread(
+            self._execute, 'SELECT data FROM conversations WHERE session_id = ?', (session_id,), 'one'
+        )
+        return json.loads(row[0]) if row else None
+
+    # Guardar el PDF, el texto y la tabla de bloques de un documento (una sola vez por hash)
+    async def save_document(self, doc_hash, document):
+        exists = await asyncio.to_thread(
+            self._execute, 'SELECT 1 FROM documents WHERE doc_hash = ?', (doc_hash,), 'one'
+        )
+        if exists:
+            return
+        await asyncio.to_thread(self._write_document_files, doc_hash, document['buffer'], document['pages'])
+        await asyncio.to_thread(
+            self._execute, 'INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)',
+            (doc_hash, document['totalPages'], json.dumps(document['blocks']), time.time())
+        )
+
+    def _write_document_files(self, doc_hash, buffer, pages):
+        pdf_path, pages_path = self._document_paths(doc_hash)
+        # Escribir en archivos temporales y renombrar, para que otro worker nunca lea un archivo a medias
+        temporary = f".{os.getpid()}.tmp"
+        if isinstance(buffer, str):
+            with open(buffer, 'rb') as f:
+                buffer = f.read()
+        with open(pdf_path + temporary, 'wb') as f:
+            f.write(buffer)
+        write_pages_file(pages_path + temporary, pages)
+        os.replace(pdf_path + temporary, pdf_path)
+        os.replace(pages_path + temporary, pages_path)
+
+    # Cargar un documento guardado por otro worker: el PDF queda en disco (los
+    # procesos de renderizado lo abren desde la ruta) y el texto se mapea en memoria
+    async def load_document(self, doc_hash):
+        row = await asyncio.to_thread(
+            self._execute, 'SELECT total_pages, blocks FROM documents WHERE doc_hash = ?', (doc_hash,), 'one'
+        )
+        if row is None:
+            return None
+        pdf_path, pages_path = self._document_paths(doc_hash)
+        try:
+            pages = await asyncio.to_thread(MappedPages, pages_path)
+        except OSError as error:
+            logger.error(f"No se pudo abrir el documento compartido {doc_hash[:12]}: {error}")
+            return None
+        return {
+            'totalPages': row[0],
+            'pages': pages,
+            'blocks': [tuple(block) for block in json.loads(row[1])],
+            'buffer': pdf_path,
+            'shared': True
+        }
+
+    def stats(self):
+        row = self._execute('SELECT COUNT(*) FROM sessions', (), 'one')
+        documents = self._execute('SELECT COUNT(*) FROM documents', (), 'one')
+        return {'backend': 'sqlite', 'sessions': row[0], 'documents': documents[0]}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Función para crear el estado de las sesiones según SESSION_BACKEND
+def create_session_state(backend=SESSION_BACKEND):
+    if backend == 'memory':
+        return MemorySessionState()
+    if backend == 'sqlite':
+        logger.info(f"Estado de las sesiones compartido en {SESSION_STATE_PATH}")
+        return SQLiteSessionState()
+    raise ValueError(f"SESSION_BACKEND no válido: {backend}. Usa 'memory' o 'sqlite'")
@@ -7,6 +7,12 @@ document.addEventListener("DOMContentLoaded", () => {
   let isWaitingForBlockSummary = false;
   let blockSummaryRetries = 0;
   const MAX_RETRIES = 10;
+  let waitingBlock = null; // Bloque cuyo resumen se está esperando
+  let isWaitingForDocumentSummary = false; // Resumen completo en curso
+  let documentSummaryLevel = 0; // Último nivel de reducción anunciado
+  let eventSource = null; // Flujo de eventos de la sesión (Server-Sent Events)
+  let streamFallbackTimer = null;
+  const STREAM_FALLBACK_DELAY = 60000; // Si el flujo no entrega nada, volver al polling
   let isTyping = false; // Variable para controlar la animación de tipeo
 
   // Elementos DOM
@@ -19,6 +25,8 @@ document.addEventListener("DOMContentLoaded", () => {
   const clearButton = document.getElementById("clear-input");
   const sessionInfo = document.getElementById("session-info");
   const docNameElement = document.getElementById("doc-name");
+  const documentSelectContainer = document.getElementById("document-select-container");
+  const documentSelect = document.getElementById("document-select");
   const totalPagesElement = document.getElementById("total-pages");
   const totalBlocksElement = document.getElementById("total-blocks");
   const currentBlockElement = document.getElementById("current-block");
@@ -43,6 +51,7 @@ document.addEventListener("DOMContentLoaded", () => {
   <div class="commands-buttons">
     <button class="command-btn" data-command="obtener resumen">📄 Obtener resumen</button>
     <button class="command-btn" data-command="siguiente bloque">⏭️ Siguiente bloque</button>
+    <button class="command-btn" data-command="resumen completo">📚 Resumen completo</button>
     <button class="command-btn" data-command="bloque 1: resumen">📑 Bloque 1</button>
     <button class="command-btn" data-command="pagina 1: contenido">📃 Página 1</button>
   </div>
@@ -147,12 +156,13 @@ document.addEventListener("DOMContentLoaded", () => {
   themeSwitch.addEventListener("change", toggleDarkMode);
   downloadChatBtn.addEventListener("click", downloadConversation);
   clearChatBtn.addEventListener("click", clearConversation);
+  documentSelect.addEventListener("change", handleDocumentChange);
 
   // Función para manejar la selección de archivo
   function handleFileSelect(e) {
     const file = e.target.files[0];
     if (file) {
-      const fileName = file.name;
+      const fileName = e.target.files.length > 1 ? `${e.target.files.length} archivos seleccionados` : file.name;
       fileNameDisplay.textContent = fileName.length > 25 ? fileName.substring(0, 22) + "..." : fileName;
 
       // Animar el contenedor del archivo
@@ -170,13 +180,13 @@ document.addEventListener("DOMContentLoaded", () => {
   async function handleFormSubmit(e) {
     e.preventDefault();
 
-    const file = pdfFileInput.files[0];
-    if (!file) {
+    const files = Array.from(pdfFileInput.files);
+    if (!files.length) {
       showToast("Por favor selecciona un archivo PDF", "error");
       return;
     }
 
-    if (!file.name.toLowerCase().endsWith(".pdf")) {
+    if (files.some((file) => !file.name.toLowerCase().endsWith(".pdf"))) {
       showToast("Solo se permiten archivos PDF", "error");
       return;
     }
@@ -185,10 +195,10 @@ document.addEventListener("DOMContentLoaded", () => {
     loadingOverlay.classList.add("active");
 
     // Mostrar mensaje de carga inicial
-    addSystemMessage("Cargando y procesando el PDF...");
+    addSystemMessage(files.length > 1 ? `Cargando y procesando ${files.length} PDFs...` : "Cargando y procesando el PDF...");
 
     const formData = new FormData();
-    formData.append("files", file);
+    files.forEach((file) => formData.append("files", file));
 
     try {
       const response = await fetch("/api/query", {
@@ -206,6 +216,9 @@ document.addEventListener("DOMContentLoaded", () => {
         // Mostrar el contenedor de información de sesión
         sessionInfo.style.display = "block";
 
+        // En una carga por lotes, cada PDF tiene su propia sesión: permitir cambiar entre ellas
+        updateDocumentSelect(data.documents || []);
+
         // Verificar si el backend envía un array de mensajes o un solo mensaje
         if (Array.isArray(data.messages)) {
           // Si es un array, mostrar cada mensaje
@@ -224,12 +237,11 @@ document.addEventListener("DOMContentLoaded", () => {
         addSystemMessage("Puedes seguir interactuando con la aplicación mientras se genera el resumen.");
 
         // Actualizar los botones de comandos con datos reales
-        updateCommandButtons(data.totalBlocks || (data.totalPages ? Math.ceil(data.totalPages / 3) : 3));
+        updateCommandButtons(data.totalBlocks || 3);
 
-        // Iniciar un polling para obtener el resumen del primer bloque
-        isWaitingForBlockSummary = true;
-        blockSummaryRetries = 0;
-        setTimeout(getBlockSummary, 2000);
+        // Escuchar los eventos de la sesión y esperar el resumen del primer bloque
+        connectSessionEvents(currentSessionId);
+        waitForBlockSummary(1);
 
         // Mostrar toast de éxito
         showToast("PDF cargado correctamente", "success");
@@ -257,14 +269,14 @@ document.addEventListener("DOMContentLoaded", () => {
     const commandButtons = document.querySelector(".commands-buttons");
     if (!commandButtons) return;
 
-    // Mantener los primeros dos botones (obtener resumen y siguiente bloque)
-    const firstTwoButtons = Array.from(commandButtons.querySelectorAll("button")).slice(0, 2);
+    // Mantener los primeros tres botones (obtener resumen, siguiente bloque y resumen completo)
+    const fixedButtons = Array.from(commandButtons.querySelectorAll("button")).slice(0, 3);
 
     // Vaciar el contenedor
     commandButtons.innerHTML = "";
 
-    // Añadir los primeros dos botones
-    firstTwoButtons.forEach((btn) => commandButtons.appendChild(btn));
+    // Añadir los botones fijos
+    fixedButtons.forEach((btn) => commandButtons.appendChild(btn));
 
     // Añadir botones para bloques
     for (let i = 1; i <= Math.min(3, totalBlocks); i++) {
@@ -333,27 +345,7 @@ document.addEventListener("DOMContentLoaded", () => {
       const data = await response.json();
 
       if (data.success && data.isBlockSummary) {
-        // Actualizar el bloque actual en la información de sesión
-        if (currentBlockElement) {
-          currentBlockElement.textContent = data.block;
-
-          // Actualizar barra de progreso
-          if (data.totalBlocks) {
-            updateProgressBar(data.block, data.totalBlocks);
-          }
-        }
-
-        // Añadir el resumen al chat con animación de tipeo
-        addBotMessage(data.message, true);
-        saveToHistory("bot", data.message);
-
-        // Ya no necesitamos seguir esperando
-        isWaitingForBlockSummary = false;
-
-        // Mostrar mensaje informativo sobre cómo obtener más resúmenes
-        addSystemMessage(
-          'Para ver el resumen del siguiente bloque, escribe "siguiente bloque" o usa los botones de comandos',
-        );
+        showBlockSummary(data.block, data.message, data.totalBlocks);
       } else if (data.success) {
         // Si aún no está listo el resumen, seguir esperando
         if (blockSummaryRetries % 3 === 0) {
@@ -363,8 +355,9 @@ document.addEventListener("DOMContentLoaded", () => {
         setTimeout(getBlockSummary, 2000);
       } else {
         console.log("No se pudo obtener el resumen:", data.message);
-        // Aumentar el intervalo de reintento exponencialmente
-        const retryDelay = Math.min(3000 * Math.pow(1.5, blockSummaryRetries - 1), 10000);
+        // Esperar lo que indique el servidor si está saturado (429/503); si no, aumentar el intervalo exponencialmente
+        const retryAfter = Number(response.headers.get("Retry-After"));
+        const retryDelay = retryAfter > 0 ? retryAfter * 1000 : Math.min(3000 * Math.pow(1.5, blockSummaryRetries - 1), 10000);
         setTimeout(getBlockSummary, retryDelay);
       }
     } catch (error) {
@@ -375,6 +368,146 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  // Función para mostrar el resumen de un bloque recibido por polling o por eventos
+  function showBlockSummary(block, summary, totalBlocks) {
+    if (!isWaitingForBlockSummary) return;
+
+    // Ya no necesitamos seguir esperando
+    isWaitingForBlockSummary = false;
+    waitingBlock = null;
+    clearTimeout(streamFallbackTimer);
+
+    // Actualizar el bloque actual en la información de sesión
+    if (currentBlockElement) {
+      currentBlockElement.textContent = block;
+
+      // Actualizar barra de progreso
+      if (totalBlocks) {
+        updateProgressBar(block, totalBlocks);
+      }
+    }
+
+    // Añadir el resumen al chat con animación de tipeo
+    addBotMessage(summary, true);
+    saveToHistory("bot", summary);
+
+    // Mostrar mensaje informativo sobre cómo obtener más resúmenes
+    addSystemMessage(
+      'Para ver el resumen del siguiente bloque, escribe "siguiente bloque" o usa los botones de comandos',
+    );
+  }
+
+  // Función para empezar a esperar el resumen de un bloque. Si el flujo de eventos
+  // está disponible se espera al evento "block_ready"; si no, se usa polling.
+  function waitForBlockSummary(block) {
+    isWaitingForBlockSummary = true;
+    waitingBlock = Number(block);
+    blockSummaryRetries = 0;
+    clearTimeout(streamFallbackTimer);
+
+    if (eventSource && eventSource.readyState !== EventSource.CLOSED) {
+      streamFallbackTimer = setTimeout(getBlockSummary, STREAM_FALLBACK_DELAY);
+    } else {
+      setTimeout(getBlockSummary, 2000);
+    }
+  }
+
+  // Función para suscribirse a los eventos de la sesión (Server-Sent Events)
+  function connectSessionEvents(sessionId) {
+    closeSessionEvents();
+    if (!window.EventSource) return;
+
+    eventSource = new EventSource(`/api/sessions/${sessionId}/events`);
+
+    eventSource.addEventListener("block_started", (e) => {
+      const data = JSON.parse(e.data);
+      if (isWaitingForBlockSummary && data.block === waitingBlock) {
+        updateBlockInfo({ processingBlock: data.block });
+      }
+    });
+
+    eventSource.addEventListener("block_ready", (e) => {
+      const data = JSON.parse(e.data);
+      if (isWaitingForBlockSummary && data.block === waitingBlock) {
+        showBlockSummary(data.block, data.summary, data.totalBlocks);
+      }
+    });
+
+    // Progreso del resumen completo: primero los bloques, después cada nivel de combinación
+    eventSource.addEventListener("document_progress", (e) => {
+      const data = JSON.parse(e.data);
+      if (!isWaitingForDocumentSummary) return;
+      if (data.stage === "map") {
+        updateLoadingProgress(data.completed, data.total);
+      } else if (data.level > documentSummaryLevel) {
+        documentSummaryLevel = data.level;
+        addSystemMessage(`Combinando ${data.total > 1 ? data.total + " secciones" : "el resumen final"} (nivel ${data.level})...`);
+      }
+    });
+
+    // Avance del procesamiento del PDF en segundo plano: el total de bloques es una
+    // estimación hasta que se procesan todas las páginas
+    eventSource.addEventListener("ingestion", (e) => {
+      const data = JSON.parse(e.data);
+      if (totalBlocksElement && data.estimatedBlocks) totalBlocksElement.textContent = data.estimatedBlocks;
+      if (data.done) {
+        updateCommandButtons(data.estimatedBlocks || 3);
+      } else if (data.error) {
+        addSystemMessage(`No se pudo procesar el documento completo: ${data.error}`);
+      }
+    });
+
+    eventSource.addEventListener("document_ready", (e) => {
+      const data = JSON.parse(e.data);
+      if (isWaitingForDocumentSummary) {
+        isWaitingForDocumentSummary = false;
+        addBotMessage(data.summary, true);
+        saveToHistory("bot", data.summary);
+      }
+    });
+
+    eventSource.addEventListener("error", (e) => {
+      if (e.data) {
+        // Error enviado por el servidor al generar un resumen
+        const data = JSON.parse(e.data);
+        if (data.documentSummary) {
+          if (isWaitingForDocumentSummary) {
+            isWaitingForDocumentSummary = false;
+            addSystemMessage(data.message);
+            saveToHistory("system", data.message);
+          }
+          return;
+        }
+        if (isWaitingForBlockSummary && data.block === waitingBlock) {
+          isWaitingForBlockSummary = false;
+          waitingBlock = null;
+          clearTimeout(streamFallbackTimer);
+          const message = `${data.message} Escribe "obtener resumen" para intentar nuevamente.`;
+          addSystemMessage(message);
+          saveToHistory("system", message);
+        }
+        return;
+      }
+
+      // Error de conexión: si el navegador no va a reconectar, volver al polling
+      if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+        eventSource = null;
+        if (isWaitingForBlockSummary) {
+          clearTimeout(streamFallbackTimer);
+          setTimeout(getBlockSummary, 2000);
+        }
+      }
+    });
+  }
+
+  // Función para cerrar el flujo de eventos de la sesión anterior
+  function closeSessionEvents() {
+    if (eventSource) {
+      eventSource.close();
+      eventSource = null;
+    }
+  }
+
   // Add a new function to show loading progress for block summaries
   function updateLoadingProgress(current, total) {
     const percent = Math.round((current / total) * 100);
@@ -423,6 +556,8 @@ document.addEventListener("DOMContentLoaded", () => {
     try {
       const formData = new FormData();
       formData.append("query", query);
+      // Pedir la respuesta en streaming; los comandos siguen respondiendo en JSON
+      formData.append("stream", "true");
 
       if (currentSessionId) {
         formData.append("sessionId", currentSessionId);
@@ -433,27 +568,49 @@ document.addEventListener("DOMContentLoaded", () => {
         body: formData,
       });
 
-      const data = await response.json();
+      const contentType = response.headers.get("Content-Type") || "";
+      let data;
 
-      // Eliminar el indicador de escritura
-      if (typingIndicator) {
-        typingIndicator.remove();
+      if (contentType.includes("text/event-stream") && response.body) {
+        // Eliminar el indicador de escritura en cuanto empieza a llegar texto
+        if (typingIndicator) {
+          typingIndicator.remove();
+        }
+        data = await readStreamingResponse(response);
+      } else {
+        data = await response.json();
+
+        // Eliminar el indicador de escritura
+        if (typingIndicator) {
+          typingIndicator.remove();
+        }
       }
 
       if (data.success) {
-        // Añadir respuesta con animación de tipeo
-        addBotMessage(data.message, true);
+        // Añadir respuesta con animación de tipeo (si no se mostró ya en streaming)
+        if (!data.streamed) {
+          addBotMessage(data.message, true);
+        }
         saveToHistory("bot", data.message);
 
+        // Si el resumen completo sigue generándose, esperar el evento "document_ready"
+        if (data.documentSummaryPending) {
+          isWaitingForDocumentSummary = true;
+          documentSummaryLevel = 0;
+        }
+
         // Si la respuesta contiene información sobre bloques, actualizar
         if (data.processingBlock) {
           updateBlockInfo(data);
           updateProgressBar(data.processingBlock, data.totalBlocks);
 
-          // Si está procesando un bloque, iniciar polling para obtener el resumen
-          isWaitingForBlockSummary = true;
-          blockSummaryRetries = 0;
-          setTimeout(getBlockSummary, 2000);
+          // Si está procesando un bloque, esperar su resumen
+          waitForBlockSummary(data.processingBlock);
+        }
+
+        // Si la respuesta se basó en las páginas encontradas por el índice del documento
+        if (data.pages && data.pages.length) {
+          addSystemMessage(`Respuesta basada en las páginas ${data.pages.join(", ")}`);
         }
 
         // Si es una consulta sobre un bloque específico
@@ -489,6 +646,66 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  // Función para leer una respuesta en streaming (Server-Sent Events) y mostrar
+  // el texto a medida que llega. Devuelve el sobre final del evento "done".
+  async function readStreamingResponse(response) {
+    const messageDiv = document.createElement("div");
+    messageDiv.className = "message bot-message typing-text";
+    chatMessages.appendChild(messageDiv);
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let result = null;
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let separator;
+      while ((separator = buffer.indexOf("\n\n")) !== -1) {
+        const event = parseSseEvent(buffer.slice(0, separator));
+        buffer = buffer.slice(separator + 2);
+        if (!event) continue;
+
+        if (event.name === "chunk") {
+          messageDiv.textContent += event.data.text;
+          chatMessages.scrollTop = chatMessages.scrollHeight;
+        } else if (event.name === "done") {
+          result = event.data;
+        }
+      }
+    }
+
+    if (!result) {
+      result = { success: false, message: "La respuesta se interrumpió. Por favor intenta de nuevo." };
+    }
+
+    if (result.success) {
+      messageDiv.textContent = result.message;
+      result.streamed = true;
+    } else {
+      messageDiv.remove();
+    }
+    return result;
+  }
+
+  // Función para interpretar un evento SSE ("event: ...\ndata: ...")
+  function parseSseEvent(rawEvent) {
+    let name = "message";
+    const dataLines = [];
+    rawEvent.split("\n").forEach((line) => {
+      if (line.startsWith("event:")) {
+        name = line.slice(6).trim();
+      } else if (line.startsWith("data:")) {
+        dataLines.push(line.slice(5).trim());
+      }
+    });
+    if (dataLines.length === 0) return null;
+    return { name, data: JSON.parse(dataLines.join("\n")) };
+  }
+
   // Función para añadir indicador de "escribiendo..."
   function addTypingIndicator() {
     const typingDiv = document.createElement("div");
@@ -800,6 +1017,32 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  // Función para mostrar el selector de documentos de una carga por lotes
+  function updateDocumentSelect(documents) {
+    const loaded = documents.filter((doc) => doc.success);
+    documentSelect.innerHTML = "";
+    loaded.forEach((doc) => {
+      const option = document.createElement("option");
+      option.value = doc.sessionId;
+      option.textContent = doc.fileName;
+      documentSelect.appendChild(option);
+    });
+    documentSelect.value = currentSessionId;
+    documentSelectContainer.style.display = loaded.length > 1 ? "flex" : "none";
+  }
+
+  // Función para cambiar el documento activo entre los de una carga por lotes
+  function handleDocumentChange() {
+    const sessionId = documentSelect.value;
+    if (!sessionId || sessionId === currentSessionId) return;
+    isWaitingForBlockSummary = false;
+    isWaitingForDocumentSummary = false;
+    currentSessionId = sessionId;
+    updateSessionInfo({ sessionId });
+    connectSessionEvents(sessionId);
+    addSystemMessage(`Documento activo: ${documentSelect.options[documentSelect.selectedIndex].textContent}`);
+  }
+
   // Función para actualizar la barra de progreso
   function updateProgressBar(currentBlock, totalBlocks) {
     if (progressBar && currentBlock && totalBlocks) {
@@ -0,0 +1,74 @@
+import io
+import os
+import sys
+import asyncio
+
+os.environ.setdefault('MODEL_BACKEND', 'stub')
+os.environ.setdefault('RESPONSE_CACHE_PATH', '')
+os.environ.setdefault('INGEST_CHUNK_PAGES', '8')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from quart.datastructures import FileStorage
+
+import app as A
+from pdf_processing import PdfIngestion
+from sample_pdfs import build_report_pdf
+
+
+# Una tanda que falla a mitad del documento no debe dejar el documento a medias en el
+# almacén: la siguiente subida del mismo PDF lo vuelve a extraer entero y la sesión
+# que ya lo usaba conserva las páginas previas al fallo
+def test_failed_chunk_is_extracted_again_on_reupload(monkeypatch):
+    commit = PdfIngestion._commit
+    failures = []
+
+    async def failing_commit(self, chunk):
+        if not failures and len(self.pages) >= 16:
+            failures.append(len(self.pages))
+            raise RuntimeError('tanda corrupta')
+        await commit(self, chunk)
+
+    monkeypatch.setattr(PdfIngestion, '_commit', failing_commit)
+    buffer = build_report_pdf(60)
+
+    async def upload(name):
+        return await A.ingest_upload(FileStorage(io.BytesIO(buffer), filename=name), asyncio.Semaphore(1))
+
+    async def wait_for_ingestions():
+        while A.ingestions:
+            await asyncio.sleep(0.05)
+
+    async def run():
+        async with A.app.test_app():
+            first = await upload('a.pdf')
+            assert first['success']
+            await wait_for_ingestions()
+
+            broken = A.pdf_store[first['sessionId']]['document']
+            assert failures
+            assert 'ingestion' not in broken
+            assert broken['ingested']['error'] == 'tanda corrupta'
+            assert len(broken['pages']) < broken['totalPages']
+            assert A.document_store.get(broken['hash']) is None
+            message = await A.wait_for_ingestion(broken)
+            assert 'tanda corrupta' in message
+
+            second = await upload('b.pdf')
+            assert second['success']
+            await wait_for_ingestions()
+            document = A.pdf_store[second['sessionId']]['document']
+            assert document is not broken
+            assert document['ingested']['error'] is None
+            assert len(document['pages']) == document['totalPages'] == 60
+            assert A.document_store.stats()['retiredDocuments'] == 1
+
+            A.drop_session(first['sessionId'])
+            A.drop_session(second['sessionId'])
+            stats = A.document_store.stats()
+            assert stats['documents'] == 0
+            assert stats['references'] == 0
+
+    asyncio.run(run())
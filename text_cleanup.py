@@ -0,0 +1,179 @@
+import os
+import re
+from collections import Counter
+
+# Limpiar el texto de las páginas al procesar el documento: quitar encabezados y pies
+# de página repetidos, números de página, cortes de palabra con guion y espacios de más
+TEXT_CLEANUP = os.getenv('TEXT_CLEANUP', 'true').lower() == 'true'
+# Proporción mínima de páginas en las que debe repetirse una línea para considerarla
+# encabezado o pie de página (y nunca menos de BOILERPLATE_MIN_PAGES páginas)
+BOILERPLATE_MIN_RATIO = float(os.getenv('BOILERPLATE_MIN_RATIO', 0.3))
+BOILERPLATE_MIN_PAGES = 3
+# Líneas del principio y del final de cada página donde se buscan encabezados y pies
+BOILERPLATE_EDGE_LINES = 3
+# Caracteres máximos del texto de las páginas en una sola llamada al modelo
+# (≈ 4 caracteres por token); el exceso se recorta repartiéndolo entre las páginas
+PROMPT_MAX_CHARS = max(1000, int(os.getenv('PROMPT_MAX_CHARS', 24000)))
+
+TRUNCATION_MARK = "[… texto recortado …]"
+
+HYPHEN_BREAK_REGEX = re.compile(r'(\w)-\n[ \t]*(?=[a-záéíóúüñ])')
+SPACES_REGEX = re.compile(r'[ \t\f\v\xa0]+')
+NUMBER_REGEX = re.compile(r'\d+')
+PAGE_NUMBER_REGEX = re.compile(r'^(?:-\s*)?(?:p[áa]g(?:ina)?\.?|page)?\s*#(?:\s*(?:de|of|/)\s*\d+)?(?:\s*-)?$')
+
+# Contadores de la limpieza (documentos procesados) y de los recortes por presupuesto
+cleanup_stats = {
+    'documents': 0,
+    'rawChars': 0,
+    'cleanChars': 0,
+    'truncatedCalls': 0,
+    'truncatedChars': 0
+}
+
+
+# Función para normalizar el texto de una página: une las palabras cortadas con
+# guion al final de línea y reduce los espacios y las líneas vacías repetidas
+def normalize_text(text):
+    text = HYPHEN_BREAK_REGEX.sub(r'\1', text)
+    lines = []
+    for line in text.split('\n'):
+        line = SPACES_REGEX.sub(' ', line).strip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    return '\n'.join(lines).strip()
+
+
+# Función para obtener la clave de comparación de una línea: en minúsculas y con
+# el número de la página sustituido por '#', para que "Página 3 de 40" y
+# "Página 4 de 40" cuenten como la misma línea
+def line_key(line, page_number):
+    return NUMBER_REGEX.sub(lambda m: '#' if int(m.group()) == page_number else m.group(), line.lower())
+
+
+# Función que devuelve los índices de las líneas de los bordes de una página
+def edge_positions(lines):
+    filled = [i for i, line in enumerate(lines) if line]
+    return set(filled[:BOILERPLATE_EDGE_LINES] + filled[-BOILERPLATE_EDGE_LINES:])
+
+
+# Función para contar las líneas de los bordes de unas páginas ya normalizadas
+def count_edge_lines(texts, first_page=1, counts=None):
+    counts = Counter() if counts is None else counts
+    for page_number, text in enumerate(texts, first_page):
+        lines = text.split('\n')
+        counts.update({line_key(lines[i], page_number) for i in edge_positions(lines)})
+    return counts
+
+
+# Función para elegir, según cuántas páginas de `total_pages` tienen cada línea en
+# sus bordes, las que son encabezados o pies de página
+def frequent_lines(counts, total_pages):
+    if total_pages < BOILERPLATE_MIN_PAGES:
+        return frozenset()
+    threshold = max(BOILERPLATE_MIN_PAGES, BOILERPLATE_MIN_RATIO * total_pages)
+    return frozenset(key for key, count in counts.items() if count >= threshold)
+
+
+# Función para detectar encabezados y pies de página: líneas de los bordes de la
+# página que se repiten en muchas páginas. Recibe los textos ya normalizados.
+def detect_boilerplate(texts, first_page=1):
+    return frequent_lines(count_edge_lines(texts, first_page), len(texts))
+
+
+# Función para quitar de una página los encabezados, pies y números de página
+# (solo en los bordes, para no borrar líneas del cuerpo que coincidan por azar).
+# Devuelve el texto y el número de líneas quitadas.
+def strip_boilerplate(text, page_number, boilerplate):
+    lines = text.split('\n')
+    removed = set()
+    for i in edge_positions(lines):
+        key = line_key(lines[i], page_number)
+        if key in boilerplate or PAGE_NUMBER_REGEX.match(key):
+            removed.add(i)
+    # Una página que solo tiene líneas repetidas (diapositivas, portadillas) se deja entera
+    if not removed or len(removed) == sum(1 for line in lines if line):
+        return text, 0
+    return normalize_text('\n'.join(line for i, line in enumerate(lines) if i not in removed)), len(removed)
+
+
+# Limpieza del texto de un documento que llega por tandas de páginas: los
+# encabezados y pies se detectan con todas las páginas recibidas hasta el momento,
+# de modo que las primeras tandas se limpian sin esperar al resto del documento.
+# Con una sola tanda el resultado es el mismo que detectarlos con todo el documento.
+class PageCleaner:
+    def __init__(self):
+        self.counts = Counter()
+        self.pages = 0
+        self.boilerplate = frozenset()
+        self.report = {'rawChars': 0, 'cleanChars': 0, 'boilerplateLines': 0, 'removedLines': 0}
+        cleanup_stats['documents'] += 1
+
+    # Limpiar una tanda de páginas que empieza en la página `first_page`
+    def clean(self, texts, first_page):
+        normalized = [normalize_text(text) for text in texts]
+        count_edge_lines(normalized, first_page, self.counts)
+        self.pages += len(texts)
+        self.boilerplate = frequent_lines(self.counts, self.pages)
+        cleaned, removed_lines = [], 0
+        for page_number, text in enumerate(normalized, first_page):
+            text, removed = strip_boilerplate(text, page_number, self.boilerplate)
+            cleaned.append(text)
+            removed_lines += removed
+        raw_chars = sum(len(text) for text in texts)
+        clean_chars = sum(len(text) for text in cleaned)
+        self.report['rawChars'] += raw_chars
+        self.report['cleanChars'] += clean_chars
+        self.report['boilerplateLines'] = len(self.boilerplate)
+        self.report['removedLines'] += removed_lines
+        cleanup_stats['rawChars'] += raw_chars
+        cleanup_stats['cleanChars'] += clean_chars
+        return cleaned
+
+
+# Función para limpiar el texto de todas las páginas de un documento. Devuelve los
+# textos limpios y un informe con los caracteres antes y después de limpiar.
+def clean_pages(texts, first_page=1):
+    cleaner = PageCleaner()
+    cleaned = cleaner.clean(texts, first_page)
+    return cleaned, dict(cleaner.report)
+
+
+# Función para recortar un texto al presupuesto indicado, marcando el recorte
+def truncate_text(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars].rstrip()}\n{TRUNCATION_MARK}"
+
+
+# Función para construir el texto de varias páginas para un prompt respetando el
+# presupuesto de caracteres. Las páginas cortas se envían completas y el resto del
+# presupuesto se reparte a partes iguales entre las largas, que se recortan.
+# Recibe pares (número de página, texto) y devuelve el texto y, si hubo que
+# recortar, un informe con las páginas recortadas y los caracteres omitidos.
+def fit_pages(pages, max_chars=None):
+    max_chars = max_chars or PROMPT_MAX_CHARS
+    total = sum(len(text) for _, text in pages)
+    limits = {}
+    if total > max_chars:
+        remaining, pending = max_chars, len(pages)
+        for page_number, text in sorted(pages, key=lambda page: len(page[1])):
+            share = remaining // pending
+            limits[page_number] = min(len(text), share)
+            remaining -= limits[page_number]
+            pending -= 1
+
+    sections, truncated = [], []
+    for page_number, text in pages:
+        limit = limits.get(page_number, len(text))
+        if limit < len(text):
+            truncated.append(page_number)
+            text = truncate_text(text, limit)
+        sections.append(f"--- PÁGINA {page_number} ---\n{text}\n")
+    pages_info = "\n".join(sections)
+    if not truncated:
+        return pages_info, None
+    return pages_info, {
+        'pages': truncated,
+        'droppedChars': total - sum(limits.values())
+    }